@@ -83,7 +83,7 @@ from sipsimple.util import ISOTimestamp
 
 import ChatWindowController
 from BlinkLogger import BlinkLogger
-from ChatViewController import ChatViewController, MSG_STATE_FAILED, MSG_STATE_SENDING, MSG_STATE_DELIVERED
+from ChatViewController import ChatViewController, MSG_STATE_FAILED, MSG_STATE_SENDING, MSG_STATE_DELIVERED, rendered_message_cache
 from ChatOTR import BlinkOtrAccount, ChatOtrSmp
 from ContactListModel import encode_icon, decode_icon
 from FileTransferWindowController import openFileTransferSelectionDialog
@@ -113,6 +113,12 @@ kUIOptionDisableHide = 1 << 6
 
 MAX_MESSAGE_LENGTH = 16*1024
 
+# history messages are sent to the chat view in chunks of this size
+HISTORY_RENDER_CHUNK_SIZE = 250
+
+# messages kept in the chat view, older ones are fetched again from history when scrolled into view
+MAX_RENDERED_MESSAGES = 500
+
 TOOLBAR_SCREENSHARING_MENU_REQUEST_REMOTE = 201
 TOOLBAR_SCREENSHARING_MENU_OFFER_LOCAL = 202
 TOOLBAR_SCREENSHARING_MENU_CANCEL = 203
@@ -222,6 +228,8 @@ class ChatController(MediaStream):
         if self.sessionController.account is BonjourAccount():
             self.chatViewController.setHandleScrolling_(False)
             self.chatViewController.lastMessagesLabel.setHidden_(True)
+        else:
+            self.chatViewController.max_rendered_messages = MAX_RENDERED_MESSAGES
 
         settings = SIPSimpleSettings()
         if settings.chat.font_size < 0:
@@ -625,7 +633,7 @@ class ChatController(MediaStream):
 
 
     def chatViewDidLoad_(self, chatView):
-         self.replay_history()
+         self.replay_history(self.chatViewController.expandSmileys)
 
     def isOutputFrameVisible(self):
         return True if self.outputContainer.frame().size.height > 10 else False
@@ -638,19 +646,16 @@ class ChatController(MediaStream):
 
         self.chatViewController.clear()
         self.chatViewController.resetRenderedMessages()
-        self.replay_history(msgid)
+        self.replay_history(self.chatViewController.expandSmileys, msgid)
 
     @run_in_green_thread
     @allocate_autorelease_pool
-    def replay_history(self, scrollToMessageId=None):
+    def replay_history(self, expandSmileys, scrollToMessageId=None):
+        # expandSmileys is read by the caller, the chat view may be gone while this runs
         if not self:
             return
 
-        blink_contact = self.sessionController.contact
-        if not blink_contact:
-            remote_uris = self.remote_uri
-        else:
-            remote_uris = list(str(uri.uri) for uri in blink_contact.uris if '@' in uri.uri)
+        remote_uris = self.history_remote_uris()
 
         if self.sessionController.account is not BonjourAccount():
             zoom_factor = self.chatViewController.scrolling_zoom_factor
@@ -683,9 +688,12 @@ class ChatController(MediaStream):
                     self.zoom_period_label = NSLocalizedString("Displaying all messages", "Label")
                     self.chatViewController.setHandleScrolling_(False)
 
-                results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=10000, search_text=self.chatViewController.search_text)
+                results = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=10000, search_text=self.chatViewController.search_text)
             else:
-                results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
+                results = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
+
+            # messages left as sent by a previous session were never delivered
+            self.history.update_messages_status([row.id for row in results if row.status == 'sent'], 'failed')
 
             # build a list of previously failed messages
             last_failed_messages=[]
@@ -700,13 +708,104 @@ class ChatController(MediaStream):
             # messages_to_render = [row for row in reversed(list(results)) if row not in last_failed_messages]
             messages_to_render = [row for row in reversed(list(results))]
             #self.resend_last_failed_message(last_failed_messages)
-            self.render_history_messages(messages_to_render, scrollToMessageId)
+            self.render_history_messages(messages_to_render, expandSmileys, scrollToMessageId)
 
         self.send_pending_message()
 
+    def history_remote_uris(self):
+        blink_contact = self.sessionController.contact
+        if not blink_contact:
+            return self.remote_uri
+        return list(str(uri.uri) for uri in blink_contact.uris if '@' in uri.uri)
+
+    @run_in_green_thread
+    @allocate_autorelease_pool
+    def restore_trimmed_messages(self, msgids, expandSmileys):
+        # Fetches the page of messages older than the first of msgids found in history, for
+        # the messages dropped from the virtualized chat view
+        remote_uris = self.history_remote_uris()
+        messages = []
+        more_available = False
+        for msgid in msgids:
+            anchor = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), msgid=msgid, count=1)
+            if anchor:
+                results = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), before=anchor[0].position, count=HISTORY_RENDER_CHUNK_SIZE)
+                more_available = len(results) == HISTORY_RENDER_CHUNK_SIZE
+                messages = list(reversed(results))
+                break
+        self.render_restored_messages(self.history_render_entries(messages, expandSmileys), more_available)
+
     @allocate_autorelease_pool
     @run_in_gui_thread
-    def render_history_messages(self, messages, scrollToMessageId=None):
+    def render_restored_messages(self, entries, more_available):
+        if not self.chatViewController:
+            return
+        self.chatViewController.prependMessages([self.history_message_arguments(message, rendered_text) for message, rendered_text in entries], more_available)
+
+    @run_in_green_thread
+    @allocate_autorelease_pool
+    def restore_newer_messages(self, msgids, expandSmileys):
+        # Fetches the page of messages newer than the first of msgids found in history, for
+        # the messages dropped from the virtualized chat view while scrolling back
+        remote_uris = self.history_remote_uris()
+        messages = []
+        more_available = False
+        for msgid in msgids:
+            anchor = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), msgid=msgid, count=1)
+            if anchor:
+                results = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), after=anchor[0].position, count=HISTORY_RENDER_CHUNK_SIZE)
+                more_available = len(results) == HISTORY_RENDER_CHUNK_SIZE
+                messages = list(reversed(results))
+                break
+        self.render_restored_newer_messages(self.history_render_entries(messages, expandSmileys), more_available)
+
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def render_restored_newer_messages(self, entries, more_available):
+        if not self.chatViewController:
+            return
+        self.chatViewController.appendRestoredMessages([self.history_message_arguments(message, rendered_text) for message, rendered_text in entries], more_available)
+
+    def history_render_entries(self, messages, expandSmileys):
+        # Returns the messages to render along with their bodies converted for the chat view
+        seen_sms = {}
+        entries = []
+        for message in messages:
+            if message.status in ('sent', 'failed'):
+                continue
+
+            if message.sip_callid != '' and message.media_type == 'sms':
+                try:
+                    seen_sms[message.sip_callid]
+                except KeyError:
+                    seen_sms[message.sip_callid] = True
+                else:
+                    continue
+
+            is_html = message.content_type != 'text'
+            entries.append((message, rendered_message_cache.get(message.msgid, message.body, is_html, expandSmileys)))
+        return entries
+
+    def render_history_messages(self, messages, expandSmileys, scrollToMessageId=None):
+        # Message bodies are prepared in the calling green thread, the chat view only gets
+        # one script for each chunk of messages
+        self.render_history_header(messages)
+
+        entries = self.history_render_entries(messages, expandSmileys)
+        for index in xrange(0, len(entries), HISTORY_RENDER_CHUNK_SIZE):
+            chunk = entries[index:index+HISTORY_RENDER_CHUNK_SIZE]
+            self.render_history_chunk(chunk, index + len(chunk), len(entries))
+
+        self.render_history_finished(scrollToMessageId)
+
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def render_history_header(self, messages):
+        if not self.chatViewController:
+            return
+
+        self.chatViewController.beginHistoryReplay()
+
         if self.chatViewController.scrolling_zoom_factor:
             if not self.message_count_from_history:
                 self.message_count_from_history = len(messages)
@@ -747,46 +846,36 @@ class ChatController(MediaStream):
                 else:
                     self.chatViewController.scrolling_zoom_factor = 7
 
-        call_id = None
-        seen_sms = {}
-        last_media_type = None
-
-        for message in messages:
-            if message.status == 'sent':
-                message.status = 'failed'
-
-            if message.status == 'failed':
-                continue
-
-            if message.sip_callid != '' and message.media_type == 'sms':
-                try:
-                    seen_sms[message.sip_callid]
-                except KeyError:
-                    seen_sms[message.sip_callid] = True
-                else:
-                    continue
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def render_history_chunk(self, entries, rendered_count, total_count):
+        if not self.chatViewController:
+            return
 
-            if message.direction == 'outgoing':
-                icon = NSApp.delegate().contactsWindowController.iconPathForSelf()
-            else:
-                sender_uri = sipuri_components_from_string(message.cpim_from)[0]
-                icon = NSApp.delegate().contactsWindowController.iconPathForURI(sender_uri)
+        self.chatViewController.showMessages([self.history_message_arguments(message, rendered_text) for message, rendered_text in entries])
 
-            timestamp=ISOTimestamp(message.cpim_timestamp)
-            is_html = message.content_type != 'text'
-            private = bool(int(message.private))
+        if rendered_count < total_count and not self.outgoing_message_handler.otr_negotiation_in_progress:
+            self.chatViewController.loadingProgressIndicator.startAnimation_(None)
+            self.chatViewController.loadingTextIndicator.setStringValue_(NSLocalizedString("Loading messages %d of %d", "Label") % (rendered_count, total_count))
 
-            if self.chatViewController:
-                #if call_id is not None and call_id != message.sip_callid and  message.media_type == 'chat':
-                    #self.chatViewController.showSystemMessage(message.sip_callid, 'Connection established', timestamp, False)
+    def history_message_arguments(self, message, rendered_text):
+        if message.direction == 'outgoing':
+            icon = NSApp.delegate().contactsWindowController.iconPathForSelf()
+        else:
+            sender_uri = sipuri_components_from_string(message.cpim_from)[0]
+            icon = NSApp.delegate().contactsWindowController.iconPathForURI(sender_uri)
 
-                #if message.media_type == 'sms' and last_media_type == 'chat':
-                    #self.chatViewController.showSystemMessage(message.sip_callid, 'Instant messages', timestamp, False)
+        return dict(call_id=message.sip_callid, msgid=message.msgid, direction=message.direction, sender=message.cpim_from, icon_path=icon, text=message.body,
+                    timestamp=ISOTimestamp(message.cpim_timestamp), is_private=bool(int(message.private)), recipient=message.cpim_to, state=message.status,
+                    is_html=message.content_type != 'text', media_type=message.media_type, encryption=message.encryption, rendered_text=rendered_text)
 
-                self.chatViewController.showMessage(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, is_private=private, recipient=message.cpim_to, state=message.status, is_html=is_html, history_entry=True, media_type = message.media_type, encryption=message.encryption)
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def render_history_finished(self, scrollToMessageId=None):
+        if not self.chatViewController:
+            return
 
-            call_id = message.sip_callid
-            last_media_type = 'chat' if message.media_type == 'chat' else 'sms'
+        self.chatViewController.endHistoryReplay()
 
         if scrollToMessageId is not None:
             self.chatViewController.scrollToId(scrollToMessageId)
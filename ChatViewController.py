@@ -1,7 +1,7 @@
 # Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
 #
 
-__all__ = ['ChatInputTextView', 'ChatViewController', 'processHTMLText',
+__all__ = ['ChatInputTextView', 'ChatViewController', 'processHTMLText', 'renderMessageText', 'rendered_message_cache',
            'MSG_STATE_SENDING', 'MSG_STATE_FAILED', 'MSG_STATE_DELIVERED', 'MSG_STATE_DEFERRED']
 
 import calendar
@@ -14,11 +14,13 @@ import time
 import urllib
 import uuid
 
+from collections import OrderedDict
+from threading import Lock
 from AppKit import NSCommandKeyMask, NSDragOperationNone, NSDragOperationCopy, NSFilenamesPboardType, NSShiftKeyMask, NSTextDidChangeNotification
 from Foundation import NSArray, NSDate, NSLocalizedString, NSMakeRange, NSNotificationCenter, NSObject, NSTextView, NSTimer, NSURL, NSURLRequest, NSWorkspace
 from WebKit import WebView, WebViewProgressFinishedNotification, WebActionOriginalURLKey
 
-from application.notification import NotificationCenter
+from application.notification import NotificationCenter, NotificationData
 from bs4 import BeautifulSoup
 from sipsimple.configuration.settings import SIPSimpleSettings
 from sipsimple.util import ISOTimestamp
@@ -38,6 +40,9 @@ TYPING_IDLE_TIMEOUT = 5
 # if user is typing, is-composing notifications will be sent in the following interval
 TYPING_NOTIFY_INTERVAL = 30
 
+# messages are dropped from virtualized chat views in batches of this size
+RENDERED_MESSAGES_TRIM_SIZE = 100
+
 
 _url_pattern = re.compile("((?:http://|https://|sip:|sips:)[^ )<>\r\n]+)")
 _url_pattern_exact = re.compile("^((?:http://|https://|sip:|sips:)[^ )<>\r\n]+)$")
@@ -82,6 +87,184 @@ def processHTMLText(text='', usesmileys=True, is_html=False):
     return "".join(result)
 
 
+def renderMessageText(text, is_html=False, usesmileys=True):
+    # does not touch any view, so that message bodies can be prepared outside the GUI thread
+    if is_html:
+        # urlify links
+        soup = BeautifulSoup(text)
+        ps = soup.find_all('p')
+        for p in ps:
+            if not p.string:
+                continue
+            ptext = p.string.strip()
+            p.clear()
+            tokens = _url_pattern.split(ptext)
+            for token in tokens:
+                if _url_pattern.match(token):
+                    new_tag = soup.new_tag("a", href=token)
+                    new_tag.string = token
+                    p.append(new_tag)
+                else:
+                    p.append(token)
+
+        text = soup.prettify()
+
+    return processHTMLText(text, usesmileys, is_html)
+
+
+class RenderedMessageCache(object):
+    """Least recently used cache of message bodies converted by renderMessageText"""
+
+    def __init__(self, size=5000):
+        self.size = size
+        self.theme = None
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, msgid, text, is_html=False, usesmileys=True):
+        if not msgid:
+            return renderMessageText(text, is_html, usesmileys)
+
+        smiley_manager = SmileyManager()
+        theme = (smiley_manager.smiley_directory, smiley_manager.theme)
+        key = (msgid, hash(text), is_html, usesmileys)
+        with self.lock:
+            if theme != self.theme:
+                # smileys of the previous theme are in the rendered bodies
+                self.entries.clear()
+                self.theme = theme
+            try:
+                rendered_text = self.entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.entries[key] = rendered_text
+                return rendered_text
+
+        rendered_text = renderMessageText(text, is_html, usesmileys)
+        with self.lock:
+            self.entries[key] = rendered_text
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return rendered_text
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+rendered_message_cache = RenderedMessageCache()
+
+
+class RenderedMessageIndex(object):
+    """Trigram index over the text of the messages rendered in a chat view, positions match rendered_messages"""
+
+    def __init__(self):
+        self.offset = 0    # internal position of rendered_messages[0], messages are trimmed and prepended
+        self.texts = []
+        self.message_call_ids = []
+        self.trigrams = {}
+        self.call_ids = {}
+        self.last_search = None
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def end(self):
+        return self.offset + len(self.texts)
+
+    @staticmethod
+    def _trigrams(text):
+        return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+    def _index(self, position, message):
+        text = message.text.lower() if message.text else u''
+        for trigram in self._trigrams(text):
+            self.trigrams.setdefault(trigram, set()).add(position)
+        return text
+
+    def add(self, message):
+        position = self.end
+        self.texts.append(self._index(position, message))
+        self.message_call_ids.append(message.call_id)
+        if message.call_id:
+            self.call_ids.setdefault(message.call_id, []).append(position)
+
+    def prepend(self, messages):
+        texts = []
+        for index, message in enumerate(messages):
+            texts.append(self._index(self.offset - len(messages) + index, message))
+        for index, message in reversed(list(enumerate(messages))):
+            if message.call_id:
+                self.call_ids.setdefault(message.call_id, []).insert(0, self.offset - len(messages) + index)
+        self.texts[0:0] = texts
+        self.message_call_ids[0:0] = [message.call_id for message in messages]
+        self.offset -= len(messages)
+        self.last_search = None
+
+    def _unindex(self, position, text, call_id):
+        for trigram in self._trigrams(text):
+            postings = self.trigrams[trigram]
+            postings.discard(position)
+            if not postings:
+                del self.trigrams[trigram]
+        if call_id:
+            positions = self.call_ids[call_id]
+            positions.remove(position)
+            if not positions:
+                del self.call_ids[call_id]
+
+    def trim(self, count):
+        for position, text, call_id in zip(xrange(self.offset, self.offset + count), self.texts[:count], self.message_call_ids[:count]):
+            self._unindex(position, text, call_id)
+        del self.texts[:count]
+        del self.message_call_ids[:count]
+        self.offset += count
+        self.last_search = None
+
+    def trim_end(self, count):
+        if count <= 0:
+            return
+        for position, text, call_id in zip(xrange(self.end - count, self.end), self.texts[-count:], self.message_call_ids[-count:]):
+            self._unindex(position, text, call_id)
+        del self.texts[-count:]
+        del self.message_call_ids[-count:]
+        self.last_search = None
+
+    def search(self, text):
+        text = text.lower()
+        candidates = None
+        if self.last_search is not None:
+            last_text, last_positions, last_end = self.last_search
+            if last_text in text:
+                # the search was refined, only previous results and newer messages can match
+                candidates = last_positions.union(xrange(last_end, self.end))
+
+        if len(text) >= 3:
+            postings = sorted((self.trigrams.get(trigram, ()) for trigram in self._trigrams(text)), key=len)
+            positions = set(postings[0])
+            for posting in postings[1:]:
+                if not positions:
+                    break
+                positions.intersection_update(posting)
+            if candidates is not None:
+                positions.intersection_update(candidates)
+        else:
+            positions = candidates if candidates is not None else xrange(self.offset, self.end)
+
+        results = sorted(position for position in positions if text in self.texts[position - self.offset])
+        self.last_search = (text, set(results), self.end)
+        return [position - self.offset for position in results]
+
+    def positions_for_call_ids(self, call_ids):
+        return sorted(position - self.offset for call_id in call_ids for position in self.call_ids.get(call_id, ()))
+
+    @property
+    def stats(self):
+        return NotificationData(messages=len(self.texts), text_length=sum(len(text) for text in self.texts), trigrams=len(self.trigrams),
+                                trigram_postings=sum(len(postings) for postings in self.trigrams.itervalues()), call_ids=len(self.call_ids))
+
+
 class ChatInputTextView(NSTextView):
     owner = None
     maxLength = None
@@ -205,6 +388,20 @@ class ChatViewController(NSObject):
     search_text = None
     related_messages = []
     show_related_messages = False
+    search_index = None
+    hidden_msgids = set()
+    found_msgids = set()
+
+    # when set, only this many messages are kept in view, older ones are fetched again from history
+    max_rendered_messages = None
+    has_trimmed_messages = False
+    # msgid of the message in view followed by newer messages dropped from the view, these
+    # are fetched again from history when the view is scrolled to the bottom
+    trimmed_after_msgid = None
+    restoring_messages = False
+    # messages are not dropped while history is replayed, the replayed ones stay in view
+    replaying_history = False
+    replayed_messages = 0
 
     expandSmileys = True
     editorVisible = False
@@ -241,6 +438,174 @@ class ChatViewController(NSObject):
 
     def resetRenderedMessages(self):
         self.rendered_messages=[]
+        self.search_index = RenderedMessageIndex()
+        self.hidden_msgids = set()
+        self.found_msgids = set()
+        self.has_trimmed_messages = False
+        self.trimmed_after_msgid = None
+        self.restoring_messages = False
+        self.replaying_history = False
+        self.replayed_messages = 0
+
+    def addRenderedMessage(self, message):
+        self.rendered_messages.append(message)
+        self.search_index.add(message)
+
+    def beginHistoryReplay(self):
+        self.replaying_history = True
+
+    def endHistoryReplay(self):
+        # the messages requested from history, like the ones of a zoom period, are kept
+        # in view so that the scroll back anchor is still there
+        self.replaying_history = False
+        self.replayed_messages = len(self.rendered_messages)
+
+    def trimRenderedMessages(self):
+        # keep the transcript of virtualized views bounded, the oldest messages are dropped from the view
+        if self.max_rendered_messages is None or self.replaying_history:
+            return
+
+        max_rendered_messages = max(self.max_rendered_messages, self.replayed_messages)
+        if len(self.rendered_messages) < max_rendered_messages + RENDERED_MESSAGES_TRIM_SIZE:
+            return
+
+        count = len(self.rendered_messages) - max_rendered_messages
+        msgids = [message.msgid for message in self.rendered_messages[:count]]
+        del self.rendered_messages[:count]
+        self.search_index.trim(count)
+        self.has_trimmed_messages = True
+        if self.trimmed_after_msgid in msgids:
+            # the messages missing after it are now the older ones dropped from the view
+            self.trimmed_after_msgid = None
+        self.removeMessages(msgids)
+
+    def trimNewerRenderedMessages(self):
+        # after older messages were restored the newest ones are dropped from the view, so
+        # that scrolling back keeps the transcript bounded as well
+        if self.max_rendered_messages is None:
+            return
+
+        count = len(self.rendered_messages) - max(self.max_rendered_messages, self.replayed_messages)
+        if count <= 0:
+            return
+
+        msgids = [message.msgid for message in self.rendered_messages[-count:]]
+        del self.rendered_messages[-count:]
+        self.search_index.trim_end(count)
+        self.trimmed_after_msgid = self.rendered_messages[-1].msgid
+        self.removeMessages(msgids)
+
+    def removeMessages(self, msgids):
+        self.hidden_msgids.difference_update(msgids)
+        self.found_msgids.difference_update(msgids)
+
+        script = "removeMessages([%s])" % ", ".join("'%s'" % msgid for msgid in msgids)
+        if self.finishedLoading:
+            self.executeJavaScript(script)
+        else:
+            self.messageQueue.append(script)
+
+    def restoreTrimmedMessages(self):
+        if self.restoring_messages or not self.rendered_messages or not hasattr(self.delegate, "restore_trimmed_messages"):
+            return
+        self.restoring_messages = True
+        # the oldest message in view which is also in history is used as the anchor
+        self.delegate.restore_trimmed_messages([message.msgid for message in self.rendered_messages[:RENDERED_MESSAGES_TRIM_SIZE]], self.expandSmileys)
+
+    def prependMessages(self, messages, more_available=True):
+        # Renders messages fetched again from history above the oldest message in view, each
+        # message is a dictionary of renderMessageArguments keyword arguments
+        self.restoring_messages = False
+        self.has_trimmed_messages = more_available
+        if not messages or self.search_index is None:
+            return
+
+        last_sender = self.last_sender
+        previous_msgid = self.previous_msgid
+        self.last_sender = None
+        self.previous_msgid = ""
+        try:
+            script = "prependMessages([%s])" % ", ".join("[%s]" % self.renderMessageArguments(**message) for message in messages)
+        finally:
+            self.last_sender = last_sender
+            self.previous_msgid = previous_msgid
+
+        rendered_messages = [ChatMessageObject(message['call_id'], message['msgid'], message['text'], message.get('is_html', False), message['timestamp'], message.get('media_type', 'chat')) for message in messages]
+        self.rendered_messages[0:0] = rendered_messages
+        self.search_index.prepend(rendered_messages)
+        self.executeJavaScript(script)
+        self.trimNewerRenderedMessages()
+
+    def restoreNewerMessages(self):
+        if self.restoring_messages or self.trimmed_after_msgid is None or not hasattr(self.delegate, "restore_newer_messages"):
+            return
+        msgids = [message.msgid for message in self.rendered_messages]
+        try:
+            position = msgids.index(self.trimmed_after_msgid)
+        except ValueError:
+            self.trimmed_after_msgid = None
+            return
+        self.restoring_messages = True
+        # the newest message before the missing ones which is also in history is used as the anchor
+        self.delegate.restore_newer_messages(list(reversed(msgids[max(0, position + 1 - RENDERED_MESSAGES_TRIM_SIZE):position + 1])), self.expandSmileys)
+
+    def appendRestoredMessages(self, messages, more_available=True):
+        # Renders messages fetched again from history below the message after which newer
+        # messages were dropped, messages are ordered oldest first
+        self.restoring_messages = False
+        if self.search_index is None or self.trimmed_after_msgid is None:
+            return
+
+        msgids = [message.msgid for message in self.rendered_messages]
+        try:
+            position = msgids.index(self.trimmed_after_msgid) + 1
+        except ValueError:
+            self.trimmed_after_msgid = None
+            return
+
+        # messages received meanwhile are rendered after the missing ones, reaching one of them closes the gap
+        previous_msgids = set(msgids[:position])
+        next_msgids = set(msgids[position:])
+        restored_messages = []
+        gap_closed = not more_available
+        for message in messages:
+            if message['msgid'] in next_msgids:
+                gap_closed = True
+                break
+            if message['msgid'] not in previous_msgids:
+                restored_messages.append(message)
+
+        if restored_messages:
+            last_sender = self.last_sender
+            previous_msgid = self.previous_msgid
+            self.last_sender = None
+            self.previous_msgid = ""
+            try:
+                script = "insertMessagesAfter('%s', [%s])" % (self.trimmed_after_msgid, ", ".join("[%s]" % self.renderMessageArguments(**message) for message in restored_messages))
+            finally:
+                self.last_sender = last_sender
+                self.previous_msgid = previous_msgid
+
+            # the index only grows at its ends, the messages received meanwhile are indexed again after the restored ones
+            next_messages = self.rendered_messages[position:]
+            del self.rendered_messages[position:]
+            self.search_index.trim_end(len(next_messages))
+            for message in restored_messages:
+                self.addRenderedMessage(ChatMessageObject(message['call_id'], message['msgid'], message['text'], message.get('is_html', False), message['timestamp'], message.get('media_type', 'chat')))
+            for message in next_messages:
+                self.addRenderedMessage(message)
+            self.trimmed_after_msgid = restored_messages[-1]['msgid']
+            self.executeJavaScript(script)
+
+        if gap_closed:
+            self.trimmed_after_msgid = None
+        self.trimRenderedMessages()
+
+    def transcriptStats(self):
+        stats = self.search_index.stats if self.search_index is not None else NotificationData(messages=0, text_length=0, trigrams=0, trigram_postings=0, call_ids=0)
+        stats.rendered_messages = len(self.rendered_messages)
+        stats.has_trimmed_messages = self.has_trimmed_messages
+        return stats
 
     def setAccount_(self, account):
         self.account = account
@@ -264,82 +629,90 @@ class ChatViewController(NSObject):
 
     @objc.IBAction
     def searchMessages_(self, sender):
-        for message in self.rendered_messages:
-            self.unmarkFound(message.msgid)
-
         self.search_text = unicode(self.searchMessagesBox.stringValue()).strip() or None
+        if self.search_index is None:
+            return
 
         call_ids = set()
+        found_msgids = set()
         if self.search_text is not None:
-            for message in self.rendered_messages:
-                if self.search_text.lower() in message.text.lower():
-                    if message.call_id:
-                        call_ids.add(message.call_id)
-                        if message.media_type == 'sms':
-                            pivot_timestamp = message.timestamp
+            for pivot_index in self.search_index.search(self.search_text):
+                message = self.rendered_messages[pivot_index]
+                if message.call_id:
+                    call_ids.add(message.call_id)
+                    if message.media_type == 'sms':
+                        pivot_timestamp = message.timestamp
+                        index = pivot_index
+                        while True:
+                            index -= 1
+                            if index <= 0:
+                                break
+
+                            previous_message = self.rendered_messages[index]
+                            if previous_message.media_type != 'sms':
+                                break
+
+                            timediff = pivot_timestamp - previous_message.timestamp
+                            if timediff.seconds < 3600:
+                                call_ids.add(previous_message.call_id)
+                            else:
+                                break
+
+                        index = pivot_index
+                        while True:
+                            index += 1
+
                             try:
-                                pivot_index = self.rendered_messages.index(message)
-                            except ValueError:
-                                pass
+                                next_message = self.rendered_messages[index]
+                            except IndexError:
+                                break
+
+                            if next_message.media_type != 'sms':
+                                break
+
+                            timediff = next_message.timestamp - pivot_timestamp
+
+                            if timediff.seconds < 3600:
+                                call_ids.add(next_message.call_id)
                             else:
-                                index = pivot_index
-                                while True:
-                                    index -= 1
-                                    if index <= 0:
-                                        break
-
-                                    try:
-                                        previous_message = self.rendered_messages[index]
-                                    except IndexError:
-                                        break
-
-                                    if previous_message.media_type != 'sms':
-                                        break
-
-                                    timediff = pivot_timestamp - previous_message.timestamp
-                                    if timediff.seconds < 3600:
-                                        call_ids.add(previous_message.call_id)
-                                    else:
-                                        break
-
-                                index = pivot_index
-                                while True:
-                                    index += 1
-
-                                    try:
-                                        next_message = self.rendered_messages[index]
-                                    except IndexError:
-                                        break
-
-                                    if next_message.media_type != 'sms':
-                                        break
-
-                                    timediff = next_message.timestamp - pivot_timestamp
-
-                                    if timediff.seconds < 3600:
-                                        call_ids.add(next_message.call_id)
-                                    else:
-                                        break
-
-                    self.htmlBoxVisible('c%s' % message.msgid)
-                    self.markFound(message.msgid)
-                    call_ids.discard(message.msgid)
-                else:
-                    self.htmlBoxHidden('c%s' % message.msgid)
+                                break
+
+                found_msgids.add(message.msgid)
+                call_ids.discard(message.msgid)
+
+            hidden_msgids = set(message.msgid for message in self.rendered_messages)
+            hidden_msgids.difference_update(found_msgids)
         else:
-            for message in self.rendered_messages:
-                self.htmlBoxVisible('c%s' % message.msgid)
+            hidden_msgids = set()
 
-        self.related_messages = [message for message in self.rendered_messages if message.call_id in call_ids]
+        self.related_messages = [self.rendered_messages[index] for index in self.search_index.positions_for_call_ids(call_ids)]
 
         if self.show_related_messages:
-            for message in self.related_messages:
-                self.htmlBoxVisible('c%s' % message.msgid)
+            hidden_msgids.difference_update(message.msgid for message in self.related_messages)
             self.show_related_messages = False
 
+        self.applySearchResults(hidden_msgids, found_msgids)
+
         if self.related_messages:
             self.showRelatedMessagesButton.setHidden_(False)
 
+    def applySearchResults(self, hidden_msgids, found_msgids):
+        # only the messages whose state changed since the previous search are updated
+        hide = hidden_msgids - self.hidden_msgids
+        show = self.hidden_msgids - hidden_msgids
+        mark = found_msgids - self.found_msgids
+        unmark = self.found_msgids - found_msgids
+        self.hidden_msgids = hidden_msgids
+        self.found_msgids = found_msgids
+        if not (hide or show or mark or unmark):
+            return
+
+        def js_array(msgids):
+            return "[%s]" % ", ".join("'%s'" % msgid for msgid in msgids)
+
+        script = "applySearchResults(%s, %s, %s, %s)" % (js_array(hide), js_array(show), js_array(mark), js_array(unmark))
+        self.executeJavaScript(script)
+
     def htmlBoxVisible(self, msgid):
         script = """htmlBoxVisible('%s')""" % msgid
         self.executeJavaScript(script)
@@ -430,7 +803,7 @@ class ChatViewController(NSObject):
     def showSystemMessage(self, call_id, text, timestamp=None, is_error=False):
         msgid = str(uuid.uuid1())
         rendered_message = ChatMessageObject(call_id, msgid, text, False, timestamp)
-        self.rendered_messages.append(rendered_message)
+        self.addRenderedMessage(rendered_message)
 
         if timestamp is None:
             timestamp = ISOTimestamp.now()
@@ -448,7 +821,48 @@ class ChatViewController(NSObject):
         else:
             self.messageQueue.append(script)
 
+        self.trimRenderedMessages()
+
     def showMessage(self, call_id, msgid, direction, sender, icon_path, text, timestamp, is_html=False, state='', recipient='', is_private=False, history_entry=False, media_type='chat', encryption=None):
+        if not history_entry and not self.delegate.isOutputFrameVisible():
+            self.delegate.showChatViewWhileVideoActive()
+
+        # keep track of rendered messages to toggle the smileys or search their content later
+        self.addRenderedMessage(ChatMessageObject(call_id, msgid, text, is_html, timestamp, media_type))
+        script = "renderMessage(%s)" % self.renderMessageArguments(call_id, msgid, direction, sender, icon_path, text, timestamp, is_html=is_html, state=state, recipient=recipient, is_private=is_private, media_type=media_type, encryption=encryption)
+
+        if self.finishedLoading:
+            self.executeJavaScript(script)
+        else:
+            self.messageQueue.append(script)
+
+        self.trimRenderedMessages()
+
+        if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
+            self.delegate.chatViewDidGetNewMessage_(self)
+
+    def showMessages(self, messages):
+        # Renders history messages with a single script, each message is a dictionary
+        # of renderMessageArguments keyword arguments
+        if not messages:
+            return
+
+        for message in messages:
+            self.addRenderedMessage(ChatMessageObject(message['call_id'], message['msgid'], message['text'], message.get('is_html', False), message['timestamp'], message.get('media_type', 'chat')))
+        script = "renderMessages([%s])" % ", ".join("[%s]" % self.renderMessageArguments(**message) for message in messages)
+
+        if self.finishedLoading:
+            self.executeJavaScript(script)
+        else:
+            self.messageQueue.append(script)
+
+        self.trimRenderedMessages()
+
+        if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
+            self.delegate.chatViewDidGetNewMessage_(self)
+
+    def renderMessageArguments(self, call_id, msgid, direction, sender, icon_path, text, timestamp, is_html=False, state='', recipient='', is_private=False, media_type='chat', encryption=None, rendered_text=None):
+        # rendered_text is the body already converted by renderMessageText
         lock_icon_path = Resources.get('unlocked-darkgray.png')
         if encryption is not None:
             if encryption == '':
@@ -463,39 +877,12 @@ class ChatViewController(NSObject):
 
         self.last_sender = sender
 
-        if not history_entry and not self.delegate.isOutputFrameVisible():
-            self.delegate.showChatViewWhileVideoActive()
-
-        # keep track of rendered messages to toggle the smileys or search their content later
-        rendered_message = ChatMessageObject(call_id, msgid, text, is_html, timestamp, media_type)
-        self.rendered_messages.append(rendered_message)
-
         if timestamp.date() != datetime.date.today():
             displayed_timestamp = time.strftime("%F %T", time.localtime(calendar.timegm(timestamp.utctimetuple())))
         else:
             displayed_timestamp = time.strftime("%T", time.localtime(calendar.timegm(timestamp.utctimetuple())))
 
-        if is_html:
-            # urlify links
-            soup = BeautifulSoup(text)
-            ps = soup.find_all('p')
-            for p in ps:
-                if not p.string:
-                    continue
-                ptext = p.string.strip()
-                p.clear()
-                tokens = _url_pattern.split(ptext)
-                for token in tokens:
-                    if _url_pattern.match(token):
-                        new_tag = soup.new_tag("a", href=token)
-                        new_tag.string = token
-                        p.append(new_tag)
-                    else:
-                        p.append(token)
-
-            text = soup.prettify()
-
-        text = processHTMLText(text, self.expandSmileys, is_html)
+        text = rendered_text if rendered_text is not None else rendered_message_cache.get(msgid, text, is_html, self.expandSmileys)
         private = 1 if is_private else "null"
 
         if is_private and recipient:
@@ -506,24 +893,20 @@ class ChatViewController(NSObject):
             else:
                 label = cgi.escape(self.account.display_name or self.account.id) if sender is None else cgi.escape(sender)
 
-        script = """renderMessage('%s', '%s', '%s', %s, "%s", '%s', '%s', %s, '%s', '%s')""" % (msgid, direction, label, icon_path, text, displayed_timestamp, state, private, lock_icon_path, self.previous_msgid)
-
-        if self.finishedLoading:
-            self.executeJavaScript(script)
-        else:
-            self.messageQueue.append(script)
-
-        if hasattr(self.delegate, "chatViewDidGetNewMessage_"):
-            self.delegate.chatViewDidGetNewMessage_(self)
-
+        arguments = """'%s', '%s', '%s', %s, "%s", '%s', '%s', %s, '%s', '%s'""" % (msgid, direction, label, icon_path, text, displayed_timestamp, state, private, lock_icon_path, self.previous_msgid)
         self.previous_msgid = msgid
+        return arguments
 
     def toggleSmileys(self, expandSmileys):
         for entry in self.rendered_messages:
             self.updateMessage(entry.msgid, entry.text, entry.is_html, expandSmileys)
 
     def updateMessage(self, msgid, text, is_html, expandSmileys):
-        text = processHTMLText(text, expandSmileys, is_html)
+        if is_html:
+            # links of HTML bodies are left as they are, only the smileys are updated
+            text = processHTMLText(text, expandSmileys, is_html)
+        else:
+            text = rendered_message_cache.get(msgid, text, is_html, expandSmileys)
         script = """updateMessageBodyContent('%s', "%s")""" % (msgid, text)
         self.executeJavaScript(script)
 
@@ -613,10 +996,20 @@ class ChatViewController(NSObject):
             return False
         if sel == "isScrolling:":
             return False
+        if sel == "isScrolledToBottom":
+            return False
 
         return True
 
+    def isScrolledToBottom(self):
+        if self.trimmed_after_msgid is not None and not self.editorVisible:
+            self.restoreNewerMessages()
+
     def isScrolling_(self, scrollTop):
+        if scrollTop == 0 and self.has_trimmed_messages and not self.editorVisible:
+            self.restoreTrimmedMessages()
+            return
+
         if not self.handle_scrolling:
             return
 
@@ -680,6 +1073,8 @@ class ChatViewController(NSObject):
     def close(self):
         # memory clean up
         self.rendered_messages = set()
+        self.search_index = None
+        self.max_rendered_messages = None
         self.pending_messages = {}
         self.view.removeFromSuperview()
         self.inputText.setOwner(None)
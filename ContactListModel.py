@@ -73,11 +73,16 @@ import base64
 import bisect
 import datetime
 import glob
+import hashlib
+import httplib
 import os
 import re
 import cPickle
+import shutil
+import socket
 import unicodedata
 import urllib
+import urllib2
 import uuid
 import sys
 import time
@@ -87,8 +92,8 @@ from application.python import Null
 from application.python.descriptor import classproperty
 from application.python.types import Singleton
 from application.system import makedirs, unlink
+from collections import namedtuple, OrderedDict
 from eventlib import api
-from eventlib.green import urllib2
 from itertools import chain
 from sipsimple.configuration import DuplicateIDError
 from sipsimple.configuration.settings import SIPSimpleSettings
@@ -99,7 +104,8 @@ from sipsimple.payloads import prescontent
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.threading import run_in_thread
 from sipsimple.util import ISOTimestamp
-from twisted.internet.error import ConnectionLost
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implements
 
 from ContactController import AddContactController, EditContactController
@@ -110,7 +116,7 @@ from HistoryManager import SessionHistory
 from MergeContactController import MergeContactController
 from VirtualGroups import VirtualGroupsManager, VirtualGroup
 from resources import ApplicationData, Resources
-from util import allocate_autorelease_pool, format_date, format_uri_type, is_anonymous, sipuri_components_from_string, sip_prefix_pattern, strip_addressbook_special_characters, run_in_gui_thread, utc_to_local
+from util import allocate_autorelease_pool, clear_identity_cache, format_date, format_uri_type, is_anonymous, sipuri_components_from_string, sip_prefix_pattern, strip_addressbook_special_characters, run_in_gui_thread, run_in_thread_pool, utc_to_local
 
 status_localized = {
     'busy':      NSLocalizedString("busy", "Label"),
@@ -200,6 +206,173 @@ def presence_status_for_contact(contact, uri=None):
         return status
 
 
+PresenceDevice = namedtuple('PresenceDevice', 'id description user_agent contact location local_time time_offset notes status caps icon aor timestamp')
+PresenceSnapshot = namedtuple('PresenceSnapshot', 'busy available away offline devices urls notes_count icon transitions')
+
+
+def aggregate_presence(pidfs):
+    # pure function of the PIDF documents, safe to run outside the GUI thread
+    basic_status = 'closed'
+    status = dict(available=False, away=False, busy=False, offline=False)
+    notes_count = 0
+    devices = OrderedDict()
+    urls = []
+    transitions = []
+    for pidf in pidfs:
+        aor = str(urllib.unquote(pidf.entity))
+        if not aor.startswith(('sip:', 'sips:')):
+            aor = 'sip:'+aor
+        uri_text = sip_prefix_pattern.sub('', aor)
+
+        # make a list of latest services
+        most_recent_service_timestamp = None
+        most_recent_service = None
+        most_recent_services = []
+        for service in pidf.services:
+            if hasattr(service, 'timestamp') and service.timestamp is not None:
+                if most_recent_service_timestamp is None:
+                    # add service
+                    most_recent_service_timestamp = service.timestamp.value
+                    most_recent_service = service
+                elif service.timestamp.value >= most_recent_service_timestamp:
+                    if service.user_input is not None and service.user_input.value == 'idle':
+                        # replace older idle with newer
+                        if most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
+                            most_recent_service_timestamp = service.timestamp.value
+                            most_recent_service = service
+                    else:
+                        # replace idle with non-idle
+                        if service.status.basic == 'open':
+                            most_recent_service_timestamp = service.timestamp.value
+                            most_recent_service = service
+                elif service.timestamp.value < most_recent_service_timestamp:
+                    # replace newer idle with older non-idle
+                    if service.user_input is not None and service.user_input.value != 'idle' and most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
+                        most_recent_service_timestamp = service.timestamp.value
+                        most_recent_service = service
+            else:
+                # services without timestamp will be weighted later
+                most_recent_services.append(service)
+
+        if most_recent_service is not None:
+            most_recent_services.append(most_recent_service)
+
+        # services are compared by identity, in the order of the document
+        most_recent_ids = set(id(service) for service in most_recent_services)
+        recent_services = [service for service in pidf.services if id(service) in most_recent_ids]
+
+        if basic_status == 'closed':
+            basic_status = 'open' if any(service.status.basic == 'open' for service in recent_services) else 'closed'
+
+        _busy = any(service.status.extended == 'busy' for service in recent_services)
+        _available = any(service.status.extended == 'available' for service in recent_services) or any(service.status.extended is None and basic_status == 'open' for service in pidf.services)
+        _away = any(service.status.extended == 'away' for service in recent_services)
+        _offline = any(service.status.extended == 'offline' for service in recent_services)
+        status['busy'] = status['busy'] or _busy
+        status['available'] = status['available'] or _available
+        status['away'] = status['away'] or _away
+        status['offline'] = status['offline'] or _offline
+
+        if _busy:
+            device_wining_status = 'busy'
+        elif _available:
+            device_wining_status = 'available'
+        elif _away:
+            device_wining_status = 'away'
+        else:
+            device_wining_status = 'offline'
+
+        _presence_open_notes = sorted([unicode(note) for service in recent_services if service.status.basic == 'open' for note in service.notes if note])
+        _presence_closed_notes = sorted([unicode(note) for service in recent_services if service.status.basic == 'closed' for note in service.notes if note])
+
+        _presence_notes = tuple(_presence_closed_notes if device_wining_status == 'offline' else _presence_open_notes)
+
+        notes_count += len(_presence_notes)
+
+        for service in pidf.services:
+            is_recent = id(service) in most_recent_ids
+            if service.homepage is not None and service.homepage.value:
+                urls.append(service.homepage.value)
+
+            caps = set()
+            if service.capabilities is not None:
+                if service.capabilities.audio:
+                    caps.add("audio")
+                if service.capabilities.message:
+                    caps.add("chat")
+                if service.capabilities.file_transfer:
+                    caps.add("file-transfer")
+                if service.capabilities.screen_sharing_server:
+                    caps.add("screen-sharing-server")
+                if service.capabilities.screen_sharing_client:
+                    caps.add("screen-sharing-client")
+
+            contact = urllib.unquote(service.contact.value) if service.contact is not None else aor
+            if not contact.startswith(('sip:', 'sips:')):
+                contact = 'sip:'+contact
+
+            if is_recent and service.icon is not None:
+                icon = unicode(service.icon)
+            else:
+                icon = None
+
+            if service.device_info is not None:
+                if service.device_info.time_offset is not None:
+                    ctime = datetime.datetime.utcnow() + datetime.timedelta(minutes=int(service.device_info.time_offset))
+                    time_offset = int(service.device_info.time_offset)/60.0
+                    if time_offset == int(time_offset):
+                        offset_info = '(UTC+%d%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
+                    else:
+                        offset_info = '(UTC+%.1f%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
+                    offset_info_text = "%s %s" % (ctime.strftime("%H:%M"), offset_info)
+                else:
+                    offset_info = None
+                    offset_info_text = None
+                if service.status.extended is not None:
+                    device_wining_status = str(service.status.extended)
+                device_text = '%s running %s' % (service.device_info.description, service.device_info.user_agent) if service.device_info.user_agent else service.device_info.description
+                description = service.device_info.description
+                user_agent = service.device_info.user_agent
+
+            else:
+                device_text = '%s' % service.id
+                description = None
+                user_agent = None
+                offset_info = None
+                offset_info_text = None
+
+            try:
+                device = devices[service.id]
+            except KeyError:
+                devices[service.id] = {
+                    'id'          : service.id,
+                    'description' : description,
+                    'user_agent'  : user_agent,
+                    'contact'     : contact,
+                    'location'    : service.map.value if service.map is not None else None,
+                    'local_time'  : offset_info_text,
+                    'time_offset' : offset_info,
+                    'notes'       : _presence_notes,
+                    'status'      : device_wining_status,
+                    'caps'        : frozenset(caps),
+                    'icon'        : icon,
+                    'aor'         : [aor],
+                    'timestamp'   : service.timestamp if hasattr(service, 'timestamp') and service.timestamp is not None else None
+                    }
+            else:
+                device['aor'].append(aor)
+
+            if is_recent:
+                transitions.append((service.id, device_text, uri_text, device_wining_status, _presence_notes))
+
+    # Get the winning icon
+    icons = dict((device['status'], device['icon']) for device in reversed(devices.values()) if device['icon'] is not None)
+    icon = next((icons[status] for status in ('busy', 'available', 'away', 'offline') if status in icons), None)
+
+    devices = tuple(PresenceDevice(**dict(device, aor=tuple(device['aor']))) for device in devices.itervalues())
+    return PresenceSnapshot(devices=devices, urls=tuple(urls), notes_count=notes_count, icon=icon, transitions=tuple(transitions), **status)
+
+
 def encode_icon(icon):
     if not icon:
         return None
@@ -340,6 +513,172 @@ class PresenceContactAvatar(Avatar):
         unlink(self.path)
 
 
+# icons published in presence documents are downloaded by a few threads at a time
+avatar_pool = ThreadPool(minthreads=1, maxthreads=4, name='avatar-fetching')
+avatar_pool.start()
+reactor.addSystemEventTrigger('before', 'shutdown', avatar_pool.stop)
+
+run_in_avatar_thread = run_in_thread_pool(avatar_pool)
+
+
+class AvatarFetcher(object):
+    """Downloads the icons published by contacts into a cache shared by all contacts and accounts"""
+    __metaclass__ = Singleton
+
+    timeout = 30
+    # the least recently downloaded icons are dropped from the cache above this many URLs
+    max_entries = 1000
+
+    def __init__(self):
+        self.cache_path = os.path.join(Avatar.base_path, 'cache')
+        self.index_path = os.path.join(self.cache_path, 'index.pickle')
+        makedirs(self.cache_path)
+        # url -> (etag, content digest) of the last downloaded icons, the most recent last
+        try:
+            with open(self.index_path, 'rb') as f:
+                self.index = OrderedDict(cPickle.load(f))
+        except Exception:
+            self.index = OrderedDict()
+        # url -> {contact id: contact} waiting for the same download
+        self.requests = {}
+        self._prune(set(digest for etag, digest in self.index.itervalues()))
+
+    def path_for_digest(self, digest):
+        return os.path.join(self.cache_path, digest)
+
+    def fetch(self, contact, icon_url):
+        if not icon_url:
+            # Don't remove icon, keep last used one around
+            return
+
+        url, token, icon_hash = icon_url.partition('blink-icon')
+        if token:
+            # Fast path
+            if contact.icon_info and contact.icon_info.etag == icon_hash:
+                return
+
+        try:
+            self.requests[icon_url][contact.id] = contact
+        except KeyError:
+            self.requests[icon_url] = {contact.id: contact}
+            etag, digest = self.index.get(icon_url, (None, None))
+            if digest is not None and not os.path.isfile(self.path_for_digest(digest)):
+                etag, digest = None, None
+            self._download(icon_url, etag, digest)
+
+    @run_in_avatar_thread
+    @allocate_autorelease_pool
+    def _download(self, icon_url, etag, digest):
+        headers = {'If-None-Match': etag} if etag else {}
+        req = urllib2.Request(icon_url, headers=headers)
+        try:
+            response = urllib2.urlopen(req, timeout=self.timeout)
+            content = response.read()
+            info = response.info()
+            content_type = info.getheader('content-type')
+            etag = info.getheader('etag')
+        except urllib2.HTTPError, e:
+            if e.code == 304 and digest is not None:
+                # the cached icon did not change
+                self._finish(icon_url, etag, digest)
+            else:
+                self._finish(icon_url, None, None)
+            return
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            self._finish(icon_url, None, None)
+            return
+
+        if etag is not None:
+            if etag.startswith('W/'):
+                etag = etag[2:]
+            etag = etag.replace('\"', '')
+        if content_type == prescontent.PresenceContentDocument.content_type:
+            try:
+                pres_content = prescontent.PresenceContentDocument.parse(content)
+                content = base64.decodestring(pres_content.data.value)
+            except Exception:
+                self._finish(icon_url, None, None)
+                return
+
+        # Check if the icon can be loaded in a NSImage
+        try:
+            icon = NSImage.alloc().initWithData_(NSData.alloc().initWithBytes_length_(content, len(content)))
+        except Exception:
+            icon = None
+        if not icon:
+            self._finish(icon_url, None, None)
+            return
+        del icon
+
+        digest = hashlib.sha1(content).hexdigest()
+        path = self.path_for_digest(digest)
+        if not os.path.isfile(path):
+            try:
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(content)
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError), e:
+                BlinkLogger().log_error(u"Failed to save icon %s: %s" % (icon_url, e))
+                self._finish(icon_url, None, None)
+                return
+        self._finish(icon_url, etag, digest)
+
+    @run_in_gui_thread
+    def _finish(self, icon_url, etag, digest):
+        contacts = self.requests.pop(icon_url, {})
+        if digest is None:
+            return
+        if self.index.get(icon_url) != (etag, digest):
+            removed = [self.index.pop(icon_url, (None, None))[1]]
+            self.index[icon_url] = (etag, digest)
+            while len(self.index) > self.max_entries:
+                removed.append(self.index.popitem(last=False)[1][1])
+            # icons are shared by URLs with the same content, only the ones no longer used are deleted
+            used = set(digest for etag, digest in self.index.itervalues())
+            self._save_index(self.index.copy(), set(digest for digest in removed if digest is not None and digest not in used))
+        path = self.path_for_digest(digest)
+        notification_center = NotificationCenter()
+        for contact in contacts.itervalues():
+            notification_center.post_notification("BlinkContactAvatarWasFetched", sender=contact, data=NotificationData(url=icon_url, etag=etag, path=path))
+
+    @run_in_thread('file-io')
+    def _save_index(self, index, unused_digests):
+        try:
+            with open(self.index_path + '.tmp', 'wb') as f:
+                cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(self.index_path + '.tmp', self.index_path)
+        except (IOError, OSError, cPickle.PicklingError), e:
+            BlinkLogger().log_error(u"Failed to save icon cache index: %s" % e)
+            return
+        for digest in unused_digests:
+            unlink(self.path_for_digest(digest))
+
+    @run_in_thread('file-io')
+    def _prune(self, used_digests):
+        # removes the icons left over by an index that was lost or not saved
+        try:
+            names = os.listdir(self.cache_path)
+        except OSError, e:
+            BlinkLogger().log_error(u"Failed to list icon cache: %s" % e)
+            return
+        for name in names:
+            if name not in used_digests and name != os.path.basename(self.index_path):
+                unlink(os.path.join(self.cache_path, name))
+
+
+def split_uri(uri):
+    if isinstance(uri, (FrozenSIPURI, SIPURI)):
+        return (uri.user or '', uri.host or '')
+    elif '@' in uri:
+        uri = sip_prefix_pattern.sub("", uri)
+        user, _, host = uri.partition("@")
+        host = host.partition(":")[0]
+        return (user, host)
+    else:
+        user = uri.partition(":")[0]
+        return (user, '')
+
+
 class BlinkContact(NSObject):
     """Basic Contact representation in Blink UI"""
     editable = True
@@ -438,16 +777,7 @@ class BlinkContact(NSObject):
         return any(text in item for item in chain((uri.uri.lower() for uri in self.uris), (self.name.lower(),)))
 
     def split_uri(self, uri):
-        if isinstance(uri, (FrozenSIPURI, SIPURI)):
-            return (uri.user or '', uri.host or '')
-        elif '@' in uri:
-            uri = sip_prefix_pattern.sub("", uri)
-            user, _, host = uri.partition("@")
-            host = host.partition(":")[0]
-            return (user, host)
-        else:
-            user = uri.partition(":")[0]
-            return (user, '')
+        return split_uri(uri)
 
     def matchesURI(self, uri, exact_match=False):
 
@@ -699,6 +1029,7 @@ class BlinkPresenceContact(BlinkContact):
         self.old_presence_note = None
         self.old_resource_state = None
         self.pidfs_map = {}
+        self.pidfs_generation = 0
         self.init_presence_state()
         self.timer = None
         self.application_will_end = False
@@ -839,8 +1170,8 @@ class BlinkPresenceContact(BlinkContact):
             else:
                 NotificationCenter().post_notification("BlinkContactsHaveChanged", sender=self)
 
-    def handle_presence_resources(self, resources, account, full_state=False, log=False):
-        # log should be set only for contacts in all contacs group
+    def update_presence_resources(self, resources, account, full_state=False, log=False):
+        # log should be set only for contacts in all contacs group, the pidfs are aggregated by the caller
         if self.application_will_end:
             return
 
@@ -913,7 +1244,7 @@ class BlinkPresenceContact(BlinkContact):
         if not changes:
             return False
 
-        self.handle_pidfs(log)
+        self.pidfs_generation += 1
         return True
 
     def handle_pidfs(self, log=False):
@@ -925,184 +1256,35 @@ class BlinkPresenceContact(BlinkContact):
             # as a result of pidfs changes we may go offline and some GUI contacts are destroyed
             return
 
-        basic_status = 'closed'
-        self.init_presence_state()
-        has_notes = 0
-
-        devices = {}
-        urls = []
-        if self.pidfs:
-            for pidf in self.pidfs:
-                aor = str(urllib.unquote(pidf.entity))
-                if not aor.startswith(('sip:', 'sips:')):
-                    aor = 'sip:'+aor
-                # make a list of latest services
-                most_recent_service_timestamp = None
-                most_recent_service = None
-                most_recent_services = []
-                for service in pidf.services:
-                    if hasattr(service, 'timestamp') and service.timestamp is not None:
-                        if most_recent_service_timestamp is None:
-                            # add service
-                            most_recent_service_timestamp = service.timestamp.value
-                            most_recent_service = service
-                        elif service.timestamp.value >= most_recent_service_timestamp:
-                            if service.user_input is not None and service.user_input.value == 'idle':
-                                # replace older idle with newer
-                                if most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
-                                    most_recent_service_timestamp = service.timestamp.value
-                                    most_recent_service = service
-                            else:
-                                # replace idle with non-idle
-                                if service.status.basic == 'open':
-                                    most_recent_service_timestamp = service.timestamp.value
-                                    most_recent_service = service
-                        elif service.timestamp.value < most_recent_service_timestamp:
-                            # replace newer idle with older non-idle
-                            if service.user_input is not None and service.user_input.value != 'idle' and most_recent_service.user_input is not None and most_recent_service.user_input.value == 'idle':
-                                most_recent_service_timestamp = service.timestamp.value
-                                most_recent_service = service
-                    else:
-                        # services without timestamp will be weighted later
-                        most_recent_services.append(service)
-
-                if most_recent_service is not None:
-                    most_recent_services.append(most_recent_service)
-
-                if basic_status is 'closed':
-                    basic_status = 'open' if any(service for service in pidf.services if service in most_recent_services and service.status.basic == 'open') else 'closed'
-
-                _busy = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'busy')
-                if self.presence_state['status']['busy'] is False:
-                    self.presence_state['status']['busy'] = _busy
-
-                _available = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'available' or (service.status.extended == None and basic_status == 'open'))
-                if self.presence_state['status']['available'] is False:
-                    self.presence_state['status']['available'] = _available
-
-                _away = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'away')
-                if self.presence_state['status']['away'] is False:
-                    self.presence_state['status']['away'] = _away
-
-                _offline = any(service for service in pidf.services if service in most_recent_services and service.status.extended == 'offline')
-                if self.presence_state['status']['offline'] is False:
-                    self.presence_state['status']['offline'] = _offline
-
-                if _busy:
-                    device_wining_status = 'busy'
-                elif _available:
-                    device_wining_status = 'available'
-                elif _away:
-                    device_wining_status = 'away'
-                else:
-                    device_wining_status = 'offline'
-
-                _presence_open_notes = sorted([unicode(note) for service in pidf.services if service in most_recent_services and service.status.basic == 'open' for note in service.notes if note])
-                _presence_closed_notes = sorted([unicode(note) for service in pidf.services if service in most_recent_services and service.status.basic == 'closed' for note in service.notes if note])
-
-                _presence_notes =  _presence_closed_notes if device_wining_status == 'offline' else _presence_open_notes
-
-                has_notes += len(_presence_notes)
-
-                for service in pidf.services:
-                    if service.homepage is not None and service.homepage.value:
-                        urls.append(service.homepage.value)
-                    uri_text = sip_prefix_pattern.sub('', aor)
-
-                    caps = set()
-                    if service.capabilities is not None:
-                        if service.capabilities.audio:
-                            caps.add("audio")
-                        if service.capabilities.message:
-                            caps.add("chat")
-                        if service.capabilities.file_transfer:
-                            caps.add("file-transfer")
-                        if service.capabilities.screen_sharing_server:
-                            caps.add("screen-sharing-server")
-                        if service.capabilities.screen_sharing_client:
-                            caps.add("screen-sharing-client")
-
-                    contact = urllib.unquote(service.contact.value) if service.contact is not None else aor
-                    if not contact.startswith(('sip:', 'sips:')):
-                        contact = 'sip:'+contact
-
-                    if service in most_recent_services and service.icon is not None:
-                        icon = unicode(service.icon)
-                    else:
-                        icon = None
-
-                    if service.device_info is not None:
-                        if service.device_info.time_offset is not None:
-                            ctime = datetime.datetime.utcnow() + datetime.timedelta(minutes=int(service.device_info.time_offset))
-                            time_offset = int(service.device_info.time_offset)/60.0
-                            if time_offset == int(time_offset):
-                                offset_info = '(UTC+%d%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
-                            else:
-                                offset_info = '(UTC+%.1f%s)' % (time_offset, (service.device_info.time_offset.description is not None and (' (%s)' % service.device_info.time_offset.description) or ''))
-                            offset_info_text = "%s %s" % (ctime.strftime("%H:%M"), offset_info)
-                        else:
-                            offset_info = None
-                            offset_info_text = None
-                        if service.status.extended is not None:
-                            device_wining_status = str(service.status.extended)
-                        device_text = '%s running %s' % (service.device_info.description, service.device_info.user_agent) if service.device_info.user_agent else service.device_info.description
-                        description = service.device_info.description
-                        user_agent = service.device_info.user_agent
-
-                    else:
-                        device_text = '%s' % service.id
-                        description = None
-                        user_agent = None
-                        offset_info = None
-                        offset_info_text = None
-
-                    try:
-                        device = devices[service.id]
-                    except KeyError:
-                        devices[service.id] = {
-                            'id'          : service.id,
-                            'description' : description,
-                            'user_agent'  : user_agent,
-                            'contact'     : contact,
-                            'location'    : service.map.value if service.map is not None else None,
-                            'local_time'  : offset_info_text,
-                            'time_offset' : offset_info,
-                            'notes'       : _presence_notes,
-                            'status'      : device_wining_status,
-                            'caps'        : caps,
-                            'icon'        : icon,
-                            'aor'         : [aor],
-                            'timestamp'   : service.timestamp if hasattr(service, 'timestamp') and service.timestamp is not None else None
-                            }
-                    else:
-                        device['aor'].append(aor)
-
-                    if self.log_presence_transitions and service in most_recent_services:
-                        something_has_changed = False
-                        try:
-                            old_device = (device for device in self.old_devices if device['id'] == service.id).next()
-                        except StopIteration:
-                            something_has_changed = True
-                            pass
-                        else:
-                            if old_device['status'] != device_wining_status or old_device['notes'] != _presence_notes:
-                                something_has_changed = True
-
-                        if something_has_changed and service.id and log:
-                            if self.old_presence_status is None and device_wining_status == 'offline':
-                                pass
-                            else:
-                                log_line = u"Availability of device %s of %s (%s) is %s" % (device_text, self.name, uri_text, device_wining_status)
-                                BlinkLogger().log_debug(log_line)
+        self.pidfs_generation += 1
+        self.apply_presence_snapshot(aggregate_presence(self.pidfs), log)
 
-            self.presence_state['devices'] = devices
-            self.presence_state['urls'] = urls
+    def apply_presence_snapshot(self, snapshot, log=False):
+        # log should be True when updating contacts in all contacts group to avoid duplicates
+        if self.application_will_end or not self.contact:
+            return
 
-            if self.log_presence_transitions:
-                self.old_devices = self.presence_state['devices'].values()
+        self.init_presence_state()
+        for status in ('available', 'away', 'busy', 'offline'):
+            self.presence_state['status'][status] = getattr(snapshot, status)
+        self.presence_state['devices'] = dict((device.id, dict(device._asdict())) for device in snapshot.devices)
+        self.presence_state['urls'] = list(snapshot.urls)
+
+        if self.log_presence_transitions:
+            if log:
+                old_devices = dict((device['id'], device) for device in self.old_devices)
+                for device_id, device_text, uri_text, device_wining_status, _presence_notes in snapshot.transitions:
+                    old_device = old_devices.get(device_id)
+                    if old_device is not None and old_device['status'] == device_wining_status and old_device['notes'] == _presence_notes:
+                        continue
+                    if not device_id or (self.old_presence_status is None and device_wining_status == 'offline'):
+                        continue
+                    log_line = u"Availability of device %s of %s (%s) is %s" % (device_text, self.name, uri_text, device_wining_status)
+                    BlinkLogger().log_debug(log_line)
+            self.old_devices = self.presence_state['devices'].values()
 
         self.setPresenceNote()
-        has_notes = has_notes > 1 or self.presence_state['pending_authorizations']
+        has_notes = snapshot.notes_count > 1 or self.presence_state['pending_authorizations']
         if has_notes:
             if self.timer is not None and self.timer.isValid():
                 self.timer.invalidate()
@@ -1113,19 +1295,8 @@ class BlinkPresenceContact(BlinkContact):
             self.timer.invalidate()
             self.timer = None
 
-        # Get the winning icon
         if not self.contact.icon_info.local:
-            available_devices = (dev for dev in devices.itervalues() if dev['status'] == 'available' and dev['icon'] is not None)
-            offline_devices = (dev for dev in devices.itervalues() if dev['status'] == 'offline' and dev['icon'] is not None)
-            away_devices = (dev for dev in devices.itervalues() if dev['status'] == 'away' and dev['icon'] is not None)
-            busy_devices = (dev for dev in devices.itervalues() if dev['status'] == 'busy' and dev['icon'] is not None)
-            try:
-                wining_dev = next(chain(busy_devices, available_devices, away_devices, offline_devices))
-            except StopIteration:
-                wining_icon = None
-            else:
-                wining_icon = wining_dev['icon']
-            self._process_icon(wining_icon)
+            AvatarFetcher().fetch(self.contact, snapshot.icon)
 
         if self.presence_state['status']['busy']:
             status = 'busy'
@@ -1197,70 +1368,6 @@ class BlinkPresenceContact(BlinkContact):
         if log:
             NotificationCenter().post_notification("BlinkContactPresenceHasChanged", sender=self)
 
-    @allocate_autorelease_pool
-    @run_in_green_thread
-    def _process_icon(self, icon_url):
-        contact = self.contact
-        if not contact:
-            # Contact may have been destroyed before this function runs
-            return
-
-        # TODO: naive attempt for not downloading the same icon multiple times, contacts should
-        # not listen for this notification in the first place
-        if getattr(contact, 'updating_remote_icon', False):
-            return
-        contact.updating_remote_icon = True
-
-        if not icon_url:
-            # Don't remove icon, keep last used one around
-            contact.updating_remote_icon = False
-            return
-
-        url, token, icon_hash = icon_url.partition('blink-icon')
-        if token:
-            # Fast path
-            if contact.icon_info and contact.icon_info.etag == icon_hash:
-                contact.updating_remote_icon = False
-                return
-        # Need to download
-        headers = {'If-None-Match': contact.icon_info.etag} if contact.icon_info.etag else {}
-        req = urllib2.Request(icon_url, headers=headers)
-        try:
-            response = urllib2.urlopen(req)
-            content = response.read()
-            info = response.info()
-            content_type = info.getheader('content-type')
-            etag = info.getheader('etag')
-        except (ConnectionLost, urllib2.HTTPError, urllib2.URLError):
-            contact.updating_remote_icon = False
-            return
-        else:
-            if etag.startswith('W/'):
-                etag = etag[2:]
-            etag = etag.replace('\"', '')
-        if content_type == prescontent.PresenceContentDocument.content_type:
-            try:
-                pres_content = prescontent.PresenceContentDocument.parse(content)
-                content = base64.decodestring(pres_content.data.value)
-            except Exception:
-                contact.updating_remote_icon = False
-                return
-
-        # Check if the icon can be loaded in a NSImage
-        try:
-            icon = NSImage.alloc().initWithData_(NSData.alloc().initWithBytes_length_(content, len(content)))
-        except Exception:
-            contact.updating_remote_icon = False
-            return
-        del icon
-
-        with open(PresenceContactAvatar.path_for_contact(contact), 'w') as f:
-            f.write(content)
-        contact.icon_info.url = icon_url
-        contact.icon_info.etag = etag
-        contact.save()
-        contact.updating_remote_icon = False
-
     def addToOrRemoveFromOnlineGroup(self):
         status = presence_status_for_contact(self)
         model = NSApp.delegate().contactsWindowController.model
@@ -1759,6 +1866,7 @@ class HistoryBlinkGroup(VirtualBlinkGroup):
     remove_contact_allowed = False
     delete_contact_allowed = False
     last_results = []
+    history_limit = 100
 
     def __init__(self, name, expanded=False):
         super(HistoryBlinkGroup, self).__init__(name, expanded)
@@ -1776,21 +1884,33 @@ class HistoryBlinkGroup(VirtualBlinkGroup):
 
     def setInitialPeriod(self, days):
         self.days = days
-        after_date=datetime.datetime.now()-datetime.timedelta(days=days)
-        self.after_date=after_date.strftime("%Y-%m-%d")
+        self.update_after_date()
 
     def setPeriod_(self, days):
         self.days = days
-        after_date=datetime.datetime.now()-datetime.timedelta(days=days)
-        self.after_date=after_date.strftime("%Y-%m-%d")
+        self.update_after_date()
         results = self.get_history_entries()
+        self.last_results = results
         self.refresh_contacts(results)
 
+    def update_after_date(self):
+        # the period covers the last days, its start moves on as days pass
+        after_date=datetime.datetime.now()-datetime.timedelta(days=self.days)
+        self.after_date=after_date.strftime("%Y-%m-%d")
+
     @run_in_green_thread
-    def load_history(self, force_reload=False):
+    def load_history(self, force_reload=False, incremental=False):
         if self.days is None:
             return
-        results = self.get_history_entries()
+        self.update_after_date()
+        if incremental and self.last_results:
+            # only fetch the sessions added since the last refresh and merge them with the previous
+            # results, dropping the ones which are now older than the period
+            new_results = self.get_history_entries(after_id=max(result.id for result in self.last_results))
+            after_date = datetime.datetime.strptime(self.after_date, "%Y-%m-%d")
+            results = sorted((result for result in chain(new_results, self.last_results) if result.start_time >= after_date), key=lambda result: result.start_time, reverse=True)[:self.history_limit]
+        else:
+            results = self.get_history_entries()
         if self.last_results != results or force_reload:
             self.last_results = results
             self.refresh_contacts(results)
@@ -1798,9 +1918,11 @@ class HistoryBlinkGroup(VirtualBlinkGroup):
     @allocate_autorelease_pool
     @run_in_green_thread
     def refresh_contacts(self, results):
-        for blink_contact in list(self.contacts):
-            self.contacts.remove(blink_contact)
-            blink_contact.destroy()
+        # existing contacts are reused, only contacts for new remote parties are created here, the
+        # contacts shown are only changed in the GUI thread by apply_contacts
+        previous_contacts = list(self.contacts)
+        existing_contacts = dict(((blink_contact.contact if blink_contact.contact is not None else blink_contact.uri), blink_contact) for blink_contact in previous_contacts)
+        updates = {}
         seen = {}
         contacts = []
         settings = SIPSimpleSettings()
@@ -1870,55 +1992,95 @@ class HistoryBlinkGroup(VirtualBlinkGroup):
                 else:
                     icon = None
                 name = NSLocalizedString("Anonymous", "Contact detail") if is_anonymous(target_uri) else name
-                blink_contact = HistoryBlinkContact(result.remote_uri, icon=icon, name=name)
-                blink_contact.answering_machine_filenames = set()
+                blink_contact = existing_contacts.pop(k, None)
+                if blink_contact is None or blink_contact.uri != result.remote_uri:
+                    if blink_contact is not None:
+                        existing_contacts[k] = blink_contact
+                    blink_contact = HistoryBlinkContact(result.remote_uri, icon=icon, name=name)
+                answering_machine_filenames = set()
                 if len(result.am_filename):
-                    blink_contact.answering_machine_filenames.add(result.am_filename)
+                    answering_machine_filenames.add(result.am_filename)
+                detail = blink_contact.detail
                 if self.type == "missed":
-                    blink_contact.detail = NSLocalizedString("Missed call", "Contact detail") + " " + format_date(utc_to_local(result.start_time))
+                    detail = NSLocalizedString("Missed call", "Contact detail") + " " + format_date(utc_to_local(result.start_time))
                 elif self.type == "incoming":
-                    blink_contact.detail = NSLocalizedString("Incoming call", "Contact detail")  + " " + format_date(utc_to_local(result.start_time))
+                    detail = NSLocalizedString("Incoming call", "Contact detail")  + " " + format_date(utc_to_local(result.start_time))
                 elif self.type == "outgoing":
-                    blink_contact.detail = NSLocalizedString("Outgoing call", "Contact detail") + " " + format_date(utc_to_local(result.start_time))
-                blink_contact.contact = contact
+                    detail = NSLocalizedString("Outgoing call", "Contact detail") + " " + format_date(utc_to_local(result.start_time))
+                updates[blink_contact] = dict(name=name, icon=icon, detail=detail, contact=contact, answering_machine_filenames=answering_machine_filenames)
                 contacts.append(blink_contact)
 
         for blink_contact in contacts:
-            k = blink_contact.contact if blink_contact.contact is not None else blink_contact.uri
+            update = updates[blink_contact]
+            k = update['contact'] if update['contact'] is not None else blink_contact.uri
             try:
-                blink_contact.session_ids = session_ids[k]
+                update['session_ids'] = session_ids[k]
             except KeyError:
                 pass
             try:
                 if seen[k] > 1:
                     if seen[k] - 2:
-                        new_detail = blink_contact.detail + NSLocalizedString(" and %d other times", "Label") % seen[k]
+                        update['detail'] += NSLocalizedString(" and %d other times", "Label") % seen[k]
                     else:
-                        new_detail = blink_contact.detail + NSLocalizedString(" and one other time", "Label")
-                    blink_contact.detail = new_detail
-
+                        update['detail'] += NSLocalizedString(" and one other time", "Label")
             except KeyError:
                 pass
 
-            if len(blink_contact.answering_machine_filenames):
+            if len(update['answering_machine_filenames']):
                 v1 = NSLocalizedString("Voice Message", "Contact detail")
                 v2 = NSLocalizedString("Voice Messages", "Contact detail")
-                new_detail = blink_contact.detail + u' (%d %s)' % (len(blink_contact.answering_machine_filenames), (v2 if len(blink_contact.answering_machine_filenames) > 1 else v1))
-                blink_contact.detail = new_detail
+                update['detail'] += u' (%d %s)' % (len(update['answering_machine_filenames']), (v2 if len(update['answering_machine_filenames']) > 1 else v1))
 
-            self.contacts.append(blink_contact)
+        self.apply_contacts(previous_contacts, contacts, updates)
 
-        NotificationCenter().post_notification("BlinkContactsHaveChanged", sender=self)
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def apply_contacts(self, previous_contacts, contacts, updates):
+        if self.contacts != previous_contacts:
+            # another refresh was applied meanwhile, the contacts created for this one are not used
+            for blink_contact in contacts:
+                if blink_contact not in previous_contacts:
+                    blink_contact.destroy()
+            self.refresh_contacts(self.last_results)
+            return
+
+        changed = []
+        for blink_contact in contacts:
+            update = updates[blink_contact]
+            if blink_contact.name != update['name'] or unicode(blink_contact.detail) != unicode(update['detail']):
+                changed.append(blink_contact)
+            blink_contact.name = update['name']
+            blink_contact.detail = update['detail']
+            if update['icon'] is not None and blink_contact.avatar.icon is not update['icon']:
+                blink_contact.avatar = Avatar(update['icon'])
+                if blink_contact not in changed:
+                    changed.append(blink_contact)
+            blink_contact.contact = update['contact']
+            blink_contact.answering_machine_filenames = update['answering_machine_filenames']
+            if 'session_ids' in update:
+                blink_contact.session_ids = update['session_ids']
+
+        reload = contacts != self.contacts
+        removed = [blink_contact for blink_contact in self.contacts if blink_contact not in contacts]
+        if reload:
+            self.contacts[:] = contacts
+        # the contacts which are no longer shown are only destroyed once the outline no longer refers to them
+        for blink_contact in removed:
+            blink_contact.destroy()
+
+        if reload or changed:
+            NotificationCenter().post_notification("BlinkGroupContactsHaveChanged", sender=self, data=NotificationData(contacts=changed, reload=reload))
 
 
 class MissedCallsBlinkGroup(HistoryBlinkGroup):
     type = 'missed'
+    history_limit = 200
 
     def __init__(self, name=NSLocalizedString("Missed Calls", "Group name label")):
         super(MissedCallsBlinkGroup, self).__init__(name, expanded=True)
 
-    def get_history_entries(self):
-        return SessionHistory().get_entries(hidden=0, after_date=self.after_date, count=200)
+    def get_history_entries(self, after_id=None):
+        return SessionHistory().get_entries(hidden=0, after_date=self.after_date, after_id=after_id, count=self.history_limit)
 
 
 class OutgoingCallsBlinkGroup(HistoryBlinkGroup):
@@ -1927,8 +2089,8 @@ class OutgoingCallsBlinkGroup(HistoryBlinkGroup):
     def __init__(self, name=NSLocalizedString("Outgoing Calls", "Group name label")):
         super(OutgoingCallsBlinkGroup, self).__init__(name, expanded=True)
 
-    def get_history_entries(self):
-        return SessionHistory().get_entries(direction='outgoing', remote_focus="0", hidden=0, after_date=self.after_date, count=100)
+    def get_history_entries(self, after_id=None):
+        return SessionHistory().get_entries(direction='outgoing', remote_focus="0", hidden=0, after_date=self.after_date, after_id=after_id, count=self.history_limit)
 
 
 class IncomingCallsBlinkGroup(HistoryBlinkGroup):
@@ -1937,8 +2099,8 @@ class IncomingCallsBlinkGroup(HistoryBlinkGroup):
     def __init__(self, name=NSLocalizedString("Incoming Calls", "Group name label")):
         super(IncomingCallsBlinkGroup, self).__init__(name, expanded=True)
 
-    def get_history_entries(self):
-        return SessionHistory().get_entries(direction='incoming', status='completed', remote_focus="0", hidden=0, after_date=self.after_date, count=100)
+    def get_history_entries(self, after_id=None):
+        return SessionHistory().get_entries(direction='incoming', status='completed', remote_focus="0", hidden=0, after_date=self.after_date, after_id=after_id, count=self.history_limit)
 
 
 class AddressBookBlinkGroup(VirtualBlinkGroup):
@@ -2048,6 +2210,241 @@ class AddressBookBlinkGroup(VirtualBlinkGroup):
         nc.post_notification("BlinkContactsHaveChanged", sender=self)
 
 
+class ContactURIIndex(object):
+    """Index of the contacts in the contacts list by the URIs they match"""
+
+    # phone numbers match when the last digits are the same, see BlinkContact.matchesURI
+    phone_suffix_length = 8
+
+    def __init__(self):
+        # the lookups run on the GUI and green threads, the index is replaced as a whole
+        # and each lookup uses the one it got first
+        self.index = None
+
+    def invalidate(self):
+        self.index = None
+
+    def _key(self, (username, domain)):
+        # keys are unicode, sorting byte strings together with unicode ones fails
+        return tuple(value if isinstance(value, unicode) else value.decode('utf-8', 'replace') for value in (username or '', domain or ''))
+
+    def _phone_suffix(self, username):
+        username = strip_addressbook_special_characters(username).lstrip("+")
+        if len(username) < self.phone_suffix_length or any(d not in "1234567890" for d in username):
+            return None
+        return username[-self.phone_suffix_length:]
+
+    def _trigrams(self, text):
+        return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+    def build(self, groups, signature=None):
+        # entries are (group, blink_contact) pairs in the order of the contacts list
+        entries = [(group, blink_contact) for group in groups for blink_contact in group.contacts]
+        exact = {}
+        phone = {}
+        usernames = []
+        texts = {}
+        grams = {}
+        for position, (group, blink_contact) in enumerate(entries):
+            keys = set([self._key((getattr(blink_contact, 'username', None), getattr(blink_contact, 'domain', None)))])
+            keys.update(self._key(split_uri(item.uri)) for item in blink_contact.uris if item.uri)
+            for key in keys:
+                exact.setdefault(key, []).append(position)
+                usernames.append((key[0], position))
+                suffix = self._phone_suffix(key[0])
+                if suffix is not None:
+                    phone.setdefault(suffix, []).append(position)
+            # the organization, job title and note match any part of the URI, see BlinkContact.matchesURI
+            text = u'\n'.join(value.lower() for value in (getattr(blink_contact, attribute, None) for attribute in ('organization', 'job_title', 'note')) if value)
+            if text:
+                texts[position] = text
+                for gram in self._trigrams(text):
+                    grams.setdefault(gram, set()).add(position)
+        usernames.sort()
+        self.index = index = (signature, entries, exact, phone, usernames, texts, grams)
+        return index
+
+    def lookup(self, groups, uri, exact_match=False):
+        signature = [(group, len(group.contacts)) for group in groups]
+        index = self.index
+        if index is None or index[0] != signature:
+            index = self.build(groups, signature)
+        signature, entries, exact, phone, usernames, texts, grams = index
+
+        username, domain = self._key(split_uri(uri))
+        positions = set()
+        if not domain:
+            if not username:
+                positions.update(xrange(len(entries)))
+            else:
+                position = bisect.bisect_left(usernames, (username,))
+                while position < len(usernames) and usernames[position][0].startswith(username):
+                    positions.add(usernames[position][1])
+                    position += 1
+        else:
+            positions.update(exact.get((username, domain), ()))
+        if not domain or not exact_match:
+            candidate_username = username.lstrip("+").lstrip("0")
+            if len(candidate_username) > 7 and all(d in "1234567890" for d in candidate_username):
+                positions.update(phone.get(candidate_username[-self.phone_suffix_length:], ()))
+        text = unicode(uri).lower()
+        if len(text) >= 3:
+            postings = sorted((grams.get(gram, ()) for gram in self._trigrams(text)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = texts
+        positions.update(position for position in candidates if text in texts[position])
+
+        # candidates are checked again as some contacts types match URIs differently
+        return [entries[position] for position in sorted(positions) if entries[position][1].matchesURI(uri, exact_match)]
+
+
+class ContactSearchIndex(object):
+    """Trigram index of the searchable contacts by name, URIs, organization and notes"""
+
+    def __init__(self, uri_index):
+        self.valid = False
+        self.signature = None
+        self.entries = []
+        self.positions = {}
+        self.contact_positions = {}
+        self.texts = {}
+        self.grams = {}
+        # contacts whose text must be computed again, None when all of them must
+        self.changed_contacts = set()
+        # the URI index of the contacts list is shared with the model, which invalidates it
+        self.uri_index = uri_index
+        self.last_text = None
+        self.last_contacts = None
+
+    def invalidate(self, contacts=None):
+        # contacts are the ones that changed, the contacts added or removed are found by the next build
+        self.valid = False
+        if contacts is None:
+            self.changed_contacts = None
+        elif self.changed_contacts is not None:
+            self.changed_contacts.update(contacts)
+
+    def _text(self, blink_contact):
+        values = [item.uri for item in blink_contact.uris if item.uri]
+        values.append(blink_contact.name)
+        values.extend(getattr(blink_contact, attribute, None) for attribute in ('organization', 'job_title', 'note'))
+        # values are joined so that a search text, which has no new lines, cannot match across them
+        return u'\n'.join(value.lower() if isinstance(value, unicode) else value.decode('utf-8', 'replace').lower() for value in values if value)
+
+    def _trigrams(self, text):
+        return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+    def _add(self, blink_contact, text):
+        self.texts[blink_contact] = text
+        for gram in self._trigrams(text):
+            self.grams.setdefault(gram, set()).add(blink_contact)
+
+    def _remove(self, blink_contact):
+        for gram in self._trigrams(self.texts.pop(blink_contact)):
+            contacts = self.grams[gram]
+            contacts.discard(blink_contact)
+            if not contacts:
+                del self.grams[gram]
+
+    def build(self, groups):
+        self.entries = [(group, blink_contact) for group in groups for blink_contact in group.contacts]
+        self.positions = dict((entry, position) for position, entry in enumerate(self.entries))
+        self.contact_positions = {}
+        for position, (group, blink_contact) in enumerate(self.entries):
+            self.contact_positions.setdefault(blink_contact, []).append(position)
+
+        # only the contacts that were added, changed or removed since the last build update the trigrams
+        for blink_contact in [blink_contact for blink_contact in self.texts if blink_contact not in self.contact_positions]:
+            self._remove(blink_contact)
+        if self.changed_contacts is None:
+            contacts = self.contact_positions
+        else:
+            contacts = [blink_contact for blink_contact in self.contact_positions if blink_contact in self.changed_contacts or blink_contact not in self.texts]
+        for blink_contact in contacts:
+            text = self._text(blink_contact)
+            old_text = self.texts.get(blink_contact)
+            if old_text != text:
+                if old_text is not None:
+                    self._remove(blink_contact)
+                self._add(blink_contact, text)
+
+        self.changed_contacts = set()
+        self.last_text = None
+        self.last_contacts = None
+        self.valid = True
+
+    def _candidates(self, text):
+        if self.last_text is not None and self.last_text in text:
+            # the search text was extended, the results can only get fewer
+            candidates = self.last_contacts
+        else:
+            candidates = None
+        if len(text) >= 3:
+            postings = sorted((self.grams.get(gram, ()) for gram in self._trigrams(text)), key=len)
+            if candidates is None or len(postings[0]) < len(candidates):
+                candidates = set(postings[0])
+                for contacts in postings[1:]:
+                    candidates.intersection_update(contacts)
+                    if not candidates:
+                        break
+        if candidates is None:
+            candidates = self.contact_positions
+        return candidates
+
+    def search(self, groups, text, uri_groups=None):
+        # uri_groups are the groups the URI index is looked up with, which include groups not searched
+        signature = [(group, len(group.contacts)) for group in groups]
+        if not self.valid or signature != self.signature:
+            self.build(groups)
+            self.signature = signature
+
+        lower_text = text.lower()
+        contacts = set(blink_contact for blink_contact in self._candidates(lower_text) if lower_text in self.texts[blink_contact])
+        self.last_text = lower_text
+        self.last_contacts = contacts
+
+        positions = set(chain.from_iterable(self.contact_positions[blink_contact] for blink_contact in contacts))
+        # URI matches are not narrowed, phone numbers for example match by their last digits
+        positions.update(self.positions[entry] for entry in self.uri_index.lookup(uri_groups or groups, text) if entry in self.positions)
+        return [self.entries[position][1] for position in sorted(positions)]
+
+
+class ContactPresenceIndex(object):
+    """Index of the contacts subscribed to presence by the URIs presence notifications carry"""
+
+    def __init__(self):
+        self.valid = False
+        self.signature = None
+        self.contacts = {}
+
+    def invalidate(self):
+        self.valid = False
+
+    def build(self, groups):
+        self.contacts = {}
+        for group in groups:
+            for blink_contact in group.contacts:
+                if not isinstance(blink_contact, BlinkPresenceContact) or blink_contact.contact is None or not blink_contact.contact.presence.subscribe:
+                    continue
+                # notifications carry the URIs exactly as the contacts store them
+                for uri in set(item.uri for item in blink_contact.contact.uris):
+                    self.contacts.setdefault(uri, []).append((blink_contact, group))
+        self.valid = True
+
+    def lookup(self, groups, resource_map):
+        signature = [(group, len(group.contacts)) for group in groups]
+        if not self.valid or signature != self.signature:
+            self.build(groups)
+            self.signature = signature
+
+        resources = {}
+        for uri, value in resource_map.iteritems():
+            for item in self.contacts.get(uri, ()):
+                resources.setdefault(item, {})[uri] = value
+        return resources
+
+
 class CustomListModel(NSObject):
     """Contacts List Model behaviour, display and drag an drop actions"""
     groupsList = []
@@ -2475,16 +2872,30 @@ class ContactListModel(CustomListModel):
         self.outgoing_calls_group = OutgoingCallsBlinkGroup()
         self.incoming_calls_group = IncomingCallsBlinkGroup()
         self.contact_backup_timer = None
+        self.uri_index = ContactURIIndex()
+        self.search_index = ContactSearchIndex(self.uri_index)
+        self.presence_index = ContactPresenceIndex()
 
         return self
 
     @allocate_autorelease_pool
     @run_in_gui_thread
     def handle_notification(self, notification):
+        if notification.name.startswith(('Addressbook', 'Bonjour', 'BlinkContactsHaveChanged')):
+            self.uri_index.invalidate()
+            self.search_index.invalidate(self.changedContacts(notification))
+            self.presence_index.invalidate()
+            clear_identity_cache()
+        elif notification.name == 'BlinkGroupContactsHaveChanged' and notification.data.reload:
+            self.uri_index.invalidate()
+            self.presence_index.invalidate()
+            clear_identity_cache()
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
     def awakeFromNib(self):
+        self.nc.add_observer(self, name="BlinkContactsHaveChanged")
+        self.nc.add_observer(self, name="BlinkGroupContactsHaveChanged")
         self.nc.add_observer(self, name="BlinkOnlineContactMustBeRemoved")
         self.nc.add_observer(self, name="BonjourAccountDidAddNeighbour")
         self.nc.add_observer(self, name="BonjourAccountDidUpdateNeighbour")
@@ -2492,6 +2903,7 @@ class ContactListModel(CustomListModel):
         self.nc.add_observer(self, name="CFGSettingsObjectDidChange")
         self.nc.add_observer(self, name="AddressbookContactWasActivated")
         self.nc.add_observer(self, name="AddressbookContactWasDeleted")
+        self.nc.add_observer(self, name="BlinkContactAvatarWasFetched")
         self.nc.add_observer(self, name="AddressbookContactDidChange")
         self.nc.add_observer(self, name="AddressbookGroupWasCreated")
         self.nc.add_observer(self, name="AddressbookGroupWasActivated")
@@ -2533,7 +2945,23 @@ class ContactListModel(CustomListModel):
         if settings.contacts.enable_address_book:
             self.addressbook_group.loadAddressBook(notification.userInfo())
 
-    def hasContactMatchingURI(self, uri, exact_match=False):
+    def changedContacts(self, notification):
+        # returns the contacts whose searched text the notification may have changed, None if any
+        if notification.name == 'BlinkContactsHaveChanged':
+            if isinstance(notification.sender, BlinkContact):
+                return [notification.sender]
+            elif isinstance(notification.sender, BlinkGroup):
+                return notification.sender.contacts
+            return None
+        elif notification.name == 'AddressbookContactDidChange':
+            return [blink_contact for group in self.groupsList for blink_contact in group.contacts if getattr(blink_contact, 'contact', None) is notification.sender]
+        elif notification.name.startswith(('AddressbookContactWas', 'AddressbookGroup', 'AddressbookPolicy', 'Bonjour')):
+            # these add or remove contacts, which the next build finds, the changes of a contact
+            # are notified with BlinkContactsHaveChanged
+            return ()
+        return None
+
+    def getURIIndexGroupsList(self):
         # add System AB group at the end so that we find contacts there as a last resort
         groupsList = self.groupsList[:]
         try:
@@ -2542,35 +2970,37 @@ class ContactListModel(CustomListModel):
             pass
         else:
             groupsList.append(self.addressbook_group)
+        if self.all_contacts_group not in groupsList:
+            groupsList.append(self.all_contacts_group)
+        return groupsList
 
-        return any(blink_contact.matchesURI(uri, exact_match) for group in groupsList if not group.ignore_search for blink_contact in group.contacts)
+    def getContactsMatchingURI(self, uri, exact_match=False):
+        return self.uri_index.lookup(self.getURIIndexGroupsList(), uri, exact_match)
 
-    def getFirstContactMatchingURI(self, uri, exact_match=False):
-        # add System AB group at the end so that we find contacts there as a last resort
-        groupsList = self.groupsList[:]
-        try:
-            groupsList.remove(self.addressbook_group)
-        except ValueError:
-            pass
-        else:
-            groupsList.append(self.addressbook_group)
+    def searchContacts(self, text):
+        return self.search_index.search([group for group in self.groupsList if group.ignore_search is False], text, self.getURIIndexGroupsList())
 
+    def hasContactMatchingURI(self, uri, exact_match=False):
+        return any(group in self.groupsList and not group.ignore_search for group, blink_contact in self.getContactsMatchingURI(uri, exact_match))
+
+    def getFirstContactMatchingURI(self, uri, exact_match=False):
         try:
-            return (blink_contact for group in groupsList if not group.ignore_search for blink_contact in group.contacts if blink_contact.matchesURI(uri, exact_match)).next()
+            return (blink_contact for group, blink_contact in self.getContactsMatchingURI(uri, exact_match) if group in self.groupsList and not group.ignore_search).next()
         except StopIteration:
             return None
 
     def getFirstContactFromAllContactsGroupMatchingURI(self, uri, exact_match=False):
         try:
-            return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.matchesURI(uri, exact_match)).next()
+            return (blink_contact for group, blink_contact in self.getContactsMatchingURI(uri, exact_match) if group is self.all_contacts_group).next()
         except StopIteration:
             return None
 
     def getPresenceContactsMatchingURI(self, uri, exact_match=False):
-        try:
-            return list((blink_contact, group) for group in self.groupsList if group != self.online_contacts_group for blink_contact in group.contacts if isinstance(blink_contact, BlinkPresenceContact) and blink_contact.contact.presence.subscribe and blink_contact.matchesURI(uri, exact_match))
-        except StopIteration:
-            return None
+        return list((blink_contact, group) for group, blink_contact in self.getContactsMatchingURI(uri, exact_match) if group in self.groupsList and group != self.online_contacts_group and isinstance(blink_contact, BlinkPresenceContact) and blink_contact.contact.presence.subscribe)
+
+    def getPresenceContactsMatchingResources(self, resource_map):
+        # returns the resources for each (blink_contact, group) pair subscribed to any of them
+        return self.presence_index.lookup([group for group in self.groupsList if group != self.online_contacts_group], resource_map)
 
     def presencePolicyExistsForURI_(self, uri):
         uri = sip_prefix_pattern.sub('', uri)
@@ -3039,13 +3469,13 @@ class ContactListModel(CustomListModel):
         if notification.data.direction == 'incoming':
             if notification.data.missed:
                 if settings.contacts.enable_missed_calls_group:
-                    self.missed_calls_group.load_history(force_reload=True)
+                    self.missed_calls_group.load_history(incremental=True)
             else:
                 if settings.contacts.enable_incoming_calls_group:
-                    self.incoming_calls_group.load_history(force_reload=True)
+                    self.incoming_calls_group.load_history(incremental=True)
         else:
             if settings.contacts.enable_outgoing_calls_group:
-                self.outgoing_calls_group.load_history(force_reload=True)
+                self.outgoing_calls_group.load_history(incremental=True)
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
         settings = SIPSimpleSettings()
@@ -3386,6 +3816,25 @@ class ContactListModel(CustomListModel):
         self.addPendingWatchers()
         NSApp.delegate().contactsWindowController.tellMeWhenContactBecomesAvailableList.discard(contact)
 
+    def _NH_BlinkContactAvatarWasFetched(self, notification):
+        contact = notification.sender
+        if contact.icon_info.local or not any(blink_contact.contact == contact for blink_contact in self.all_contacts_group.contacts):
+            # the contact was deleted or got a local icon in the mean time
+            return
+        path = PresenceContactAvatar.path_for_contact(contact)
+        if contact.icon_info.url == notification.data.url and contact.icon_info.etag == notification.data.etag and os.path.isfile(path):
+            # the icon was not changed, the notification comes from a refresh of the contact presence
+            return
+        try:
+            shutil.copyfile(notification.data.path, path)
+        except (IOError, OSError), e:
+            BlinkLogger().log_error(u"Failed to copy icon of %s: %s" % (contact.name, e))
+            return
+        # saving the contact reloads the avatar of its blink contacts
+        contact.icon_info.url = notification.data.url
+        contact.icon_info.etag = notification.data.etag
+        contact.save()
+
     def _NH_AddressbookContactDidChange(self, notification):
         contact = notification.sender
 
@@ -3635,7 +4084,7 @@ class ContactListModel(CustomListModel):
         return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.name == name)
 
     def getBlinkContactsForURI(self, uri, exact_match=False):
-        return (blink_contact for blink_contact in self.all_contacts_group.contacts if blink_contact.matchesURI(uri, exact_match))
+        return (blink_contact for group, blink_contact in self.getContactsMatchingURI(uri, exact_match) if group is self.all_contacts_group)
 
     def getBlinkGroupsForBlinkContact(self, blink_contact):
         allowed_groups = [group for group in self.groupsList if group.add_contact_allowed]
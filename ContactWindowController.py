@@ -89,7 +89,7 @@ import sys
 import ldap
 import uuid
 
-from collections import deque
+from collections import deque, OrderedDict
 from dateutil.tz import tzlocal
 from itertools import chain
 
@@ -124,7 +124,7 @@ from BlinkLogger import BlinkLogger
 from HistoryManager import SessionHistory
 from HistoryViewer import HistoryViewer
 from ContactCell import ContactCell
-from ContactListModel import presence_status_for_contact, BlinkContact, BlinkBlockedPresenceContact, BonjourBlinkContact, BlinkConferenceContact, BlinkPresenceContact, BlinkGroup, AllContactsBlinkGroup, BlinkPendingWatcher, LdapSearchResultContact, HistoryBlinkContact, SearchResultContact, SystemAddressBookBlinkContact, Avatar, DefaultUserAvatar, DefaultMultiUserAvatar, ICON_SIZE, HistoryBlinkGroup, MissedCallsBlinkGroup, IncomingCallsBlinkGroup, OutgoingCallsBlinkGroup, OnlineGroup
+from ContactListModel import aggregate_presence, presence_status_for_contact, BlinkContact, BlinkBlockedPresenceContact, BonjourBlinkContact, BlinkConferenceContact, BlinkPresenceContact, BlinkGroup, AllContactsBlinkGroup, BlinkPendingWatcher, LdapSearchResultContact, HistoryBlinkContact, SearchResultContact, SystemAddressBookBlinkContact, Avatar, DefaultUserAvatar, DefaultMultiUserAvatar, ICON_SIZE, HistoryBlinkGroup, MissedCallsBlinkGroup, IncomingCallsBlinkGroup, OutgoingCallsBlinkGroup, OnlineGroup
 from DebugWindow import DebugWindow
 from EnrollmentController import EnrollmentController
 from FileTransferWindowController import openFileTransferSelectionDialog, FileTransferWindowController
@@ -387,6 +387,7 @@ class ContactWindowController(NSWindowController):
         nc.add_observer(self, name="BlinkVideoWindowClosed")
         nc.add_observer(self, name="BlinkConferenceGotUpdate")
         nc.add_observer(self, name="BlinkContactsHaveChanged")
+        nc.add_observer(self, name="BlinkGroupContactsHaveChanged")
         nc.add_observer(self, name="BlinkMuteChangedState")
         nc.add_observer(self, name="BlinkShouldTerminate")
         nc.add_observer(self, name="BlinkSessionChangedState")
@@ -1121,42 +1122,50 @@ class ContactWindowController(NSWindowController):
         resource_map = notification.data.resource_map
         BlinkLogger().log_debug('Account %s got availability %s for %d SIP URIs: %s' % (notification.sender.id, 'full state' if notification.data.full_state else 'update', len(resource_map.keys()), resource_map.keys()))
 
-        blink_contacts_set = set()
-        for key, value in resource_map.iteritems():
-            m = self.model.getPresenceContactsMatchingURI(key, exact_match=True)
-            if m is None:
-                continue
-
-            for b in m:
-                blink_contacts_set.add(b)
+        blink_contacts_resources = self.model.getPresenceContactsMatchingResources(resource_map)
 
-        changed_blink_contacts = []
-        for blink_contact, group in blink_contacts_set:
-            if blink_contact.contact is None:
-                continue
-            contact_uris = list(uri.uri for uri in iter(blink_contact.contact.uris))
-            resources = dict((key, value) for key, value in resource_map.iteritems() if key in contact_uris)
-            if resources:
-                changed = blink_contact.handle_presence_resources(resources, notification.sender.id, notification.data.full_state, log=isinstance(group, AllContactsBlinkGroup))
-
-                if changed:
-                    BlinkLogger().log_debug('Availability for %s in group %s has changed' % (blink_contact.name, group.name))
-                    changed_blink_contacts.append((blink_contact,group))
-            else:
-                BlinkLogger().log_debug('%s in group %s has not resources in PIDF' % (blink_contact.name, group.name))
+        # the PIDFs are aggregated once for all the groups of a contact, away from the GUI thread
+        changed_contacts = OrderedDict()
+        for (blink_contact, group), resources in blink_contacts_resources.iteritems():
+            changed = blink_contact.update_presence_resources(resources, notification.sender.id, notification.data.full_state, log=isinstance(group, AllContactsBlinkGroup))
 
-        for blink_contact, group in changed_blink_contacts:
-            self.contactOutline.reloadItem_reloadChildren_(blink_contact, False)
-            if isinstance(group, AllContactsBlinkGroup):
-                online_group_changed = blink_contact.addToOrRemoveFromOnlineGroup()
-                if online_group_changed:
-                    self.contactOutline.reloadItem_reloadChildren_(online_group_changed, True)
+            if changed:
+                BlinkLogger().log_debug('Availability for %s in group %s has changed' % (blink_contact.name, group.name))
+                pidfs = frozenset(blink_contact.pidfs)
+                changed_contacts.setdefault((blink_contact.contact, pidfs), []).append((blink_contact, group, blink_contact.pidfs_generation))
 
-        if changed_blink_contacts:
-            BlinkLogger().log_debug("Availability for %d out of %d contacts have been updated" % (len(changed_blink_contacts), len(blink_contacts_set)))
+        if changed_contacts:
+            BlinkLogger().log_debug("Availability for %d out of %d contacts has changed" % (sum(len(items) for items in changed_contacts.itervalues()), len(blink_contacts_resources)))
+            self.aggregatePresence([(pidfs, items) for (contact, pidfs), items in changed_contacts.iteritems()])
         else:
             BlinkLogger().log_debug("No Availability has changed")
 
+    @run_in_thread('presence-aggregation')
+    def aggregatePresence(self, changed_contacts):
+        snapshots = []
+        for pidfs, items in changed_contacts:
+            try:
+                snapshot = aggregate_presence(pidfs)
+            except Exception, e:
+                BlinkLogger().log_error(u"Failed to aggregate availability: %s" % e)
+            else:
+                snapshots.append((snapshot, items))
+        self.applyPresenceSnapshots(snapshots)
+
+    @allocate_autorelease_pool
+    @run_in_gui_thread
+    def applyPresenceSnapshots(self, snapshots):
+        for snapshot, items in snapshots:
+            for blink_contact, group, generation in items:
+                if blink_contact.contact is None or blink_contact.pidfs_generation != generation:
+                    # the contact was destroyed or its PIDFs changed again in the mean time
+                    continue
+                blink_contact.apply_presence_snapshot(snapshot, log=isinstance(group, AllContactsBlinkGroup))
+                self.contactOutline.reloadItem_reloadChildren_(blink_contact, False)
+                if isinstance(group, AllContactsBlinkGroup):
+                    online_group_changed = blink_contact.addToOrRemoveFromOnlineGroup()
+                    if online_group_changed:
+                        self.contactOutline.reloadItem_reloadChildren_(online_group_changed, True)
 
     def _NH_AddressbookGroupWasActivated(self, notification):
         self.updateGroupMenu()
@@ -1342,6 +1351,7 @@ class ContactWindowController(NSWindowController):
 
     def _NH_BlinkShouldTerminate(self, notification):
         NotificationCenter().remove_observer(self, name="BlinkContactsHaveChanged")
+        NotificationCenter().remove_observer(self, name="BlinkGroupContactsHaveChanged")
         self.model.groupsList = []
         self.refreshContactsList()
         self.window().orderOut_(self)
@@ -1364,6 +1374,14 @@ class ContactWindowController(NSWindowController):
         self.refreshContactsList(notification.sender)
         self.searchContacts()
 
+    def _NH_BlinkGroupContactsHaveChanged(self, notification):
+        # only the rows of the group which changed are reloaded, the group is not searched
+        if notification.data.reload:
+            self.contactOutline.reloadItem_reloadChildren_(notification.sender, True)
+        else:
+            for blink_contact in notification.data.contacts:
+                self.contactOutline.reloadItem_reloadChildren_(blink_contact, False)
+
     def _NH_BlinkSessionChangedState(self, notification):
         self.toggleOnThePhonePresenceActivity()
 
@@ -2233,17 +2251,13 @@ class ContactWindowController(NSWindowController):
 
         if self.mainTabView.selectedTabViewItem().identifier() == "search":
             self.local_found_contacts = []
-            local_found_contacts = [contact for group in self.model.groupsList if group.ignore_search is False for contact in group.contacts if (text in contact or contact.matchesURI(text))]
-            found_count = {}
-            for local_found_contact in local_found_contacts:
-                if hasattr(local_found_contact, 'contact') and local_found_contact.contact is not None:
-                    if local_found_contact.contact.id in found_count.keys():
+            found_ids = set()
+            for local_found_contact in self.model.searchContacts(text):
+                if getattr(local_found_contact, 'contact', None) is not None:
+                    if local_found_contact.contact.id in found_ids:
                         continue
-                    else:
-                        self.local_found_contacts.append(local_found_contact)
-                        found_count[local_found_contact.contact.id] = True
-                else:
-                    self.local_found_contacts.append(local_found_contact)
+                    found_ids.add(local_found_contact.contact.id)
+                self.local_found_contacts.append(local_found_contact)
 
             active_account = self.activeAccount()
             if active_account:
@@ -14,10 +14,14 @@ from Foundation import (NSAttributedString,
                         NSMutableAttributedString,
                         NSNotificationCenter,
                         NSObject,
-                        NSString
+                        NSRunLoop,
+                        NSRunLoopCommonModes,
+                        NSString,
+                        NSTimer
                         )
 import objc
 
+from collections import deque
 from datetime import datetime
 
 from application.notification import NotificationCenter, IObserver
@@ -57,6 +61,9 @@ Disabled = Disabled()
 Simplified = Simplified()
 Full = Full()
 
+# traces are appended to the text views in batches
+TRACE_FLUSH_INTERVAL = 0.25
+
 
 class DebugWindow(NSObject):
     implements(IObserver)
@@ -103,8 +110,14 @@ class DebugWindow(NSObject):
     notificationsCheckBox = objc.IBOutlet()
     pjsipCheckBox = objc.IBOutlet()
 
-    notifications = []
-    notifications_unfiltered = []
+    notifications = ()
+    notifications_unfiltered = ()
+    notifications_filter = u''
+    pending_notifications = ()
+
+    pending_traces = None
+    trace_lengths = None
+    flush_timer = None
 
     lastSIPMessageWasDNS = False
 
@@ -139,6 +152,12 @@ class DebugWindow(NSObject):
 
         NSBundle.loadNibNamed_owner_("DebugWindow", self)
 
+        self.pending_traces = {}
+        self.trace_lengths = {}
+        self.notifications_unfiltered = deque(maxlen=self.buffer_size)
+        self.notifications = self.notifications_unfiltered
+        self.pending_notifications = []
+
         for textView in [self.activityTextView, self.sipTextView, self.rtpTextView, self.msrpTextView, self.xcapTextView, self.pjsipTextView]:
             textView.setString_("")
 
@@ -284,26 +303,27 @@ class DebugWindow(NSObject):
     @objc.IBAction
     def clearClicked_(self, sender):
         if sender.tag() == 100:
-            self.activityTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.activityTextView.textStorage().length()))
+            self.clear_text(self.activityTextView)
         elif sender.tag() == 101:
-            self.sipTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.sipTextView.textStorage().length()))
+            self.clear_text(self.sipTextView)
             self.sipInCount = 0
             self.sipOutCount = 0
             self.sipBytes = 0
             self.sipInfoLabel.setStringValue_('')
         elif sender.tag() == 102:
-            self.rtpTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.rtpTextView.textStorage().length()))
+            self.clear_text(self.rtpTextView)
         elif sender.tag() == 104:
             self.msrpInCount = 0
             self.msrpOutCount = 0
             self.msrpBytes = 0
             self.msrpInfoLabel.setStringValue_('')
-            self.msrpTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.msrpTextView.textStorage().length()))
+            self.clear_text(self.msrpTextView)
         elif sender.tag() == 105:
-            self.xcapTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.xcapTextView.textStorage().length()))
+            self.clear_text(self.xcapTextView)
         elif sender.tag() == 103:
-            self.notifications = []
-            self.notifications_unfiltered = []
+            self.notifications_unfiltered = deque(maxlen=self.buffer_size)
+            self.filterNotifications()
+            self.pending_notifications = []
             self.notificationsBytes = 0
             self.notificationsTextView.reloadData()
             self.notificationsInfoLabel.setStringValue_('')
@@ -311,20 +331,54 @@ class DebugWindow(NSObject):
             self.pjsipCount = 0
             self.pjsipBytes = 0
             self.pjsipInfoLabel.setStringValue_('')
-            self.pjsipTextView.textStorage().deleteCharactersInRange_(NSMakeRange(0, self.pjsipTextView.textStorage().length()))
+            self.clear_text(self.pjsipTextView)
 
     @objc.IBAction
     def searchNotifications_(self, sender):
-        self.renderNotifications()
-
-    def renderNotifications(self):
-        text = unicode(self.filterNotificationsSearchBox.stringValue().strip().lower())
-        self.notifications = [notification for notification in self.notifications_unfiltered if text in notification[0].lower()] if text else self.notifications_unfiltered
-        self.notificationsTextView.noteNumberOfRowsChanged()
+        self.notifications_filter = unicode(self.filterNotificationsSearchBox.stringValue().strip().lower())
+        self.filterNotifications()
+        self.notificationsTextView.reloadData()
+        self.renderNotifications(self.buffer_size)
+
+    def filterNotifications(self):
+        text = self.notifications_filter
+        self.notifications = deque((notification for notification in self.notifications_unfiltered if text in notification[0].lower()), maxlen=self.notifications_unfiltered.maxlen) if text else self.notifications_unfiltered
+
+    def renderNotifications(self, buffer_size):
+        text = self.notifications_filter
+        removed_rows = False
+        if self.notifications_unfiltered.maxlen != buffer_size:
+            self.notifications_unfiltered = deque(self.notifications_unfiltered, maxlen=buffer_size)
+            self.filterNotifications()
+            removed_rows = True
+
+        # only the new notifications are checked against the filter
+        pending_notifications, self.pending_notifications = self.pending_notifications, []
+        for notification in pending_notifications:
+            if buffer_size is not None and len(self.notifications_unfiltered) == buffer_size:
+                # the oldest notification is dropped by the append below
+                oldest = self.notifications_unfiltered[0]
+                if not text:
+                    removed_rows = True
+                elif self.notifications and self.notifications[0] is oldest:
+                    self.notifications.popleft()
+                    removed_rows = True
+            self.notifications_unfiltered.append(notification)
+            if text and text in notification[0].lower():
+                self.notifications.append(notification)
+
+        if removed_rows:
+            self.notificationsTextView.reloadData()
+        else:
+            self.notificationsTextView.noteNumberOfRowsChanged()
         self.notificationsTextView.scrollRowToVisible_(len(self.notifications)-1)
         self.notificationsInfoLabel.setStringValue_('%d notifications, %sytes' % (len(self.notifications), format_size(self.notificationsBytes)) if not text else '%d notifications matched' % len(self.notifications))
 
     def dealloc(self):
+        if self.flush_timer is not None:
+            self.flush_timer.invalidate()
+            self.flush_timer = None
+
         # Observers added in init
         NSNotificationCenter.defaultCenter().removeObserver_(self)
         notification_center = NotificationCenter()
@@ -350,18 +404,64 @@ class DebugWindow(NSObject):
 
         super(DebugWindow, self).dealloc()
 
+    @property
+    def buffer_size(self):
+        # 0 keeps everything
+        return SIPSimpleSettings().logs.trace_in_gui_buffer_size or None
+
+    def append_text(self, textView, text):
+        # text is rendered by flushTraces_, only the last buffer_size entries are kept
+        try:
+            pending = self.pending_traces[textView]
+        except KeyError:
+            pending = self.pending_traces[textView] = deque(maxlen=self.buffer_size)
+        pending.append(text)
+        self.schedule_flush()
+
+    def clear_text(self, textView):
+        self.pending_traces.pop(textView, None)
+        self.trace_lengths.pop(textView, None)
+        textView.textStorage().deleteCharactersInRange_(NSMakeRange(0, textView.textStorage().length()))
+
+    def schedule_flush(self):
+        if self.flush_timer is None:
+            self.flush_timer = NSTimer.timerWithTimeInterval_target_selector_userInfo_repeats_(TRACE_FLUSH_INTERVAL, self, "flushTraces:", None, False)
+            NSRunLoop.currentRunLoop().addTimer_forMode_(self.flush_timer, NSRunLoopCommonModes)
+
+    @allocate_autorelease_pool
+    def flushTraces_(self, timer):
+        self.flush_timer = None
+        buffer_size = self.buffer_size
+
+        pending_traces, self.pending_traces = self.pending_traces, {}
+        for textView, pending in pending_traces.iteritems():
+            lengths = self.trace_lengths.setdefault(textView, deque())
+            text = NSMutableAttributedString.alloc().init()
+            for item in pending:
+                text.appendAttributedString_(item)
+                lengths.append(item.length())
+            storage = textView.textStorage()
+            storage.beginEditing()
+            storage.appendAttributedString_(text)
+            if buffer_size is not None and len(lengths) > buffer_size:
+                # drop the oldest entries in one go
+                length = sum(lengths.popleft() for i in xrange(len(lengths) - buffer_size))
+                storage.deleteCharactersInRange_(NSMakeRange(0, length))
+            storage.endEditing()
+            textView.scrollRangeToVisible_(NSMakeRange(storage.length()-1, 1))
+
+        if self.pending_notifications:
+            self.renderNotifications(buffer_size)
+
     def append_line(self, textView, line):
         if isinstance(line, NSAttributedString):
-            textView.textStorage().appendAttributedString_(line)
+            self.append_text(textView, line)
         else:
-            textView.textStorage().appendAttributedString_(NSAttributedString.alloc().initWithString_(line+"\n"))
-
-        textView.scrollRangeToVisible_(NSMakeRange(textView.textStorage().length()-1, 1))
+            self.append_text(textView, NSAttributedString.alloc().initWithString_(line+"\n"))
 
     def append_error_line(self, textView, line):
         red = NSDictionary.dictionaryWithObject_forKey_(NSColor.redColor(), NSForegroundColorAttributeName)
-        textView.textStorage().appendAttributedString_(NSAttributedString.alloc().initWithString_attributes_(line+"\n", red))
-        textView.scrollRangeToVisible_(NSMakeRange(textView.textStorage().length()-1, 1))
+        self.append_text(textView, NSAttributedString.alloc().initWithString_attributes_(line+"\n", red))
 
     @allocate_autorelease_pool
     @run_in_gui_thread
@@ -407,8 +507,7 @@ class DebugWindow(NSObject):
             text += '%s Remote SIP User Agent is "%s"\n' % (session.start_time, session.remote_user_agent)
 
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def renderVideo(self, session):
         try:
@@ -440,8 +539,7 @@ class DebugWindow(NSObject):
             text += '%s Remote SIP User Agent is "%s"\n' % (session.start_time, session.remote_user_agent)
 
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     @allocate_autorelease_pool
     def renderSIP(self, notification):
@@ -544,9 +642,8 @@ class DebugWindow(NSObject):
             if self.filter_sip_application not in applications:
                 return
 
-        self.sipTextView.textStorage().appendAttributedString_(text)
-        self.sipTextView.textStorage().appendAttributedString_(self.newline)
-        self.sipTextView.scrollRangeToVisible_(NSMakeRange(self.sipTextView.textStorage().length()-1, 1))
+        text.appendAttributedString_(self.newline)
+        self.append_text(self.sipTextView, text)
 
     def renderDNS(self, text):
         settings = SIPSimpleSettings()
@@ -600,11 +697,11 @@ class DebugWindow(NSObject):
             ts = ts.replace(microsecond=0) if type(ts) == datetime else ""
 
             self.notificationsBytes += len(notification.name) + len(str(notification.sender)) + len(attribs) + len(str(ts))
-            self.notifications_unfiltered.append((NSString.stringWithString_(notification.name),
-                                            NSString.stringWithString_(str(notification.sender)),
-                                            NSString.stringWithString_(attribs),
-                                            NSString.stringWithString_(str(ts))))
-            self.renderNotifications()
+            self.pending_notifications.append((NSString.stringWithString_(notification.name),
+                                               NSString.stringWithString_(str(notification.sender)),
+                                               NSString.stringWithString_(attribs),
+                                               NSString.stringWithString_(str(ts))))
+            self.schedule_flush()
 
     def _NH_CFGSettingsObjectDidChange(self, notification):
         sender = notification.sender
@@ -620,14 +717,12 @@ class DebugWindow(NSObject):
     def _NH_AudioSessionHasQualityIssues(self, notification):
         text = '%s Audio call quality to %s is poor: loss %s, rtt: %s\n' % (notification.datetime, notification.sender.sessionController.target_uri, notification.data.packet_loss, notification.data.latency)
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_AudioSessionQualityRestored(self, notification):
         text = '%s Audio call quality to %s is back to normal: loss %s, rtt: %s\n' % (notification.datetime, notification.sender.sessionController.target_uri, notification.data.packet_loss, notification.data.latency)
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_MSRPTransportTrace(self, notification):
         settings = SIPSimpleSettings()
@@ -706,8 +801,7 @@ class DebugWindow(NSObject):
         if stream.srtp_active:
             text += '%s RTP audio stream is encrypted\n' % notification.datetime
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_AudioStreamICENegotiationDidSucceed(self, notification):
         data = notification.data
@@ -733,8 +827,7 @@ class DebugWindow(NSObject):
         for check in data.valid_list:
             text += '\t%s\n' % check
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_VideoStreamICENegotiationDidSucceed(self, notification):
         data = notification.data
@@ -760,24 +853,21 @@ class DebugWindow(NSObject):
         for check in data.valid_list:
             text += '\t%s\n' % check
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_AudioStreamICENegotiationDidFail(self, notification):
         data = notification.data
 
         text = '%s Audio ICE negotiation failed: %s\n' % (notification.datetime, data.reason)
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_VideoStreamICENegotiationDidFail(self, notification):
         data = notification.data
 
         text = '%s Video ICE negotiation failed: %s\n' % (notification.datetime, data.reason)
         astring = NSAttributedString.alloc().initWithString_(text)
-        self.rtpTextView.textStorage().appendAttributedString_(astring)
-        self.rtpTextView.scrollRangeToVisible_(NSMakeRange(self.rtpTextView.textStorage().length()-1, 1))
+        self.append_text(self.rtpTextView, astring)
 
     def _NH_SIPEngineLog(self, notification):
         if self.pjsipCheckBox.state() == NSOnState:
@@ -5,6 +5,7 @@ from Foundation import NSDownloadsDirectory, NSSearchPathForDirectoriesInDomains
 
 import hashlib
 import datetime
+import mmap
 import os
 import re
 import time
@@ -22,14 +23,17 @@ from sipsimple.streams import FileTransferStream, FileSelector
 from sipsimple.threading import run_in_thread
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.util import ISOTimestamp
-from threading import Event
+from threading import Event, Lock
+from eventlib.twistedutil import block_on
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectionLost
+from twisted.python.threadpool import ThreadPool
 from zope.interface import implements
 
 from BlinkLogger import BlinkLogger
-from HistoryManager import FileTransferHistory, ChatHistory
-from util import allocate_autorelease_pool, format_size, format_date, format_identity_to_string
+from HistoryManager import FileTransferHistory, FileChecksumCache, ChatHistory
+from util import allocate_autorelease_pool, format_size, format_date, format_identity_to_string, run_in_thread_pool
 
 
 def format_duration(t):
@@ -40,6 +44,79 @@ def format_duration(t):
     return s
 
 
+# Checksums of outgoing files are computed on their own pool, so that hashing a large file
+# does not hold back the other transfers nor the chunk writes on the 'file-transfer' thread
+hash_pool = ThreadPool(minthreads=1, maxthreads=4, name='file-hashing')
+hash_pool.start()
+reactor.addSystemEventTrigger('before', 'shutdown', hash_pool.stop)
+
+run_in_hash_thread = run_in_thread_pool(hash_pool)
+
+# size of the memory mapped slices hashed between checks for cancellation
+HASH_SLICE_SIZE = 4*1024*1024
+
+# files modified less than this many seconds ago may still be written to and are not memory mapped
+HASH_MMAP_MIN_AGE = 5
+
+# received chunks are coalesced into writes of this size, aligned on the file offset
+DOWNLOAD_WRITE_SIZE = 1024*1024
+
+# the stream is held back while more than this many received bytes are waiting to be written
+DOWNLOAD_MAX_PENDING = 16*1024*1024
+
+# minimum interval in seconds between the progress updates of a transfer
+PROGRESS_UPDATE_INTERVAL = 0.25
+
+
+def compute_file_hash(file, stop_event, progress_callback=Null):
+    # Returns the SHA-1 hash object of an open file or None if stop_event got set. Files that
+    # are not being written to are memory mapped and hashed in place, the others are read in
+    # chunks: reading the pages of a mapped file truncated by another process raises SIGBUS.
+    # The size and modification time are checked before each slice, if the file changed the
+    # mapping is dropped and the file is hashed again with read()
+    stat = os.fstat(file.fileno())
+    size = stat.st_size
+    mapping = None
+    if size and time.time() - stat.st_mtime > HASH_MMAP_MIN_AGE:
+        try:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            mapping = None
+    chunk_size = limit(size/100, min=65536, max=1048576)
+    hash = hashlib.sha1()
+    pos = progress = 0
+    try:
+        while pos < size:
+            if stop_event.isSet():
+                return None
+            if mapping is not None:
+                current = os.fstat(file.fileno())
+                if (current.st_size, current.st_mtime) != (stat.st_size, stat.st_mtime):
+                    mapping.close()
+                    mapping = None
+                    size = current.st_size
+                    hash = hashlib.sha1()
+                    pos = 0
+                    file.seek(0)
+                    continue
+                length = min(HASH_SLICE_SIZE, size - pos)
+                hash.update(buffer(mapping, pos, length))
+            else:
+                content = file.read(chunk_size)
+                if not content:
+                    break
+                length = len(content)
+                hash.update(content)
+            pos += length
+            old_progress, progress = progress, int(float(pos)/size*100)
+            if old_progress != progress:
+                progress_callback(progress)
+    finally:
+        if mapping is not None:
+            mapping.close()
+    return hash
+
+
 class FileTransferInfo(object):
     def __init__(self, transfer_id=None, direction=None, local_uri=None, remote_uri=None, file_path=None, bytes_transfered=0, file_size=0, status=None):
         self.transfer_id       = transfer_id
@@ -51,6 +128,19 @@ class FileTransferInfo(object):
         self.file_size         = file_size
         self.status            = status
 
+
+class CachedHash(object):
+    # Stands for the hash object of a file whose checksum was found in FileChecksumCache
+    def __init__(self, hexdigest):
+        self._hexdigest = hexdigest
+
+    def hexdigest(self):
+        return self._hexdigest
+
+    def digest(self):
+        return self._hexdigest.decode('hex')
+
+
 class FileTransfer(object):
     implements(IObserver)
 
@@ -73,6 +163,8 @@ class FileTransfer(object):
     rate_history = None
     ft_info = None
 
+    last_progress_time = 0
+
     @property
     def file_name(self):
         name = self.file_selector and os.path.basename(self.file_selector.name or 'Unknown')
@@ -146,6 +238,75 @@ class FileTransfer(object):
         notification_center = NotificationCenter()
         notification_center.post_notification("BlinkFileTransferSpeedDidUpdate", sender=self)
 
+    def open_download_file(self):
+        download_folder = unicodedata.normalize('NFC', NSSearchPathForDirectoriesInDomains(NSDownloadsDirectory, NSUserDomainMask, True)[0])
+        for name in self.filename_generator(os.path.join(download_folder, self.file_name)):
+            if not os.path.exists(name) and not os.path.exists(name+".download"):
+                self.file_path = name + '.download'
+                break
+        self.file_selector.fd = open(self.file_path, "w+")
+
+        self.write_buffer = []
+        self.write_buffer_offset = 0
+        self.write_buffer_size = 0
+        self.write_lock = Lock()
+        self.pending_bytes = 0
+        self.writes_drained = None
+
+    def buffer_chunk(self, data, offset):
+        # Received chunks are written to disk in blocks of DOWNLOAD_WRITE_SIZE
+        if not self.write_buffer:
+            self.write_buffer_offset = offset
+        self.write_buffer.append(data)
+        self.write_buffer_size += len(data)
+        end = self.write_buffer_offset + self.write_buffer_size
+        aligned_end = end - end % DOWNLOAD_WRITE_SIZE
+        if aligned_end - self.write_buffer_offset >= DOWNLOAD_WRITE_SIZE:
+            data = ''.join(self.write_buffer)
+            cut = aligned_end - self.write_buffer_offset
+            self.queue_write(data[:cut])
+            self.write_buffer = [data[cut:]] if cut < len(data) else []
+            self.write_buffer_offset = aligned_end
+            self.write_buffer_size = len(data) - cut
+
+    def flush_chunks(self):
+        if self.write_buffer:
+            self.queue_write(''.join(self.write_buffer))
+            self.write_buffer = []
+            self.write_buffer_size = 0
+
+    def queue_write(self, data):
+        with self.write_lock:
+            self.pending_bytes += len(data)
+        self.write_chunk(data)
+
+    def wait_for_writes(self):
+        # Holds back the stream, and with it the reading from the MSRP connection, until the disk catches up
+        with self.write_lock:
+            if self.pending_bytes <= DOWNLOAD_MAX_PENDING:
+                return
+            self.writes_drained = Deferred()
+        block_on(self.writes_drained)
+
+    def should_update_progress(self):
+        now = time.time()
+        if now - self.last_progress_time < PROGRESS_UPDATE_INTERVAL and self.file_pos != self.file_size:
+            return False
+        self.last_progress_time = now
+        return True
+
+    def write_download_chunk(self, data):
+        # Caller needs to be in the 'file-transfer' thread
+        try:
+            self.file_selector.fd.write(data)
+            self.hash.update(data)
+        finally:
+            with self.write_lock:
+                self.pending_bytes -= len(data)
+                if self.writes_drained is not None and self.pending_bytes <= DOWNLOAD_MAX_PENDING/2:
+                    writes_drained, self.writes_drained = self.writes_drained, None
+                    reactor.callFromThread(writes_drained.callback, None)
+
     @run_in_green_thread
     def add_to_history(self):
         FileTransferHistory().add_transfer(transfer_id=self.ft_info.transfer_id, direction=self.ft_info.direction, local_uri=self.ft_info.local_uri, remote_uri=self.ft_info.remote_uri, file_path=self.ft_info.file_path, bytes_transfered=self.ft_info.bytes_transfered, file_size=self.ft_info.file_size or 0, status=self.ft_info.status)
@@ -218,17 +379,11 @@ class IncomingFileTransferHandler(FileTransfer):
     def start(self):
         notification_center = NotificationCenter()
 
-        download_folder = unicodedata.normalize('NFC', NSSearchPathForDirectoriesInDomains(NSDownloadsDirectory, NSUserDomainMask, True)[0])
-
-        for name in self.filename_generator(os.path.join(download_folder, self.file_name)):
-            if not os.path.exists(name) and not os.path.exists(name+".download"):
-                self.file_path = name + '.download'
-                break
+        self.open_download_file()
 
         self.ft_info = FileTransferInfo(transfer_id=self.transfer_id, direction='incoming', local_uri=format_identity_to_string(self.account) if self.account is not BonjourAccount() else 'bonjour' , file_size=self.file_size, remote_uri=self.remote_identity, file_path=self.file_path)
 
         self.log_info(u"Will write file to %s" % self.file_path)
-        self.file_selector.fd = open(self.file_path, "w+")
 
         self.ft_info.status = "preparing"
         self.status = NSLocalizedString("Accepting File Transfer...", "Label")
@@ -252,11 +407,9 @@ class IncomingFileTransferHandler(FileTransfer):
         notification_center = NotificationCenter()
         if data is not None:
             try:
-                self.file_selector.fd.write(data)
+                self.write_download_chunk(data)
             except EnvironmentError, e:
                 notification_center.post_notification('IncomingFileTransferHandlerGotError', sender=self, data=NotificationData(error=str(e)))
-            else:
-                self.hash.update(data)
         else:
             self.file_selector.fd.close()
             if self.error:
@@ -299,19 +452,23 @@ class IncomingFileTransferHandler(FileTransfer):
 
     def _NH_MediaStreamDidEnd(self, sender, data):
         # Mark end of write operations
+        self.flush_chunks()
         self.write_chunk(None)
 
     def _NH_FileTransferStreamGotChunk(self, sender, data):
         self.file_pos = data.transferred_bytes
         self.file_selector.size = data.file_size # just in case the size was not specified in the file selector -Dan
 
-        self.write_chunk(data.content)
+        self.buffer_chunk(data.content, data.transferred_bytes - len(data.content))
 
-        self.update_transfer_rate()
-        self.status = self.format_progress()
-        self.ft_info.status = "transferring"
-        notification_center = NotificationCenter()
-        notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+        if self.should_update_progress():
+            self.update_transfer_rate()
+            self.status = self.format_progress()
+            self.ft_info.status = "transferring"
+            notification_center = NotificationCenter()
+            notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+
+        self.wait_for_writes()
 
     def _NH_FileTransferStreamDidFinish(self, sender, data):
         self.finished_transfer = True
@@ -448,7 +605,7 @@ class OutgoingPushFileTransferHandler(FileTransfer):
         self.stop_event.clear()
         self.initiate_file_transfer()
 
-    @run_in_thread('file-transfer')
+    @run_in_hash_thread
     def initiate_file_transfer(self):
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=self)
@@ -463,25 +620,27 @@ class OutgoingPushFileTransferHandler(FileTransfer):
         # compute the file hash first
         self.ft_info.status = "preparing"
         self.status = NSLocalizedString("Computing checksum...", "Label")
-        hash = hashlib.sha1()
-        pos = progress = 0
-        chunk_size = limit(self.file_selector.size/100, min=65536, max=1048576)
+
+        # retries and repeated sends of an unchanged file reuse the checksum computed before
+        checksum_cache = FileChecksumCache()
+        stat = os.fstat(self.file_selector.fd.fileno())
+        checksum = checksum_cache.get(self.file_path, stat)
+        if checksum is not None:
+            self.log_info(u"Using cached checksum for file %s" % os.path.basename(self.file_path))
+            self.file_selector.hash = CachedHash(checksum)
+            notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=100))
+            notification_center.post_notification('BlinkFileTransferDidComputeHash', sender=self)
+            return
+
         notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=0))
-        while not self.stop_event.isSet():
-            content = self.file_selector.fd.read(chunk_size)
-            if not content:
-                break
-            hash.update(content)
-            pos += len(content)
-            old_progress, progress = progress, int(float(pos)/self.file_selector.size*100)
-            if old_progress != progress:
-                notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=progress))
-        else:
+        hash = compute_file_hash(self.file_selector.fd, self.stop_event, lambda progress: notification_center.post_notification('BlinkFileTransferHashUpdate', sender=self, data=NotificationData(progress=progress)))
+        if hash is None:
             self.file_selector.fd.close()
             notification_center.post_notification('BlinkFileTransferDidNotComputeHash', sender=self, data=NotificationData(reason='Cancelled computing checksum'))
             return
         self.file_selector.fd.seek(0)
         self.file_selector.hash = hash
+        checksum_cache.put(self.file_path, stat, hash.hexdigest())
         notification_center.post_notification('BlinkFileTransferDidComputeHash', sender=self)
 
     def cancel(self):
@@ -663,14 +822,8 @@ class OutgoingPullFileTransferHandler(FileTransfer):
         notification_center = NotificationCenter()
         settings = SIPSimpleSettings()
 
-        download_folder = unicodedata.normalize('NFC', NSSearchPathForDirectoriesInDomains(NSDownloadsDirectory, NSUserDomainMask, True)[0])
-        for name in self.filename_generator(os.path.join(download_folder, self.file_name)):
-            if not os.path.exists(name) and not os.path.exists(name+".download"):
-                self.file_path = name + '.download'
-                break
-
+        self.open_download_file()
         self.log_info(u"File will be written to %s" % self.file_path)
-        self.file_selector.fd = open(self.file_path, "w+")
 
         self.ft_info = FileTransferInfo(transfer_id=self.transfer_id, direction='incoming', local_uri=format_identity_to_string(self.account) if self.account is not BonjourAccount() else 'bonjour' , file_size=self.file_size, remote_uri=self.remote_identity, file_path=self.file_path)
 
@@ -717,11 +870,9 @@ class OutgoingPullFileTransferHandler(FileTransfer):
         notification_center = NotificationCenter()
         if data is not None:
             try:
-                self.file_selector.fd.write(data)
+                self.write_download_chunk(data)
             except EnvironmentError, e:
                 notification_center.post_notification('OutgoingPullFileTransferHandlerGotError', sender=self, data=NotificationData(error=str(e)))
-            else:
-                self.hash.update(data)
         else:
             self.file_selector.fd.close()
             if self.error:
@@ -783,6 +934,7 @@ class OutgoingPullFileTransferHandler(FileTransfer):
 
     def _NH_MediaStreamDidEnd(self, sender, data):
         # Mark end of write operations
+        self.flush_chunks()
         self.write_chunk(None)
 
     def _NH_FileTransferStreamGotChunk(self, sender, data):
@@ -790,13 +942,16 @@ class OutgoingPullFileTransferHandler(FileTransfer):
         self.file_selector.size = data.file_size # just in case the size was not specified in the file selector -Dan
         self.ft_info.file_size = self.file_size
 
-        self.write_chunk(data.content)
+        self.buffer_chunk(data.content, data.transferred_bytes - len(data.content))
 
-        self.update_transfer_rate()
-        self.status = self.format_progress()
-        self.ft_info.status = "transferring"
-        notification_center = NotificationCenter()
-        notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+        if self.should_update_progress():
+            self.update_transfer_rate()
+            self.status = self.format_progress()
+            self.ft_info.status = "transferring"
+            notification_center = NotificationCenter()
+            notification_center.post_notification("BlinkFileTransferUpdate", sender=self)
+
+        self.wait_for_writes()
 
     def _NH_FileTransferStreamDidFinish(self, sender, data):
         self.finished_transfer = True
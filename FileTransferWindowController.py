@@ -22,7 +22,7 @@ from zope.interface import implements
 
 import ListView
 from BlinkLogger import BlinkLogger
-from HistoryManager import FileTransferHistory
+from HistoryManager import FileTransferHistory, FileChecksumCache
 from FileTransferItemView import FileTransferItemView
 from FileTransferSession import IncomingFileTransferHandler, OutgoingPushFileTransferHandler, OutgoingPullFileTransferHandler
 from util import allocate_autorelease_pool, run_in_gui_thread, format_size
@@ -65,6 +65,7 @@ class FileTransferWindowController(NSObject):
             NotificationCenter().add_observer(self, name="BlinkFileTransferDidFail")
             NotificationCenter().add_observer(self, name="BlinkFileTransferDidEnd")
             NotificationCenter().add_observer(self, name="BlinkFileTransferSpeedDidUpdate")
+            NotificationCenter().add_observer(self, name="BlinkFileTransferDidComputeHash")
             NotificationCenter().add_observer(self, name="BlinkShouldTerminate")
 
             NSBundle.loadNibNamed_owner_("FileTransferWindow", self)
@@ -95,13 +96,22 @@ class FileTransferWindowController(NSObject):
             h = self.listView.minimumHeight()
             self.listView.scrollRectToVisible_(NSMakeRect(0, h-1, 100, 1))
 
+        self.refresh_bottom_label()
+
+        self.loaded = True
+
+    def refresh_bottom_label(self):
         count = len(self.listView.subviews())
         if count == 1:
-            self.bottomLabel.setStringValue_(NSLocalizedString("1 item", "Label"))
+            text = NSLocalizedString("1 item", "Label")
         else:
-            self.bottomLabel.setStringValue_(NSLocalizedString("%i items", "Label") % count if count else u"")
+            text = NSLocalizedString("%i items", "Label") % count if count else u""
 
-        self.loaded = True
+        stats = FileChecksumCache().stats
+        if stats.hits or stats.misses:
+            checksums = NSLocalizedString("checksum cache %i hits, %i misses", "Label") % (stats.hits, stats.misses)
+            text = text + ", " + checksums if text else checksums
+        self.bottomLabel.setStringValue_(text)
 
     def load_transfers_from_history(self):
         active_items = []
@@ -186,11 +196,7 @@ class FileTransferWindowController(NSObject):
         if 'xscreencapture' not in sender.file_path:
             self.window.orderFront_(None)
 
-        count = len(self.listView.subviews())
-        if count == 1:
-            self.bottomLabel.setStringValue_(NSLocalizedString("1 item", "Label"))
-        else:
-            self.bottomLabel.setStringValue_(NSLocalizedString("%i items", "Label") % count)
+        self.refresh_bottom_label()
 
     def _NH_BlinkFileTransferDidFail(self, sender, data):
         self.listView.relayout()
@@ -199,6 +205,9 @@ class FileTransferWindowController(NSObject):
     def _NH_BlinkFileTransferSpeedDidUpdate(self, sender, data):
         self.refresh_transfer_rate()
 
+    def _NH_BlinkFileTransferDidComputeHash(self, sender, data):
+        self.refresh_bottom_label()
+
     def _NH_BlinkFileTransferDidEnd(self, sender, data):
         self.listView.relayout()
         self.refresh_transfer_rate()
@@ -27,7 +27,9 @@ import urlparse
 import urllib
 import pytz
 
-from datetime import datetime
+from collections import namedtuple, OrderedDict
+from datetime import date, datetime
+from threading import Event, Lock, RLock, Timer, local
 from uuid import uuid1
 from pytz import timezone
 
@@ -35,8 +37,8 @@ from application.notification import IObserver, NotificationCenter, Notification
 from application.python import Null
 from application.python.decorator import decorator, preserve_signature
 from application.python.types import Singleton
-from application.system import makedirs
-from sqlobject import SQLObject, StringCol, DateTimeCol, DateCol, IntCol, UnicodeCol, DatabaseIndex, DESC, SQLObjectNotFound
+from application.system import makedirs, unlink
+from sqlobject import SQLObject, StringCol, DateTimeCol, DateCol, FloatCol, IntCol, UnicodeCol, DatabaseIndex, SQLObjectNotFound
 from sqlobject import connectionForURI
 from sqlobject import dberrors
 
@@ -58,10 +60,19 @@ from sipsimple.util import ISOTimestamp
 from zope.interface import implements
 
 
+# All inserts, updates and deletes are serialized on the single 'db-ops' writer thread,
+# while the history lookups run concurrently on the 'db-reads' pool. The database
+# runs in WAL mode so that readers never wait for the writer.
 pool = ThreadPool(minthreads=1, maxthreads=1, name='db-ops')
 pool.start()
 reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
 
+read_pool = ThreadPool(minthreads=1, maxthreads=4, name='db-reads')
+read_pool.start()
+reactor.addSystemEventTrigger('before', 'shutdown', read_pool.stop)
+
+read_thread_data = local()
+
 
 @decorator
 def run_in_db_thread(func):
@@ -71,6 +82,118 @@ def run_in_db_thread(func):
     return wrapper
 
 
+@decorator
+def run_in_db_read_thread(func):
+    @preserve_signature(func)
+    def wrapper(self, *args, **kw):
+        return deferToThreadPool(reactor, read_pool, _run_db_read, func, self, *args, **kw)
+    return wrapper
+
+
+def _run_db_read(func, history, *args, **kw):
+    # Wait for the table to be created or migrated by the writer thread
+    history.initialized.wait()
+    # Each history has its own read connection, SQLite keeps one handle per thread for each
+    try:
+        query_only_connections = read_thread_data.query_only_connections
+    except AttributeError:
+        query_only_connections = read_thread_data.query_only_connections = set()
+    if id(history.read_db) not in query_only_connections:
+        try:
+            history.read_db.queryAll('PRAGMA query_only = 1')
+        except Exception, e:
+            BlinkLogger().log_error(u"Error setting history read connection to read-only: %s" % e)
+        else:
+            query_only_connections.add(id(history.read_db))
+    return func(history, *args, **kw)
+
+
+def read_connection_for_uri(db_uri):
+    # A distinct URI gives a connection object separate from the writer, SQLite
+    # keeps one handle per db read thread for it
+    return connectionForURI(db_uri + "?timeout=30")
+
+
+class SQLQuery(object):
+    # Builds a parameterized statement out of optional conditions. The SQL text is cached
+    # by the shape of the query, queries with the same shape produce identical text which
+    # lets SQLite reuse the statement already prepared on each connection
+    _statement_cache = {}
+    _statement_cache_size = 200
+
+    def __init__(self, statement, *parameters):
+        self.statement = statement
+        self.conditions = []
+        self.clauses = []
+        self._statement_parameters = list(parameters)
+        self._condition_parameters = []
+        self._clause_parameters = []
+
+    @staticmethod
+    def columns(table_class):
+        return ", ".join([table_class.sqlmeta.idName] + [column.dbName for column in table_class.sqlmeta.columnList])
+
+    def where(self, condition, *parameters):
+        self.conditions.append(condition)
+        self._condition_parameters.extend(parameters)
+        return self
+
+    def where_in(self, column, values):
+        if isinstance(values, basestring):
+            values = (values,)
+        values = list(values)
+        if len(values) == 1:
+            return self.where("%s = ?" % column, values[0])
+        return self.where("%s in (%s)" % (column, ", ".join("?" * len(values))), *values)
+
+    def append(self, clause, *parameters):
+        self.clauses.append(clause)
+        self._clause_parameters.extend(parameters)
+        return self
+
+    @property
+    def sql(self):
+        shape = (self.statement, tuple(self.conditions), tuple(self.clauses))
+        try:
+            return self._statement_cache[shape]
+        except KeyError:
+            sql = self.statement
+            if self.conditions:
+                sql += " where " + " and ".join(self.conditions)
+            if self.clauses:
+                sql += " " + " ".join(self.clauses)
+            if len(self._statement_cache) >= self._statement_cache_size:
+                self._statement_cache.clear()
+            self._statement_cache[shape] = sql
+            return sql
+
+    @property
+    def parameters(self):
+        parameters = []
+        for value in self._statement_parameters + self._condition_parameters + self._clause_parameters:
+            # Same representation as the one used by SQLObject for the stored values
+            if isinstance(value, datetime):
+                value = value.strftime("%Y-%m-%d %H:%M:%S")
+            elif isinstance(value, date):
+                value = value.strftime("%Y-%m-%d")
+            parameters.append(value)
+        return parameters
+
+    def execute(self, db):
+        # Caller needs to be in a db thread
+        conn = db.getConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.sql, self.parameters)
+            return cursor.fetchall()
+        finally:
+            db.releaseConnection(conn)
+
+    def select(self, table_class, db):
+        # The statement must select the columns returned by SQLQuery.columns(table_class)
+        return [table_class.get(row[0], connection=db, selectResults=row[1:]) for row in self.execute(db)]
+
+
 class TableVersionEntry(SQLObject):
     class sqlmeta:
         table = 'versions'
@@ -82,6 +205,7 @@ class TableVersions(object):
     __metaclass__ = Singleton
 
     def __init__(self):
+        self.vacuum_needed = False
         path = ApplicationData.get('history')
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
@@ -91,6 +215,19 @@ class TableVersions(object):
     def _initialize(self, db_uri):
         self.db = connectionForURI(db_uri)
         TableVersionEntry._connection = self.db
+        try:
+            if self.db.queryAll('PRAGMA auto_vacuum')[0][0] != 2:
+                # Free pages are reclaimed in small steps by HistoryCompactor. A new database
+                # gets the mode right away, an existing one is converted by a full vacuum
+                # which HistoryCompactor runs once when the user is idle
+                self.db.queryAll('PRAGMA auto_vacuum = INCREMENTAL')
+                self.vacuum_needed = self.db.queryAll('PRAGMA auto_vacuum')[0][0] != 2
+        except Exception, e:
+            BlinkLogger().log_error(u"Error enabling incremental vacuum for history database: %s" % e)
+        try:
+            self.db.queryAll('PRAGMA journal_mode = WAL')
+        except Exception, e:
+            BlinkLogger().log_error(u"Error enabling write-ahead logging for history database: %s" % e)
         try:
             TableVersionEntry.createTable(ifNotExists=True)
         except Exception, e:
@@ -124,6 +261,106 @@ class TableVersions(object):
         return False
 
 
+class HistoryCompactor(object):
+    __metaclass__ = Singleton
+    implements(IObserver)
+
+    # Number of free pages released by each step, a step holds the db thread only for a moment
+    step_pages = 256
+    step_interval = 0.5
+
+    def __init__(self):
+        self.compacting = False
+        self.paused = False
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='BlinkUserBecameIdle')
+        notification_center.add_observer(self, name='BlinkUserBecameActive')
+        notification_center.add_observer(self, name='SystemWillSleep')
+        notification_center.add_observer(self, name='SystemDidWakeUpFromSleep')
+
+    @property
+    def db(self):
+        return TableVersions().db
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification.sender, notification.data)
+
+    def _NH_BlinkUserBecameIdle(self, sender, data):
+        self.paused = False
+        self.compact()
+
+    def _NH_BlinkUserBecameActive(self, sender, data):
+        self.paused = True
+
+    def _NH_SystemWillSleep(self, sender, data):
+        self.paused = False
+        self.compact()
+
+    def _NH_SystemDidWakeUpFromSleep(self, sender, data):
+        self.paused = True
+
+    def compact(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        self._compact_step()
+
+    def _compact_step(self):
+        if self.paused:
+            self.compacting = False
+            return
+        if TableVersions().vacuum_needed:
+            deferred = self._enable_incremental_vacuum()
+        else:
+            deferred = self._release_free_pages(self.step_pages)
+        deferred.addCallback(self._compact_step_finished)
+
+    def _compact_step_finished(self, free_pages):
+        if free_pages:
+            reactor.callLater(self.step_interval, self._compact_step)
+        else:
+            self.compacting = False
+
+    @run_in_db_thread
+    def _enable_incremental_vacuum(self):
+        # the full vacuum rewrites the database and holds the db thread until it is done
+        start_time = time.time()
+        try:
+            self.db.queryAll('PRAGMA auto_vacuum = INCREMENTAL')
+            self.db.queryAll('VACUUM')
+        except Exception, e:
+            BlinkLogger().log_error(u"Error enabling incremental vacuum for history database: %s" % e)
+        else:
+            BlinkLogger().log_info(u"Enabled incremental vacuum for history database in %.1f seconds" % (time.time() - start_time))
+        # a failed conversion is not tried again before the next start
+        TableVersions().vacuum_needed = False
+        return 0
+
+    @run_in_db_thread
+    def _release_free_pages(self, count):
+        try:
+            self.db.queryAll('PRAGMA incremental_vacuum(%d)' % count)
+            return self.db.queryAll('PRAGMA freelist_count')[0][0]
+        except Exception, e:
+            BlinkLogger().log_error(u"Error compacting history database: %s" % e)
+            return 0
+
+    @run_in_db_thread
+    def _get_stats(self):
+        try:
+            page_size = self.db.queryAll('PRAGMA page_size')[0][0]
+            page_count = self.db.queryAll('PRAGMA page_count')[0][0]
+            free_pages = self.db.queryAll('PRAGMA freelist_count')[0][0]
+        except Exception, e:
+            BlinkLogger().log_error(u"Error getting history database stats: %s" % e)
+            return None
+        return NotificationData(page_size=page_size, page_count=page_count, free_pages=free_pages, free_bytes=free_pages*page_size)
+
+    def get_stats(self):
+        return block_on(self._get_stats())
+
+
 class SessionHistoryEntry(SQLObject):
     class sqlmeta:
         table = 'sessions'
@@ -151,13 +388,21 @@ class SessionHistoryEntry(SQLObject):
 
 class SessionHistory(object):
     __metaclass__ = Singleton
-    __version__ = 5
+    __version__ = 6
+    indexes = (('sip_callid_index', 'sip_callid'),
+               ('sip_fromtag_index', 'sip_fromtag'),
+               ('start_time_index', 'start_time'),
+               ('sip_callid_start_time_index', 'sip_callid, start_time'),
+               ('sip_fromtag_start_time_index', 'sip_fromtag, start_time'),
+               ('start_time_media_types_index', 'start_time, media_types, local_uri, remote_uri'))
 
     def __init__(self):
         path = ApplicationData.get('history')
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
         TableVersions()    # initialize versions table
+        self.initialized = Event()
+        self.read_db = read_connection_for_uri(db_uri)
         self._initialize(db_uri)
 
     @run_in_db_thread
@@ -177,11 +422,23 @@ class SessionHistory(object):
                 except Exception, e:
                     BlinkLogger().log_error(u"Error creating table %s: %s" % (SessionHistoryEntry.sqlmeta.table,e))
                 else:
+                    self._create_indexes()
                     TableVersions().set_table_version(SessionHistoryEntry.sqlmeta.table, self.__version__)
 
         except Exception, e:
             BlinkLogger().log_error(u"Error checking table %s: %s" % (SessionHistoryEntry.sqlmeta.table,e))
 
+        self.initialized.set()
+
+    def _create_indexes(self):
+        for name, columns in self.indexes:
+            query = "CREATE INDEX IF NOT EXISTS %s ON sessions (%s)" % (name, columns)
+            try:
+                self.db.queryAll(query)
+                BlinkLogger().log_debug(u"Added index %s to table %s" % (name, SessionHistoryEntry.sqlmeta.table))
+            except Exception, e:
+                BlinkLogger().log_error(u"Error adding index %s to table %s: %s" % (name, SessionHistoryEntry.sqlmeta.table, e))
+
     @allocate_autorelease_pool
     def _migrate_version(self, previous_version):
         if previous_version is None:
@@ -239,6 +496,9 @@ class SessionHistory(object):
                 except Exception, e:
                     BlinkLogger().log_error(u"Error alter table %s: %s" % (SessionHistoryEntry.sqlmeta.table, e))
 
+        if previous_version is None or previous_version.version < 6:
+            self._create_indexes()
+
         TableVersions().set_table_version(SessionHistoryEntry.sqlmeta.table, self.__version__)
 
     @run_in_db_thread
@@ -269,57 +529,49 @@ class SessionHistory(object):
             BlinkLogger().log_error(u"Error adding record %s to sessions table: %s" % (session_id, e))
             return False
 
-    @run_in_db_thread
-    def _get_entries(self, direction, status, remote_focus, count, call_id, from_tag, to_tag, remote_uris, hidden, after_date):
-        query='1=1'
+    @run_in_db_read_thread
+    def _get_entries(self, direction, status, remote_focus, count, call_id, from_tag, to_tag, remote_uris, hidden, after_date, after_id):
+        query = SQLQuery("select %s from sessions" % SQLQuery.columns(SessionHistoryEntry))
         if call_id:
-            query += " and sip_callid = %s" % SessionHistoryEntry.sqlrepr(call_id)
+            query.where("sip_callid = ?", call_id)
         if from_tag:
-            query += " and sip_fromtag = %s" % SessionHistoryEntry.sqlrepr(from_tag)
+            query.where("sip_fromtag = ?", from_tag)
         if to_tag:
-            query += " and sip_to_tag = %s" % SessionHistoryEntry.sqlrepr(to_tag)
+            query.where("sip_totag = ?", to_tag)
         if direction:
-            query += " and direction = %s" % SessionHistoryEntry.sqlrepr(direction)
+            query.where("direction = ?", direction)
         if status:
-            query += " and status = %s" % SessionHistoryEntry.sqlrepr(status)
+            query.where("status = ?", status)
         if remote_focus:
-            query += " and remote_focus = %s" % SessionHistoryEntry.sqlrepr(remote_focus)
+            query.where("remote_focus = ?", remote_focus)
         if hidden is not None:
-            query += " and hidden = %s" % SessionHistoryEntry.sqlrepr(hidden)
+            query.where("hidden = ?", hidden)
         if after_date:
-            query += " and start_time >= %s" % SessionHistoryEntry.sqlrepr(after_date)
-
+            query.where("start_time >= ?", after_date)
+        if after_id:
+            query.where("id > ?", after_id)
         if remote_uris:
-            remote_uris_sql = ''
-            for uri in remote_uris:
-                remote_uris_sql += "%s," % SessionHistoryEntry.sqlrepr(unicode(uri))
-            remote_uris_sql = remote_uris_sql.rstrip(",")
-            query += " and remote_uri in (%s)" % remote_uris_sql
+            query.where_in("remote_uri", [unicode(uri) for uri in remote_uris])
 
-        query += " order by start_time desc limit %d" % count
+        query.append("order by start_time desc limit ?", count)
         try:
-            return list(SessionHistoryEntry.select(query))
+            return query.select(SessionHistoryEntry, self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting entries from sessions history table: %s" % e)
             return []
 
-    def get_entries(self, direction=None, status=None, remote_focus=None, count=12, call_id=None, from_tag=None, to_tag=None, remote_uris=None, hidden=None, after_date=None):
+    def get_entries(self, direction=None, status=None, remote_focus=None, count=12, call_id=None, from_tag=None, to_tag=None, remote_uris=None, hidden=None, after_date=None, after_id=None):
         # TODO: exclude media types like file transfer, as we may not want to redial them
-        return block_on(self._get_entries(direction, status, remote_focus, count, call_id, from_tag, to_tag, remote_uris, hidden, after_date))
+        return block_on(self._get_entries(direction, status, remote_focus, count, call_id, from_tag, to_tag, remote_uris, hidden, after_date, after_id))
 
     def hide_entries(self, session_ids):
         block_on(self._hide_entries(session_ids))
 
     @run_in_db_thread
     def _hide_entries(self, session_ids):
-        query = "update sessions set hidden = 1 where "
-        session_ids_sql = ''
-        for id in session_ids:
-            session_ids_sql += "%s," % SessionHistoryEntry.sqlrepr(id)
-        session_ids_sql = session_ids_sql.rstrip(",")
-        query += "id in (%s)" % session_ids_sql
-        try:
-            self.db.queryAll(query)
+        query = SQLQuery("update sessions set hidden = 1").where_in("id", session_ids)
+        try:
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error hiding session: %s" % e)
 
@@ -330,9 +582,9 @@ class SessionHistory(object):
 
     @run_in_db_thread
     def _unhide_missed_entries(self):
-        query = "update sessions set hidden = 0 where status = 'missed'"
+        query = SQLQuery("update sessions set hidden = 0").where("status = ?", 'missed')
         try:
-            self.db.queryAll(query)
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error hiding session: %s" % e)
 
@@ -343,9 +595,9 @@ class SessionHistory(object):
 
     @run_in_db_thread
     def _unhide_incoming_entries(self):
-        query = "update sessions set hidden = 0 where direction = 'incoming' and status != 'missed'"
+        query = SQLQuery("update sessions set hidden = 0").where("direction = ?", 'incoming').where("status != ?", 'missed')
         try:
-            self.db.queryAll(query)
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error hiding session: %s" % e)
 
@@ -356,20 +608,21 @@ class SessionHistory(object):
 
     @run_in_db_thread
     def _unhide_outgoing_entries(self):
-        query = "update sessions set hidden = 0 where direction = 'outgoing'"
+        query = SQLQuery("update sessions set hidden = 0").where("direction = ?", 'outgoing')
         try:
-            self.db.queryAll(query)
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error hiding session: %s" % e)
 
         NotificationCenter().post_notification('HistoryEntriesVisibilityChanged')
 
-    @run_in_db_thread
+    @run_in_db_read_thread
     def _get_last_chat_conversations(self, count):
-        query="select local_uri, remote_uri from sessions where media_types like '%chat%' and local_uri <> 'bonjour' order by start_time desc limit 100"
+        query = SQLQuery("select local_uri, remote_uri from sessions").where("media_types like ?", '%chat%').where("local_uri <> ?", 'bonjour')
+        query.append("order by start_time desc limit ?", 100)
         results = []
         try:
-            rows = list(self.db.queryAll(query))
+            rows = query.execute(self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting last chat convesations: %s" % e)
             return results
@@ -388,12 +641,13 @@ class SessionHistory(object):
     def get_last_sms_conversations(self, count=5):
         return block_on(self._get_last_sms_conversations(count))
 
-    @run_in_db_thread
+    @run_in_db_read_thread
     def _get_last_sms_conversations(self, count):
-        query="select local_uri, remote_uri from chat_messages where media_type = 'sms' order by time desc limit 100"
+        query = SQLQuery("select local_uri, remote_uri from chat_messages").where("media_type = ?", 'sms')
+        query.append("order by time desc limit ?", 100)
         results = []
         try:
-            rows = list(self.db.queryAll(query))
+            rows = query.execute(self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting last sms convesations: %s" % e)
             return results
@@ -408,29 +662,21 @@ class SessionHistory(object):
 
     @run_in_db_thread
     def delete_entries(self, local_uri=None, remote_uri=None, after_date=None, before_date=None):
-        query = "delete from sessions where 1=1"
+        query = SQLQuery("delete from sessions")
         if local_uri:
-            query += " and local_uri=%s" % ChatMessage.sqlrepr(local_uri)
+            query.where("local_uri = ?", local_uri)
         if remote_uri:
-            if remote_uri is not tuple:
-                remote_uri = (remote_uri,)
-            remote_uri_sql = ""
-            for uri in remote_uri:
-                remote_uri_sql += '%s,' % ChatMessage.sqlrepr(uri)
-            remote_uri_sql = remote_uri_sql.rstrip(",)")
-            remote_uri_sql = remote_uri_sql.lstrip("(")
-            query += " and remote_uri in (%s)" % remote_uri_sql
+            query.where_in("remote_uri", remote_uri)
         if after_date:
-            query += " and start_time >= %s" % ChatMessage.sqlrepr(after_date)
+            query.where("start_time >= ?", after_date)
         if before_date:
-            query += " and start_time < %s" % ChatMessage.sqlrepr(before_date)
+            query.where("start_time < ?", before_date)
         try:
-            self.db.queryAll(query)
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error deleting messages from session history table: %s" % e)
             return False
         else:
-            self.db.queryAll('vacuum')
             return True
 
 
@@ -463,15 +709,50 @@ class ChatMessage(SQLObject):
     encryption        = StringCol(default='')
 
 
+class ChatMessageRow(namedtuple('ChatMessageRow', 'id msgid direction time date sip_callid local_uri remote_uri cpim_from cpim_to cpim_timestamp body content_type private status media_type encryption stored_time')):
+    # Read-only chat message, much cheaper to build than a ChatMessage instance
+    __slots__ = ()
+    columns = "id, msgid, direction, time, date, sip_callid, local_uri, remote_uri, cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, media_type, encryption, time"
+
+    @classmethod
+    def from_row(cls, row):
+        row = list(row)
+        for index in (6, 7, 8, 9, 11):
+            if row[index] is not None:
+                row[index] = row[index].decode('utf-8')
+        if row[3]:
+            row[3] = datetime.strptime(row[3][:19], "%Y-%m-%d %H:%M:%S")
+        if row[4]:
+            row[4] = datetime.strptime(row[4][:10], "%Y-%m-%d").date()
+        return cls(*row)
+
+    @property
+    def position(self):
+        # Key used to get the messages older than this one. The time is kept as stored,
+        # with its fraction of a second, so that messages from the same second as the
+        # last one of a page are not skipped
+        return (self.stored_time, self.id)
+
+
 class ChatHistory(object):
     __metaclass__ = Singleton
-    __version__ = 5
+    __version__ = 6
+    fts_available = False
+    # index names are shared by all tables of the database, sip_callid_index is the one of the sessions table
+    indexes = (('date_index', 'date'),
+               ('time_index', 'time'),
+               ('chat_messages_sip_callid_index', 'sip_callid'),
+               ('remote_uri_media_type_date_index', 'remote_uri, media_type, date, time'),
+               ('media_type_time_index', 'media_type, time, local_uri, remote_uri'),
+               ('media_type_date_index', 'media_type, date, local_uri, remote_uri'))
 
     def __init__(self):
         path = ApplicationData.get('history')
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
         TableVersions()    # initialize versions table
+        self.initialized = Event()
+        self.read_db = read_connection_for_uri(db_uri)
         self._initialize(db_uri)
 
     @run_in_db_thread
@@ -491,11 +772,69 @@ class ChatHistory(object):
                 except Exception, e:
                     BlinkLogger().log_error(u"Error creating history table %s: %s" % (ChatMessage.sqlmeta.table,e))
                 else:
+                    self._create_indexes()
+                    self._create_fts_index()
                     TableVersions().set_table_version(ChatMessage.sqlmeta.table, self.__version__)
 
+            self.fts_available = self.db.tableExists('chat_messages_fts')
         except Exception, e:
             BlinkLogger().log_error(u"Error checking history table %s: %s" % (ChatMessage.sqlmeta.table,e))
 
+        self.initialized.set()
+
+    def _create_indexes(self):
+        # Caller needs to be in the db thread. The composite indexes cover the columns
+        # used by the daily entries, last conversations and history replay queries
+        for name, columns in self.indexes:
+            query = "CREATE INDEX IF NOT EXISTS %s ON chat_messages (%s)" % (name, columns)
+            try:
+                self.db.queryAll(query)
+            except Exception, e:
+                BlinkLogger().log_error(u"Error adding index %s to table %s: %s" % (name, ChatMessage.sqlmeta.table, e))
+
+    def _create_fts_index(self):
+        # Caller needs to be in the db thread. The full text index only references the
+        # rows of chat_messages and is kept in sync with them by triggers. It indexes
+        # trigrams, so it finds the same parts of words and numbers as a LIKE search
+        queries = ("CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(body, content='chat_messages', content_rowid='id', tokenize='trigram')",
+                   "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN "
+                   "INSERT INTO chat_messages_fts (rowid, body) VALUES (new.id, new.body); END",
+                   "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN "
+                   "INSERT INTO chat_messages_fts (chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+                   "CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF body ON chat_messages BEGIN "
+                   "INSERT INTO chat_messages_fts (chat_messages_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+                   "INSERT INTO chat_messages_fts (rowid, body) VALUES (new.id, new.body); END",
+                   "INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')")
+        try:
+            for query in queries:
+                self.db.queryAll(query)
+        except Exception, e:
+            BlinkLogger().log_error(u"Full text search for table %s is not available: %s" % (ChatMessage.sqlmeta.table, e))
+            self._drop_fts_index()
+        else:
+            BlinkLogger().log_debug(u"Created full text search index for table %s" % ChatMessage.sqlmeta.table)
+
+    def _drop_fts_index(self):
+        # Caller needs to be in the db thread
+        for query in ("DROP TRIGGER IF EXISTS chat_messages_fts_insert", "DROP TRIGGER IF EXISTS chat_messages_fts_delete", "DROP TRIGGER IF EXISTS chat_messages_fts_update", "DROP TABLE IF EXISTS chat_messages_fts"):
+            try:
+                self.db.queryAll(query)
+            except Exception:
+                pass
+
+    def _fts_match_expression(self, search_text):
+        # A phrase of trigrams matches the text anywhere in the body, like LIKE '%text%' does.
+        # Shorter text has no trigram to look up and is searched with LIKE
+        if self.fts_available and len(search_text) >= 3:
+            return '"%s"' % search_text.replace('"', '""')
+        return None
+
+    def _where_search_text(self, query, search_text):
+        match = self._fts_match_expression(search_text)
+        if match is not None:
+            return query.where("id in (select rowid from chat_messages_fts where chat_messages_fts match ?)", match)
+        return query.where("body like ?", '%'+search_text+'%')
+
     @allocate_autorelease_pool
     def _migrate_version(self, previous_version):
         if previous_version is None:
@@ -574,11 +913,15 @@ class ChatHistory(object):
                 if not str(e).startswith('duplicate column name'):
                     BlinkLogger().log_error(u"Error adding column uuid to table %s: %s" % (ChatMessage.sqlmeta.table, e))
 
+        if next_upgrade_version < 6:
+            self._create_indexes()
+            self._create_fts_index()
 
         TableVersions().set_table_version(ChatMessage.sqlmeta.table, self.__version__)
 
     @run_in_db_thread
     def add_message(self, msgid, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, time='', uuid='', journal_id='', skip_replication=False, call_id='', encryption=''):
+        journal_entry = None
         try:
             if not journal_id and not skip_replication:
                 settings = SIPSimpleSettings()
@@ -603,9 +946,6 @@ class ChatHistory(object):
                     'call_id'             : call_id,
                     'encryption'          : encryption
                 }
-
-                notification_center = NotificationCenter()
-                notification_center.post_notification('ChatReplicationJournalEntryAdded', sender=self, data=NotificationData(entry=journal_entry))
             else:
                 try:
                     time_entry = datetime.strptime(time, "%Y-%m-%d %H:%M:%S")
@@ -657,8 +997,88 @@ class ChatHistory(object):
                 BlinkLogger().log_error(u"Error updating record %s: %s" % (msgid, e))
         except Exception, e:
             BlinkLogger().log_error(u"Error adding record %s to history table: %s" % (msgid, e))
+        finally:
+            # the replication journal is written once the message is in history, its errors must not affect it
+            if journal_entry is not None:
+                try:
+                    NotificationCenter().post_notification('ChatReplicationJournalEntryAdded', sender=self, data=NotificationData(entry=journal_entry))
+                except Exception, e:
+                    BlinkLogger().log_error(u"Error adding record %s to chat replication journal: %s" % (msgid, e))
         return False
 
+    @run_in_db_thread
+    def add_messages(self, entries):
+        # Bulk insert of messages that are already journaled, like the ones received from the
+        # chat history server. Entries are dictionaries with the same keys as a replication
+        # journal entry plus optional 'uuid' and 'journal_id'. All rows are written in one
+        # transaction, an existing message only gets its status and journal id updated.
+        # Returns a list with the outcome of each entry, in the same order: 'inserted',
+        # 'updated' or None if the entry could not be saved
+        columns = ('msgid', 'sip_callid', 'sip_fromtag', 'sip_totag', 'time', 'date', 'media_type', 'direction', 'local_uri', 'remote_uri', 'cpim_from', 'cpim_to', 'cpim_timestamp', 'body', 'content_type', 'private', 'status', 'uuid', 'journal_id', 'encryption')
+        query = "INSERT INTO chat_messages (%s) VALUES (%s)" % (", ".join(columns), ", ".join('?' for column in columns))
+        upsert_supported = self.db.module.sqlite_version_info >= (3, 24, 0)
+        if upsert_supported:
+            query += " ON CONFLICT (msgid, local_uri, remote_uri) DO UPDATE SET status = excluded.status, journal_id = excluded.journal_id"
+        else:
+            query = query.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+            update_query = "UPDATE chat_messages SET status = ?, journal_id = ? WHERE msgid = ? AND local_uri = ? AND remote_uri = ?"
+
+        rows = []
+        for entry in entries:
+            try:
+                time_entry = datetime.strptime(entry['time'], "%Y-%m-%d %H:%M:%S")
+            except (KeyError, TypeError, ValueError):
+                time_entry = datetime.utcnow()
+            try:
+                rows.append((entry['msgid'], entry.get('call_id', ''), '', '', time_entry.strftime("%Y-%m-%d %H:%M:%S"), time_entry.strftime("%Y-%m-%d"),
+                             entry['media_type'], entry['direction'], entry['local_uri'], entry['remote_uri'], entry['cpim_from'], entry['cpim_to'],
+                             entry['cpim_timestamp'], entry['body'], entry['content_type'], entry['private'], entry['status'],
+                             entry.get('uuid', ''), entry.get('journal_id', ''), entry.get('encryption', '')))
+            except KeyError, e:
+                BlinkLogger().log_error(u"Error adding record to history table, missing %s" % e)
+                rows.append(None)
+
+        results = []
+        conn = self.db.getConnection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            # new rows get ids above all the existing ones, an upsert that updates a row leaves lastrowid unchanged
+            last_id = cursor.execute("SELECT max(id) FROM chat_messages").fetchone()[0] or 0
+            for row in rows:
+                if row is None:
+                    results.append(None)
+                    continue
+                try:
+                    cursor.execute(query, row)
+                    if upsert_supported:
+                        if cursor.lastrowid > last_id:
+                            last_id = cursor.lastrowid
+                            result = 'inserted'
+                        else:
+                            result = 'updated'
+                    elif cursor.rowcount == 0:
+                        cursor.execute(update_query, (row[16], row[18], row[0], row[8], row[9]))
+                        result = 'updated' if cursor.rowcount else None
+                    else:
+                        result = 'inserted'
+                except self.db.module.Error, e:
+                    BlinkLogger().log_error(u"Error adding record %s to history table: %s" % (row[0], e))
+                    results.append(None)
+                else:
+                    results.append(result)
+            cursor.execute("COMMIT")
+        except self.db.module.Error, e:
+            BlinkLogger().log_error(u"Error adding %d records to history table: %s" % (len(rows), e))
+            try:
+                conn.cursor().execute("ROLLBACK")
+            except self.db.module.Error:
+                pass
+            results = [None] * len(rows)
+        finally:
+            self.db.releaseConnection(conn)
+        return results
+
     @run_in_db_thread
     def update_from_journal_put_results(self, msgid, journal_id):
         try:
@@ -671,28 +1091,37 @@ class ChatHistory(object):
             return False
 
     @run_in_db_thread
+    def update_messages_status(self, ids, status):
+        # Rows returned by the lookups come from the read-only connections, their status
+        # can only be changed here
+        ids = list(ids)
+        if not ids:
+            return True
+        try:
+            # Older SQLite versions accept at most 999 parameters for a statement
+            for index in xrange(0, len(ids), 500):
+                SQLQuery("update chat_messages set status = ?", status).where_in("id", ids[index:index+500]).execute(self.db)
+        except Exception, e:
+            BlinkLogger().log_error(u"Error updating status of %d messages: %s" % (len(ids), e))
+            return False
+        return True
+
+    @run_in_db_read_thread
     def _get_contacts(self, remote_uri, media_type, search_text, after_date, before_date):
-        query = "select distinct(remote_uri) from chat_messages where local_uri <> 'bonjour'"
+        query = SQLQuery("select distinct(remote_uri) from chat_messages").where("local_uri <> ?", 'bonjour')
         if remote_uri:
-            if remote_uri is not tuple:
-                remote_uri = (remote_uri,)
-            remote_uri_sql = ""
-            for uri in remote_uri:
-                remote_uri_sql += '%s,' % ChatMessage.sqlrepr(uri)
-            remote_uri_sql = remote_uri_sql.rstrip(",)")
-            remote_uri_sql = remote_uri_sql.lstrip("(")
-            query += " and remote_uri in (%s)" % remote_uri_sql
+            query.where_in("remote_uri", remote_uri)
         if media_type:
-            query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
+            query.where("media_type = ?", media_type)
         if search_text:
-            query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+            self._where_search_text(query, search_text)
         if after_date:
-            query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
+            query.where("date >= ?", after_date)
         if before_date:
-            query += " and date < %s" % ChatMessage.sqlrepr(before_date)
-        query += " order by remote_uri asc"
+            query.where("date < ?", before_date)
+        query.append("order by remote_uri asc")
         try:
-            return list(self.db.queryAll(query))
+            return query.execute(self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting contacts from chat history table: %s" % e)
             return []
@@ -700,64 +1129,40 @@ class ChatHistory(object):
     def get_contacts(self, remote_uri=None, media_type=None, search_text=None, after_date=None, before_date=None):
         return block_on(self._get_contacts(remote_uri, media_type, search_text, after_date, before_date))
 
-    @run_in_db_thread
+    @run_in_db_read_thread
     def _get_daily_entries(self, local_uri, remote_uri, media_type, search_text, order_text, after_date, before_date):
+        # the order is part of the SQL text, only the selected columns and directions are allowed in it
+        order_text = order_text or "date DESC"
+        for item in order_text.split(","):
+            order = item.split()
+            if not order or order[0] not in ('date', 'local_uri', 'remote_uri', 'media_type') or len(order) > 2 or order[1:] and order[1].lower() not in ('asc', 'desc'):
+                BlinkLogger().log_error(u"Invalid order %s for chat history table" % order_text)
+                return []
+        query = SQLQuery("select date, local_uri, remote_uri, media_type from chat_messages")
         if remote_uri:
-            remote_uri_sql = ""
-            for uri in remote_uri:
-                remote_uri_sql += '%s,' % ChatMessage.sqlrepr(uri)
-            remote_uri_sql = remote_uri_sql.rstrip(",")
-            query = "select date, local_uri, remote_uri, media_type from chat_messages where remote_uri in (%s)" % remote_uri_sql
-            if media_type:
-                query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
-            if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
-            if after_date:
-                query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
-            if before_date:
-                query += " and date < %s" % ChatMessage.sqlrepr(before_date)
-
-            query += " group by date, media_type, remote_uri order by date desc, local_uri asc"
-
+            query.where_in("remote_uri", remote_uri)
         elif local_uri:
-            query = "select date, local_uri, remote_uri, media_type from chat_messages"
-            query += " where local_uri = %s" % ChatMessage.sqlrepr(local_uri)
-            if media_type:
-                query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
-            if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
-            if after_date:
-                query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
-            if before_date:
-                query += " and date < %s" % ChatMessage.sqlrepr(before_date)
-
-            query += " group by date, remote_uri, media_type, local_uri"
-
-            if order_text:
-                query += " order by %s" % order_text
-            else:
-                query += " order by date DESC"
+            query.where("local_uri = ?", local_uri)
+        if media_type:
+            query.where("media_type = ?", media_type)
+        if search_text:
+            self._where_search_text(query, search_text)
+        if after_date:
+            query.where("date >= ?", after_date)
+        if before_date:
+            query.where("date < ?", before_date)
 
+        if remote_uri:
+            query.append("group by date, media_type, remote_uri order by date desc, local_uri asc")
         else:
-            query = "select date, local_uri, remote_uri, media_type from chat_messages where 1=1"
-            if media_type:
-                query += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
-            if search_text:
-                query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
-            if after_date:
-                query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
-            if before_date:
-                query += " and date < %s" % ChatMessage.sqlrepr(before_date)
-
-            query += " group by date, local_uri, remote_uri, media_type"
-
-            if order_text:
-                query += " order by %s" % order_text
+            if local_uri:
+                query.append("group by date, remote_uri, media_type, local_uri")
             else:
-                query += " order by date DESC"
+                query.append("group by date, local_uri, remote_uri, media_type")
+            query.append("order by %s" % order_text)
 
         try:
-            return list(self.db.queryAll(query))
+            return query.execute(self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting daily entries from chat history table: %s" % e)
             return []
@@ -765,45 +1170,39 @@ class ChatHistory(object):
     def get_daily_entries(self, local_uri=None, remote_uri=None, media_type=None, search_text=None, order_text=None, after_date=None, before_date=None):
         return block_on(self._get_daily_entries(local_uri, remote_uri, media_type, search_text, order_text, after_date, before_date))
 
-    @run_in_db_thread
-    def _get_messages(self, msgid, call_id, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, orderBy, orderType, count):
-        query='1=1'
+    def _where_messages(self, query, msgid=None, call_id=None, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None):
         if msgid:
-            query += " and msgid=%s" % ChatMessage.sqlrepr(msgid)
+            query.where("msgid = ?", msgid)
         if call_id:
-            query += " and sip_callid=%s" % ChatMessage.sqlrepr(call_id)
+            query.where("sip_callid = ?", call_id)
         if local_uri:
-            query += " and local_uri=%s" % ChatMessage.sqlrepr(local_uri)
+            query.where("local_uri = ?", local_uri)
         if remote_uri:
-            if remote_uri is not tuple:
-                remote_uri = (remote_uri,)
-            remote_uri_sql = ""
-            for uri in remote_uri:
-                remote_uri_sql += '%s,' % ChatMessage.sqlrepr(uri)
-            remote_uri_sql = remote_uri_sql.rstrip(",)")
-            remote_uri_sql = remote_uri_sql.lstrip("(")
-            query += " and remote_uri in (%s)" % remote_uri_sql
+            query.where_in("remote_uri", remote_uri)
         if media_type:
-            if media_type is not tuple:
-                media_type = (media_type,)
-            media_type_sql = ""
-            for media in media_type:
-                media_type_sql += '%s,' % ChatMessage.sqlrepr(media)
-            media_type_sql = media_type_sql.rstrip(",)")
-            media_type_sql = media_type_sql.lstrip("(")
-            query += " and media_type in (%s)" % media_type_sql
+            query.where_in("media_type", media_type)
         if search_text:
-            query += " and body like %s" % ChatMessage.sqlrepr('%'+search_text+'%')
+            self._where_search_text(query, search_text)
         if date:
-            query += " and date like %s" % ChatMessage.sqlrepr(date+'%')
+            query.where("date = ?", date)
         if after_date:
-            query += " and date >= %s" % ChatMessage.sqlrepr(after_date)
+            query.where("date >= ?", after_date)
         if before_date:
-            query += " and date < %s" % ChatMessage.sqlrepr(before_date)
-        query += " order by %s %s limit %d" % (orderBy, orderType, count)
+            query.where("date < ?", before_date)
+        return query
+
+    @run_in_db_read_thread
+    def _get_messages(self, msgid, call_id, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, orderBy, orderType, count):
+        # the order is part of the SQL text, only column names and directions are allowed in it
+        if orderBy not in SQLQuery.columns(ChatMessage).split(", ") or orderType.lower() not in ('asc', 'desc'):
+            BlinkLogger().log_error(u"Invalid order %s %s for chat history table" % (orderBy, orderType))
+            return []
+        query = SQLQuery("select %s from chat_messages" % SQLQuery.columns(ChatMessage))
+        self._where_messages(query, msgid, call_id, local_uri, remote_uri, media_type, date, after_date, before_date, search_text)
+        query.append("order by %s %s limit ?" % (orderBy, orderType), count)
 
         try:
-            return list(ChatMessage.select(query))
+            return query.select(ChatMessage, self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting chat messages from chat history table: %s" % e)
             return []
@@ -811,55 +1210,108 @@ class ChatHistory(object):
     def get_messages(self, msgid=None, call_id=None, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None, orderBy='time', orderType='desc', count=100):
         return block_on(self._get_messages(msgid, call_id, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, orderBy, orderType, count))
 
+    @run_in_db_read_thread
+    def _get_message_rows(self, local_uri, remote_uri, media_type, date, after_date, before_date, search_text, before, count, msgid=None, after=None):
+        query = SQLQuery("select %s from chat_messages" % ChatMessageRow.columns)
+        self._where_messages(query, msgid=msgid, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, after_date=after_date, before_date=before_date, search_text=search_text)
+        if before is not None:
+            before_time, before_id = before
+            query.where("(time < ? or (time = ? and id < ?))", before_time, before_time, before_id)
+        if after is not None:
+            after_time, after_id = after
+            query.where("(time > ? or (time = ? and id > ?))", after_time, after_time, after_id)
+            query.append("order by time asc, id asc limit ?", count)
+        else:
+            query.append("order by time desc, id desc limit ?", count)
+
+        try:
+            rows = [ChatMessageRow.from_row(row) for row in query.execute(self.read_db)]
+        except Exception, e:
+            BlinkLogger().log_error(u"Error getting chat messages from chat history table: %s" % e)
+            return []
+        if after is not None:
+            rows.reverse()
+        return rows
+
+    def get_message_rows(self, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None, before=None, count=100, msgid=None, after=None):
+        # Returns ChatMessageRow tuples, newest first. Pages are keyed on (time, id): pass the
+        # position of the last row of a page as before to get the next, older, page, or the
+        # position of the first row as after to get the newer page
+        return block_on(self._get_message_rows(local_uri, remote_uri, media_type, date, after_date, before_date, search_text, before, count, msgid, after))
+
+    def iter_message_rows(self, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, search_text=None, before=None, chunk_size=100):
+        # Yields chunks of ChatMessageRow tuples going back in time, without querying again from the start
+        while True:
+            rows = self.get_message_rows(local_uri, remote_uri, media_type, date, after_date, before_date, search_text, before, chunk_size)
+            if rows:
+                yield rows
+            if len(rows) < chunk_size:
+                break
+            before = rows[-1].position
+
+    @run_in_db_read_thread
+    def _search_messages(self, search_text, local_uri, remote_uri, media_type, date, after_date, before_date, count):
+        match = self._fts_match_expression(search_text)
+        if match is None:
+            query = SQLQuery("select %s from chat_messages" % ChatMessageRow.columns)
+            self._where_messages(query, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, after_date=after_date, before_date=before_date, search_text=search_text)
+            query.append("order by time desc, id desc limit ?", count)
+        else:
+            query = SQLQuery("select %s from chat_messages join (select rowid, rank from chat_messages_fts where chat_messages_fts match ?) as matches on chat_messages.id = matches.rowid" % ChatMessageRow.columns, match)
+            self._where_messages(query, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, after_date=after_date, before_date=before_date)
+            query.append("order by matches.rank limit ?", count)
+
+        try:
+            return [ChatMessageRow.from_row(row) for row in query.execute(self.read_db)]
+        except Exception, e:
+            BlinkLogger().log_error(u"Error searching chat history table: %s" % e)
+            return []
+
+    def search_messages(self, search_text, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None, count=100):
+        # Returns ChatMessageRow tuples, best matches first. Without the full text index
+        # the most recent matches come first
+        return block_on(self._search_messages(search_text, local_uri, remote_uri, media_type, date, after_date, before_date, count))
+
     @run_in_db_thread
     def delete_journaled_messages(self, account, journal_ids, after_date):
         # TODO
         return
-        journal_id_sql = ""
-        for journal_id in journal_ids:
-             journal_id_sql += '%s,' % ChatMessage.sqlrepr(journal_id)
-             journal_id_sql = journal_id_sql.rstrip(",")
-
-        query = "delete from chat_messages where local_uri=%s and journal_id != '' and journal_id not in (%s) and date >= %s" % (ChatMessage.sqlrepr(account), journal_id_sql, ChatMessage.sqlrepr(after_date))
+        journal_ids = list(journal_ids)
+        query = SQLQuery("delete from chat_messages").where("local_uri = ?", account).where("journal_id != ?", '')
+        query.where("journal_id not in (%s)" % ", ".join("?" * len(journal_ids)), *journal_ids).where("date >= ?", after_date)
 
         try:
-            self.db.queryAll(query)
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error deleting messages from chat history table: %s" % e)
 
     @run_in_db_thread
     def delete_messages(self, local_uri=None, remote_uri=None, media_type=None, date=None, after_date=None, before_date=None):
-        where =  " where 1=1 "
-        if local_uri:
-            where += " and local_uri=%s" % ChatMessage.sqlrepr(local_uri)
-        if remote_uri:
-            if remote_uri is not tuple:
-                remote_uri = (remote_uri,)
-            remote_uri_sql = ""
-            for uri in remote_uri:
-                remote_uri_sql += '%s,' % ChatMessage.sqlrepr(uri)
-            remote_uri_sql = remote_uri_sql.rstrip(",)")
-            remote_uri_sql = remote_uri_sql.lstrip("(")
-            where += " and remote_uri in (%s)" % remote_uri_sql
-        if media_type:
-             where += " and media_type = %s" % ChatMessage.sqlrepr(media_type)
-        if date:
-             where += " and date = %s" % ChatMessage.sqlrepr(date)
-        if after_date:
-            where += " and date >= %s" % ChatMessage.sqlrepr(after_date)
-        if before_date:
-            where += " and date < %s" % ChatMessage.sqlrepr(before_date)
+        def messages_query(statement):
+            query = SQLQuery(statement)
+            if local_uri:
+                query.where("local_uri = ?", local_uri)
+            if remote_uri:
+                query.where_in("remote_uri", remote_uri)
+            if media_type:
+                query.where("media_type = ?", media_type)
+            if date:
+                query.where("date = ?", date)
+            if after_date:
+                query.where("date >= ?", after_date)
+            if before_date:
+                query.where("date < ?", before_date)
+            return query
+
         try:
-            query = "select journal_id, local_uri from chat_messages %s and journal_id != ''" % where
-            entries = list(self.db.queryAll(query))
+            query = messages_query("select journal_id, local_uri from chat_messages").where("journal_id != ?", '')
+            entries = query.execute(self.db)
             NotificationCenter().post_notification('ChatReplicationJournalEntryDeleted', sender=self, data=NotificationData(entries=entries))
-            query = "delete from chat_messages %s" % where
-            self.db.queryAll(query)
+            messages_query("delete from chat_messages").execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error deleting messages from chat history table: %s" % e)
             return False
         else:
-            self.db.queryAll('vacuum')
             return True
 
 class FileTransfer(SQLObject):
@@ -893,6 +1345,8 @@ class FileTransferHistory(object):
         makedirs(path)
         db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
         TableVersions()    # initialize versions table
+        self.initialized = Event()
+        self.read_db = read_connection_for_uri(db_uri)
         self._initialize(db_uri)
 
     @run_in_db_thread
@@ -914,6 +1368,8 @@ class FileTransferHistory(object):
         except Exception, e:
             BlinkLogger().log_error(u"Error checking history table %s: %s" % (FileTransfer.sqlmeta.table, e))
 
+        self.initialized.set()
+
     @allocate_autorelease_pool
     def _migrate_version(self, previous_version):
         if previous_version is None:
@@ -968,10 +1424,11 @@ class FileTransferHistory(object):
             BlinkLogger().log_error(u"Error adding record %s to history table: %s" % (transfer_id, e))
         return False
 
-    @run_in_db_thread
+    @run_in_db_read_thread
     def _get_transfers(self, limit):
         try:
-            return list(FileTransfer.select(orderBy=DESC(FileTransfer.q.id), limit=limit))
+            query = SQLQuery("select %s from file_transfers" % SQLQuery.columns(FileTransfer)).append("order by id desc limit ?", limit)
+            return query.select(FileTransfer, self.read_db)
         except Exception, e:
             BlinkLogger().log_error(u"Error getting transfers from history table: %s" % e)
             return []
@@ -981,17 +1438,123 @@ class FileTransferHistory(object):
 
     @run_in_db_thread
     def delete_transfers(self):
-        query = "delete from file_transfers"
+        query = SQLQuery("delete from file_transfers")
         try:
-            self.db.queryAll(query)
+            query.execute(self.db)
         except Exception, e:
             BlinkLogger().log_error(u"Error deleting transfers from history table: %s" % e)
             return False
         else:
-            self.db.queryAll('vacuum')
             return True
 
 
+class FileChecksum(SQLObject):
+    class sqlmeta:
+        table = 'file_checksums'
+    file_path         = UnicodeCol()
+    inode             = IntCol()
+    file_size         = IntCol()
+    mtime             = FloatCol()
+    hash              = StringCol()
+    last_used         = FloatCol()
+    path_idx          = DatabaseIndex('file_path', unique=True)
+
+
+class FileChecksumCache(object):
+    """SHA-1 checksums of the files sent, keyed by path and validated by inode, size and modification time"""
+
+    __metaclass__ = Singleton
+    __version__ = 1
+
+    # least recently used entries are evicted above this size
+    max_entries = 1000
+
+    def __init__(self):
+        path = ApplicationData.get('history')
+        makedirs(path)
+        db_uri = "sqlite://" + os.path.join(path,"history.sqlite")
+        TableVersions()    # initialize versions table
+        self.initialized = Event()
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._initialize(db_uri)
+
+    @run_in_db_thread
+    def _initialize(self, db_uri):
+        self.db = connectionForURI(db_uri)
+        FileChecksum._connection = self.db
+
+        try:
+            if not FileChecksum.tableExists():
+                FileChecksum.createTable()
+                TableVersions().set_table_version(FileChecksum.sqlmeta.table, self.__version__)
+                BlinkLogger().log_debug(u"Created file checksums table %s" % FileChecksum.sqlmeta.table)
+            results = list(FileChecksum.select(orderBy='last_used').reversed()[:self.max_entries])
+        except Exception, e:
+            BlinkLogger().log_error(u"Error loading file checksums table %s: %s" % (FileChecksum.sqlmeta.table, e))
+        else:
+            with self.lock:
+                for result in reversed(results):
+                    self.entries[result.file_path] = (result.inode, result.file_size, result.mtime, result.hash)
+
+        self.initialized.set()
+
+    def get(self, file_path, stat):
+        # Returns the hex digest of the file if it did not change since it was computed
+        self.initialized.wait()
+        with self.lock:
+            try:
+                entry = self.entries.pop(file_path)
+            except KeyError:
+                entry = None
+            else:
+                self.entries[file_path] = entry
+            if entry is None or entry[:3] != (stat.st_ino, stat.st_size, stat.st_mtime):
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._touch(file_path, time.time())
+        return entry[3]
+
+    def put(self, file_path, stat, hash):
+        self.initialized.wait()
+        evicted = []
+        with self.lock:
+            self.entries.pop(file_path, None)
+            self.entries[file_path] = (stat.st_ino, stat.st_size, stat.st_mtime, hash)
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[0])
+        self._store(file_path, stat.st_ino, stat.st_size, stat.st_mtime, hash, time.time(), evicted)
+
+    @property
+    def stats(self):
+        with self.lock:
+            return NotificationData(hits=self.hits, misses=self.misses, entries=len(self.entries))
+
+    @run_in_db_thread
+    def _store(self, file_path, inode, file_size, mtime, hash, last_used, evicted):
+        self._execute([("INSERT OR REPLACE INTO file_checksums (file_path, inode, file_size, mtime, hash, last_used) VALUES (?, ?, ?, ?, ?, ?)", (file_path, inode, file_size, mtime, hash, last_used))] +
+                      [("DELETE FROM file_checksums WHERE file_path = ?", (path,)) for path in evicted])
+
+    @run_in_db_thread
+    def _touch(self, file_path, last_used):
+        self._execute([("UPDATE file_checksums SET last_used = ? WHERE file_path = ?", (last_used, file_path))])
+
+    def _execute(self, statements):
+        # Caller needs to be in the db thread
+        conn = self.db.getConnection()
+        try:
+            cursor = conn.cursor()
+            for query, parameters in statements:
+                cursor.execute(query, parameters)
+        except self.db.module.Error, e:
+            BlinkLogger().log_error(u"Error updating file checksums table: %s" % e)
+        finally:
+            self.db.releaseConnection(conn)
+
+
 class SessionHistoryReplicator(object):
     implements(IObserver)
 
@@ -1140,6 +1703,8 @@ class SessionHistoryReplicator(object):
 
         notification_center = NotificationCenter()
         growl_notifications = {}
+        chat_entries = []
+        logged_calls = []
         try:
             if calls['received']:
                 for call in calls['received']:
@@ -1204,8 +1769,8 @@ class SessionHistoryReplicator(object):
                                 message += '<p>Call duration: %s' % duration
                                 #message += '<h4>Technicall Information</h4><table class=table_session_info><tr><td class=td_session_info>Call Id</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>From Tag</td><td class=td_session_info>%s</td></tr><tr><td class=td_session_info>To Tag</td><td class=td_session_info>%s</td></tr></table>' % (call_id, from_tag, to_tag)
                                 media_type = 'audio'
-                            self.sessionControllersManager.add_to_chat_history(id, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status, skip_replication=True)
-                            notification_center.post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction=direction, history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=bool(media_type =='missed-call')))
+                            chat_entries.append({'msgid': id, 'media_type': media_type, 'local_uri': local_uri, 'remote_uri': remote_uri, 'direction': direction, 'cpim_from': cpim_from, 'cpim_to': cpim_to, 'cpim_timestamp': timestamp, 'body': message, 'content_type': 'html', 'private': '0', 'status': status})
+                            logged_calls.append(NotificationData(direction=direction, history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=bool(media_type =='missed-call')))
 
                         if 'audio' in call['media'] and success == 'missed' and remote_uri not in growl_notifications.keys():
                             elapsed = end_time - start_time
@@ -1304,8 +1869,8 @@ class SessionHistoryReplicator(object):
                                 duration = self.sessionControllersManager.get_printed_duration(start_time, end_time)
                                 message= '<h3>Outgoing Audio Call</h3>'
                                 message += '<p>Call duration: %s' % duration
-                            self.sessionControllersManager.add_to_chat_history(id, media_type, local_uri, remote_uri, direction, cpim_from, cpim_to, timestamp, message, status, skip_replication=True)
-                            NotificationCenter().post_notification('AudioCallLoggedToHistory', sender=self, data=NotificationData(direction='outgoing', history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=False))
+                            chat_entries.append({'msgid': id, 'media_type': media_type, 'local_uri': local_uri, 'remote_uri': remote_uri, 'direction': direction, 'cpim_from': cpim_from, 'cpim_to': cpim_to, 'cpim_timestamp': timestamp, 'body': message, 'content_type': 'html', 'private': '0', 'status': status})
+                            logged_calls.append(NotificationData(direction='outgoing', history_entry=False, remote_party=remote_uri, local_party=local_uri, check_contact=True, missed=False))
         except (KeyError, ValueError):
             pass
         except Exception, e:
@@ -1313,6 +1878,15 @@ class SessionHistoryReplicator(object):
             import traceback
             print traceback.print_exc()
 
+        if chat_entries:
+            results = block_on(ChatHistory().add_messages(chat_entries))
+            failed = results.count(None)
+            if failed:
+                BlinkLogger().log_error(u"Failed to save %d of %d calls history entries of %s to chat history" % (failed, len(chat_entries), account.id))
+
+        # the calls are notified once their chat history entries are saved
+        for data in logged_calls:
+            NotificationCenter().post_notification('AudioCallLoggedToHistory', sender=self, data=data)
 
     # NSURLConnection delegate method
     def connection_didReceiveAuthenticationChallenge_(self, connection, challenge):
@@ -1336,6 +1910,99 @@ class SessionHistoryReplicator(object):
                     challenge.sender().useCredential_forAuthenticationChallenge_(credential, challenge)
 
 
+class ReplicationJournalLog(object):
+    """Append-only log of the entries waiting to be replicated"""
+
+    # appended records are flushed right away but synced to disk at most this often
+    sync_interval = 2.0
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.last_sync = 0
+        self.sync_pending = False
+        self.sync_timer = None
+        # records are appended from the db-ops thread while the log is compacted from the main thread,
+        # callers hold it while they change the entries the records come from
+        self.lock = RLock()
+
+    def replay(self):
+        records = []
+        try:
+            f = open(self.filename, 'r')
+        except IOError:
+            return records
+        with f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    records.append(cjson.decode(line.strip()))
+                except cjson.DecodeError:
+                    # records are only lost if we got interrupted while writing them, the rest are still good
+                    BlinkLogger().log_error(u"Skipped corrupted record at line %d of chat replication journal %s" % (line_number, self.filename))
+        return records
+
+    def append(self, *record):
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.file = open(self.filename, 'a')
+                self.file.write(cjson.encode(record) + '\n')
+                self.file.flush()
+                if time.time() - self.last_sync >= self.sync_interval:
+                    self._sync()
+                else:
+                    self.sync_pending = True
+                    if self.sync_timer is None:
+                        self.sync_timer = Timer(self.sync_interval, self._sync_pending_records)
+                        self.sync_timer.daemon = True
+                        self.sync_timer.start()
+            except (TypeError, ValueError, cjson.EncodeError, IOError, OSError), e:
+                BlinkLogger().log_error(u"Error writing to chat replication journal %s: %s" % (self.filename, e))
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def _sync_pending_records(self):
+        with self.lock:
+            self.sync_timer = None
+            if self.sync_pending:
+                self._sync()
+
+    def _sync(self):
+        # Caller needs to hold the lock
+        if self.file is None:
+            return
+        try:
+            os.fsync(self.file.fileno())
+        except OSError, e:
+            BlinkLogger().log_error(u"Error syncing chat replication journal %s: %s" % (self.filename, e))
+        self.last_sync = time.time()
+        self.sync_pending = False
+
+    def compact(self, get_records):
+        # replace the log with the records returned by get_records, the new log is written aside and
+        # renamed over the old one. The records are taken with the lock held, so no record is appended
+        # to the old log after they were taken
+        tmp_filename = self.filename + '.tmp'
+        with self.lock:
+            records = list(get_records())
+            try:
+                with open(tmp_filename, 'w') as f:
+                    for record in records:
+                        f.write(cjson.encode(record) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                os.rename(tmp_filename, self.filename)
+            except (TypeError, ValueError, cjson.EncodeError, IOError, OSError), e:
+                BlinkLogger().log_error(u"Error compacting chat replication journal %s: %s" % (self.filename, e))
+            else:
+                self.sync_pending = False
+
+
 class ChatHistoryReplicator(object):
     __metaclass__ = Singleton
     implements(IObserver)
@@ -1403,6 +2070,7 @@ class ChatHistoryReplicator(object):
             except shutil.Error:
                 pass
 
+        # journals saved by previous versions are migrated to the append-only logs
         try:
             with open(ApplicationData.get('chat_replication/chat_replication_journal.pickle'), 'r') as f:
                 self.outgoing_entries = cPickle.load(f)
@@ -1415,6 +2083,21 @@ class ChatHistoryReplicator(object):
         except Exception:
             pass
 
+        self.journal_log = ReplicationJournalLog(ApplicationData.get('chat_replication/chat_replication_journal.log'))
+        for account, msgid, entry in self.journal_log.replay():
+            self.outgoing_entries.setdefault(account, {})[msgid] = entry
+
+        self.delete_journal_log = ReplicationJournalLog(ApplicationData.get('chat_replication/chat_replication_delete_journal.log'))
+        for account, journal_id in self.delete_journal_log.replay():
+            self.for_delete_entries.setdefault(account, set()).add(journal_id)
+
+        pickle_paths = [ApplicationData.get('chat_replication/chat_replication_journal.pickle'), ApplicationData.get('chat_replication/chat_replication_delete_journal.pickle')]
+        if any(os.path.exists(pickle_path) for pickle_path in pickle_paths):
+            self.save_journal_on_disk()
+            self.save_delete_journal_on_disk()
+            for pickle_path in pickle_paths:
+                unlink(pickle_path)
+
         try:
             with open(ApplicationData.get('chat_replication/chat_replication_timestamp.pickle'), 'r') as f:
                 self.last_journal_timestamp = cPickle.load(f)
@@ -1426,18 +2109,10 @@ class ChatHistoryReplicator(object):
         NSRunLoop.currentRunLoop().addTimer_forMode_(self.timer, NSEventTrackingRunLoopMode)
 
     def save_delete_journal_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_delete_journal.pickle')
-        try:
-            cPickle.dump(self.for_delete_entries, open(storage_path, "w+"))
-        except (cPickle.PickleError, IOError):
-            pass
+        self.delete_journal_log.compact(lambda: ((account, journal_id) for account, journal_ids in self.for_delete_entries.iteritems() for journal_id in journal_ids))
 
     def save_journal_on_disk(self):
-        storage_path = ApplicationData.get('chat_replication/chat_replication_journal.pickle')
-        try:
-            cPickle.dump(self.outgoing_entries, open(storage_path, "w+"))
-        except (cPickle.PickleError, IOError):
-            pass
+        self.journal_log.compact(lambda: ((account, msgid, entry) for account, entries in self.outgoing_entries.iteritems() for msgid, entry in entries.iteritems()))
 
     def save_journal_timestamp_on_disk(self):
         storage_path = ApplicationData.get('chat_replication/chat_replication_timestamp.pickle')
@@ -1478,8 +2153,9 @@ class ChatHistoryReplicator(object):
                 if acc.chat.disable_replication:
                     continue
 
-                self.for_delete_entries.setdefault(account, set())
-                self.for_delete_entries[account].add(journal_id)
+                with self.delete_journal_log.lock:
+                    self.for_delete_entries.setdefault(account, set()).add(journal_id)
+                    self.delete_journal_log.append(account, journal_id)
                 BlinkLogger().log_debug(u"Scheduling deletion of chat journal id %s for account %s" % (journal_id, account))
 
     def _NH_ChatReplicationJournalEntryAdded(self, sender, data):
@@ -1488,8 +2164,6 @@ class ChatHistoryReplicator(object):
         except KeyError:
             return
 
-        self.outgoing_entries.setdefault(account, {})
-
         try:
             acc = AccountManager().get_account(account)
         except KeyError:
@@ -1513,9 +2187,11 @@ class ChatHistoryReplicator(object):
                     BlinkLogger().log_debug(u"Failed to encrypt replication data for %s: %s" % (account, e))
                     return
 
-                self.outgoing_entries[account][data.entry['msgid']] = {'data': entry,
-                                                                       'id'   : data.entry['msgid']
-                                                                      }
+                with self.journal_log.lock:
+                    self.outgoing_entries.setdefault(account, {})[data.entry['msgid']] = {'data': entry,
+                                                                                          'id'   : data.entry['msgid']
+                                                                                         }
+                    self.journal_log.append(account, data.entry['msgid'], self.outgoing_entries[account][data.entry['msgid']])
 
     def _NH_CFGSettingsObjectDidChange(self, sender, data):
         if isinstance(sender, Account) and sender.enabled:
@@ -1642,6 +2318,7 @@ class ChatHistoryReplicator(object):
             return
 
         notify_data = {}
+        history_entries = []
         for entry in results:
             try:
                 data           = entry['data']
@@ -1660,6 +2337,7 @@ class ChatHistoryReplicator(object):
             except KeyError:
                 BlinkLogger().log_debug(u"Failed to parse chat history server results for %s" % account)
                 self.disableReplication(account)
+                self.saveRemoteJournalEntries(history_entries, account)
                 return
 
             if replication_password:
@@ -1688,8 +2366,10 @@ class ChatHistoryReplicator(object):
                     except KeyError:
                         data['encryption'] = ''
 
-                    ChatHistory().add_message(data['msgid'], data['media_type'], data['local_uri'], data['remote_uri'], data['direction'], data['cpim_from'], data['cpim_to'], data['cpim_timestamp'], data['body'], data['content_type'], data['private'], data['status'], time=data['time'], uuid=uuid, journal_id=journal_id, call_id=data['call_id'], encryption=data['encryption'])
-
+                    history_entry = dict((key, data[key]) for key in ('msgid', 'media_type', 'local_uri', 'remote_uri', 'direction', 'cpim_from', 'cpim_to', 'cpim_timestamp', 'body', 'content_type', 'private', 'status', 'time', 'call_id', 'encryption'))
+                    history_entry['uuid'] = uuid
+                    history_entry['journal_id'] = journal_id
+                    history_entries.append(history_entry)
 
                     start_time = datetime.strptime(data['time'], "%Y-%m-%d %H:%M:%S")
                     elapsed = datetime.utcnow() - start_time
@@ -1715,8 +2395,11 @@ class ChatHistoryReplicator(object):
 
                 except KeyError:
                     BlinkLogger().log_debug(u"Failed to apply chat history server journal to local chat history database for %s" % account)
+                    self.saveRemoteJournalEntries(history_entries, account)
                     return
 
+        self.saveRemoteJournalEntries(history_entries, account)
+
         if notify_data:
             for key in notify_data.keys():
                 log_text = '%d new chat messages for %s retrieved from chat history server' % (notify_data[key], key)
@@ -1724,6 +2407,15 @@ class ChatHistoryReplicator(object):
         else:
             BlinkLogger().log_debug('Local chat history is in sync with chat history server for %s' % account)
 
+    def saveRemoteJournalEntries(self, entries, account):
+        if not entries:
+            return
+        results = block_on(ChatHistory().add_messages(entries))
+        failed = results.count(None)
+        if failed:
+            BlinkLogger().log_error(u"Failed to save %d of %d chat history server journal entries for %s" % (failed, len(entries), account))
+        BlinkLogger().log_debug(u"Saved %d new and %d updated chat history server journal entries for %s" % (results.count('inserted'), results.count('updated'), account))
+
     @allocate_autorelease_pool
     @run_in_gui_thread
     def updateTimer_(self, timer):
@@ -1886,6 +2578,8 @@ class ChatHistoryReplicator(object):
                             pass
                 except KeyError:
                     pass
+                else:
+                    self.save_journal_on_disk()
 
                 try:
                     del self.connections_for_outgoing_replication[key]
@@ -1954,6 +2648,8 @@ class ChatHistoryReplicator(object):
                             self.for_delete_entries[account.id].discard(entry)
                     except KeyError:
                         pass
+                    else:
+                        self.save_delete_journal_on_disk()
 
                     try:
                         del self.connections_for_delete_replication[key]
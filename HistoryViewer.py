@@ -393,7 +393,12 @@ class HistoryViewer(NSWindowController):
             if not before_date:
                 before_date = self.before_date if self.before_date else None
 
-            results = self.chat_history.get_messages(count=count, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, search_text=search_text, after_date=after_date, before_date=before_date)
+            if search_text:
+                # the best matches are kept when there are more than count, shown in the order they were written
+                results = self.chat_history.search_messages(search_text, count=count, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, after_date=after_date, before_date=before_date)
+                results.sort(key=lambda row: row.position, reverse=True)
+            else:
+                results = self.chat_history.get_message_rows(count=count, local_uri=local_uri, remote_uri=remote_uri, media_type=media_type, date=date, after_date=after_date, before_date=before_date)
 
             # cache message for pagination
             self.messages=[]
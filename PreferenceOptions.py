@@ -1864,6 +1864,7 @@ PreferenceOptionTypes = {
 "logs.trace_msrp_in_gui": HiddenOption,
 "logs.trace_sip": HiddenOption,
 "logs.trace_sip_in_gui": HiddenOption,
+"logs.trace_in_gui_buffer_size": HiddenOption,
 "msrp.connection_model" : HiddenOption,
 "nat_traversal.stun_server_list" : STUNServerAddressListOption,
 "rtp.use_srtp_without_tls" : HiddenOption,
@@ -119,6 +119,7 @@ class PresencePublisher(object):
 
     user_input = {'state': 'active', 'last_input': None}
     idle_mode = False
+    user_idle = False
     last_input = ISOTimestamp.now()
     last_time_offset = int(pidf.TimeOffset())
     hostname = socket.gethostname().split(".")[0]
@@ -284,6 +285,11 @@ class PresencePublisher(object):
         if self.previous_idle_counter > last_idle_counter:
             self.last_input = ISOTimestamp.now()
 
+        user_idle = last_idle_counter > SIPSimpleSettings().gui.idle_threshold
+        if user_idle != self.user_idle:
+            self.user_idle = user_idle
+            NotificationCenter().post_notification('BlinkUserBecameIdle' if user_idle else 'BlinkUserBecameActive', sender=self)
+
         selected_item = self.owner.presenceActivityPopUp.selectedItem()
         if selected_item is None:
             return
@@ -63,6 +63,9 @@ from util import allocate_autorelease_pool, format_identity_to_string, sipuri_co
 
 MAX_MESSAGE_LENGTH = 1300
 
+# history messages are sent to the chat view in chunks of this size
+HISTORY_RENDER_CHUNK_SIZE = 250
+
 
 class MessageInfo(object):
     def __init__(self, msgid, call_id='', direction='outgoing', sender=None, recipient=None, timestamp=None, text=None, content_type=None, status=None, encryption='', otr=False):
@@ -887,9 +890,9 @@ class SMSViewController(NSObject):
                 self.zoom_period_label = NSLocalizedString("Displaying all messages", "Label")
                 self.chatViewController.setHandleScrolling_(False)
 
-            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=10000, search_text=self.chatViewController.search_text)
+            results = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), after_date=after_date, count=10000, search_text=self.chatViewController.search_text)
         else:
-            results = self.history.get_messages(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
+            results = self.history.get_message_rows(remote_uri=remote_uris, media_type=('chat', 'sms'), count=self.showHistoryEntries, search_text=self.chatViewController.search_text)
 
         messages = [row for row in reversed(results)]
         self.render_history_messages(messages)
@@ -940,6 +943,7 @@ class SMSViewController(NSObject):
         seen_sms = {}
         last_media_type = 'sms'
         last_chat_timestamp = None
+        history_messages = []
         for message in messages:
             if message.status == 'failed':
                 continue
@@ -967,13 +971,17 @@ class SMSViewController(NSObject):
             #if message.media_type == 'sms' and last_media_type == 'chat':
             #   self.chatViewController.showSystemMessage(message.sip_callid, 'Instant messages', timestamp, False)
 
-            self.chatViewController.showMessage(message.sip_callid, message.msgid, message.direction, message.cpim_from, icon, message.body, timestamp, recipient=message.cpim_to, state=message.status, is_html=is_html, history_entry=True, media_type = message.media_type, encryption=message.encryption)
+            history_messages.append(dict(call_id=message.sip_callid, msgid=message.msgid, direction=message.direction, sender=message.cpim_from, icon_path=icon, text=message.body, timestamp=timestamp,
+                                         recipient=message.cpim_to, state=message.status, is_html=is_html, media_type=message.media_type, encryption=message.encryption))
 
             call_id = message.sip_callid
             last_media_type = 'chat' if message.media_type == 'chat' else 'sms'
             if message.media_type == 'chat':
                 last_chat_timestamp = timestamp
 
+        for index in xrange(0, len(history_messages), HISTORY_RENDER_CHUNK_SIZE):
+            self.chatViewController.showMessages(history_messages[index:index+HISTORY_RENDER_CHUNK_SIZE])
+
         if not self.otr_negotiation_in_progress:
             self.chatViewController.loadingProgressIndicator.stopAnimation_(None)
             self.chatViewController.loadingTextIndicator.setStringValue_("")
@@ -57,7 +57,7 @@ from ScreenSharingController import ScreenSharingController, ScreenSharingServer
 from FileTransferController import FileTransferController
 from FileTransferSession import OutgoingPushFileTransferHandler
 from HistoryManager import ChatHistory, SessionHistory
-from HistoryManager import SessionHistoryReplicator, ChatHistoryReplicator
+from HistoryManager import SessionHistoryReplicator, ChatHistoryReplicator, HistoryCompactor
 from MediaStream import STATE_IDLE, STATE_CONNECTED, STATE_CONNECTING, STATE_DNS_LOOKUP, STATE_DNS_FAILED, STATE_FINISHED, STATE_FAILED
 from MediaStream import STREAM_IDLE, STREAM_FAILED
 from SessionRinger import Ringer
@@ -117,6 +117,7 @@ class SessionControllersManager(object):
 
         SessionHistoryReplicator()
         ChatHistoryReplicator()
+        HistoryCompactor()
 
 
     @property
@@ -4,6 +4,7 @@
 from Foundation import NSBundle
 
 import os
+import re
 
 from application.python.types import Singleton
 from util import escape_html
@@ -19,6 +20,7 @@ class SmileyManager(object):
         self.icon = None
         self.smileys = {}
         self.smileys_html = {}
+        self.smileys_regex = None
         self.smiley_keys = []
         self.load_theme(str(NSBundle.mainBundle().resourcePath())+"/smileys" , "default")
 
@@ -75,6 +77,10 @@ class SmileyManager(object):
             ek = escape_html(k)
             self.smileys_html[ek] = "<img src='file:%s' class='smiley' />"%(self.get_smiley(k))
 
+        # a single alternation with the longer smileys first, so that text is substituted in one pass
+        keys = sorted((k for k in self.smileys_html if k), key=lambda k: (len(k), k), reverse=True)
+        self.smileys_regex = re.compile("|".join(re.escape(k) for k in keys)) if keys else None
+
     def get_smiley(self, text):
         if self.smileys.has_key(text):
             return os.path.join(self.smiley_directory, self.theme, self.smileys[text])
@@ -82,12 +88,9 @@ class SmileyManager(object):
 
 
     def subst_smileys_html(self, text):
-        items = self.smileys_html.items()
-        items.sort(lambda a,b:cmp(a[0],b[0]))
-        items.reverse() # reverse list so that longer ones are substituted 1st
-        for k, v in items:
-            text = text.replace(k, v)
-        return text
+        if self.smileys_regex is None:
+            return text
+        return self.smileys_regex.sub(lambda match: self.smileys_html[match.group(0)], text)
 
 
     def get_smiley_list(self):
@@ -0,0 +1,41 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Definitions loaded out of the Blink sources for the benchmarks.
+
+The Blink modules import PyObjC and the SIP SIMPLE SDK at the top, the
+benchmarks only need a few of their functions and classes. These are executed
+on their own with the names they refer to supplied by the caller, so that the
+code measured is always the one used by Blink.
+"""
+
+import os
+import re
+import textwrap
+
+
+SOURCE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def definition(module, name, class_name=None):
+    # Returns the source of a top level function, class or one line assignment of the
+    # module, or of a method of class_name
+    if class_name is not None:
+        source, indent = definition(module, class_name), '    '
+    else:
+        with open(os.path.join(SOURCE_DIRECTORY, module + '.py')) as f:
+            source, indent = f.read(), ''
+    match = (re.search(r'^%s(?:def|class) %s\b.*?(?=^ {0,%d}\S|\Z)' % (indent, re.escape(name), len(indent)), source, re.M | re.S) or
+             re.search(r'^%s%s\s*=(?!=).*$' % (indent, re.escape(name)), source, re.M))
+    if match is None:
+        raise LookupError('%s has no definition of %s' % (class_name or module, name))
+    return textwrap.dedent(match.group(0))
+
+
+def load(module, names, namespace=None):
+    # Executes the definitions of names in order in namespace and returns it
+    namespace = {} if namespace is None else namespace
+    for name in names:
+        exec(definition(module, name), namespace)
+    return namespace
@@ -0,0 +1,87 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Memory held by a virtualized chat view while 100k messages go through it.
+
+History is replayed first, then messages keep arriving. The messages and search
+index kept by the view are reported by ChatViewController.transcriptStats, the
+check fails if the view keeps more than the replayed window or the
+MAX_RENDERED_MESSAGES cap of ChatController.
+
+Needs the Blink runtime (PyObjC and the SIP SIMPLE SDK), run it from the source
+directory: python benchmarks/chat_transcript_memory.py [messages] [replayed]
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import resource
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from ChatViewController import ChatViewController, RENDERED_MESSAGES_TRIM_SIZE
+
+
+MAX_RENDERED_MESSAGES = 500      # same as in ChatController
+HISTORY_RENDER_CHUNK_SIZE = 250  # same as in ChatController
+WORDS = ('hello', 'meeting', 'tomorrow', 'call', 'file', 'transfer', 'blink', 'presence', 'conference', 'video')
+
+
+class TranscriptController(ChatViewController):
+    # The web view is left out, only the scripts sent to it are accounted
+    script_length = 0
+
+    def executeJavaScript(self, script):
+        self.script_length += len(script)
+
+
+def message(index):
+    text = u' '.join(WORDS[(index * 7 + i) % len(WORDS)] for i in range(5 + index % 20))
+    return dict(call_id='call%d' % (index // 50), msgid='msg%d' % index, direction='incoming', sender='bob@example.com', icon_path='',
+                text=text, timestamp=datetime.datetime(2015, 1, 1) + datetime.timedelta(seconds=index), rendered_text=text)
+
+
+def max_rss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024.0 / 1024 if sys.platform == 'darwin' else usage / 1024.0
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    replayed = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    controller = TranscriptController.alloc().init()
+    controller.resetRenderedMessages()
+    controller.max_rendered_messages = MAX_RENDERED_MESSAGES
+    controller.finishedLoading = True
+
+    controller.beginHistoryReplay()
+    for index in range(0, replayed, HISTORY_RENDER_CHUNK_SIZE):
+        controller.showMessages([message(i) for i in range(index, min(index + HISTORY_RENDER_CHUNK_SIZE, replayed))])
+    controller.endHistoryReplay()
+
+    stats = controller.transcriptStats()
+    print('replayed %d messages: %d in view' % (replayed, stats.rendered_messages))
+    failed = stats.rendered_messages != replayed
+
+    limit = max(MAX_RENDERED_MESSAGES, replayed) + RENDERED_MESSAGES_TRIM_SIZE
+    peak = 0
+    for index in range(replayed, total):
+        controller.showMessages([message(index)])
+        peak = max(peak, len(controller.rendered_messages))
+        if (index + 1) % 10000 == 0:
+            stats = controller.transcriptStats()
+            print('%6d messages: %5d in view, %7d characters, %6d trigrams, %7d postings, %4d call ids, max RSS %.1f MB' % (
+                  index + 1, stats.rendered_messages, stats.text_length, stats.trigrams, stats.trigram_postings, stats.call_ids, max_rss()))
+
+    print('at most %d messages in view, the limit is %d' % (peak, limit))
+    if failed or peak > limit:
+        print('FAILED')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
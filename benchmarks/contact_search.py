@@ -0,0 +1,66 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Time taken by the contacts search box for each keystroke.
+
+Compares the scan of every contact of the searchable groups, done before
+ContactSearchIndex, with the index, over queries typed one character at a
+time. Both must find the same contacts in the same order. The time to build
+the index and to update it after one contact or every contact changed are
+reported as well.
+
+Blink is Python 2 code: python2 benchmarks/contact_search.py [contacts]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from contacts_model import ContactSearchIndex, ContactURIIndex, contacts_list
+
+
+QUERIES = ('alice12', 'acme', '+4912', 'bob@', 'conference 19')
+
+
+def scan(groups, text):
+    return [blink_contact for group in groups if not group.ignore_search for blink_contact in group.contacts if text in blink_contact or blink_contact.matchesURI(text)]
+
+
+def milliseconds(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, (time.time() - start) * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    # one group per contact, the contacts list then has no duplicates to drop
+    groups = contacts_list(count, groups=2, groups_per_contact=1)
+    index = ContactSearchIndex(ContactURIIndex())
+
+    result, elapsed = milliseconds(index.search, groups, u'x')
+    print('%d contacts, index built in %.0f ms' % (count, elapsed))
+    for query in QUERIES:
+        for length in range(1, len(query) + 1):
+            text = query[:length]
+            expected, scan_time = milliseconds(scan, groups, text)
+            result, index_time = milliseconds(index.search, groups, text)
+            assert result == expected, text
+            print('%-15r scan %7.1f ms  index %7.1f ms  %5d contacts' % (text, scan_time, index_time, len(result)))
+
+    for name, text, changed in (('a change', u'zed ch', True), ('a change of every contact', u'zed al', False)):
+        blink_contact = groups[0].contacts[5]
+        blink_contact.name = text.title() + u'tered'
+        index.uri_index.invalidate()
+        index.invalidate([blink_contact] if changed else None)
+        # the URI index is shared with the lookups of the model, it is rebuilt once for both
+        ignored, uri_elapsed = milliseconds(index.uri_index.lookup, groups, text)
+        result, elapsed = milliseconds(index.search, groups, text)
+        assert result == scan(groups, text)
+        print('update after %s %.0f ms, URI index %.0f ms' % (name, elapsed, uri_elapsed))
+
+
+if __name__ == '__main__':
+    main()
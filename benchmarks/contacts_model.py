@@ -0,0 +1,84 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Synthetic contacts list for the contacts benchmarks.
+
+The contacts get their URI and text matching methods from BlinkContact and the
+indexes are the classes of ContactListModel, loaded from the Blink source.
+Blink is Python 2 code, the benchmarks using this module run with python2.
+"""
+
+import bisect
+import random
+import re
+
+from itertools import chain
+
+from blink_source import definition, load
+
+
+class FrozenSIPURI(object):
+    pass
+
+SIPURI = FrozenSIPURI
+
+
+class BlinkPresenceContact(object):
+    # BlinkContact methods are added below, the Cocoa base class is left out
+    def __init__(self, name, uris, organization=None, job_title=None, note=None, subscribe=True):
+        self.name = name
+        self.uris = [URI(uri) for uri in uris]
+        self.organization = organization
+        self.job_title = job_title
+        self.note = note
+        self.username, self.domain = split_uri(uris[0])
+        self.contact = Record(uris=self.uris, presence=Record(subscribe=subscribe))
+
+
+class BlinkGroup(object):
+    ignore_search = False
+
+    def __init__(self, name, contacts=None):
+        self.name = name
+        self.contacts = contacts if contacts is not None else []
+
+
+class URI(object):
+    def __init__(self, uri):
+        self.uri = uri
+
+
+class Record(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+namespace = load('util', ('_pstn_addressbook_chars', '_pstn_addressbook_chars_substract_regexp', 'sip_prefix_pattern', 'strip_addressbook_special_characters'), dict(re=re))
+namespace.update(bisect=bisect, chain=chain, FrozenSIPURI=FrozenSIPURI, SIPURI=SIPURI, BlinkPresenceContact=BlinkPresenceContact)
+load('ContactListModel', ('split_uri', 'ContactURIIndex', 'ContactSearchIndex', 'ContactPresenceIndex'), namespace)
+for method in ('__contains__', 'split_uri', 'matchesURI'):
+    # defined apart from the module names, the split_uri method would replace the split_uri function
+    methods = {}
+    exec(definition('ContactListModel', method, 'BlinkContact'), namespace, methods)
+    setattr(BlinkPresenceContact, method, methods[method])
+
+split_uri = namespace['split_uri']
+ContactURIIndex = namespace['ContactURIIndex']
+ContactSearchIndex = namespace['ContactSearchIndex']
+ContactPresenceIndex = namespace['ContactPresenceIndex']
+
+NAMES = ('alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi', 'ivan', 'judy', 'mallory', 'oscar', 'peggy', 'trent', 'victor', 'walter')
+
+
+def contacts_list(count, groups=10, groups_per_contact=2, seed=1):
+    # Returns groups holding count contacts, each with a SIP address and a phone number
+    rand = random.Random(seed)
+    blink_groups = [BlinkGroup('group%d' % index) for index in range(groups)]
+    for index in range(count):
+        name = u'%s %s%d' % (rand.choice(NAMES).title(), rand.choice(NAMES).title(), index)
+        uris = [u'%s%d@example%d.com' % (rand.choice(NAMES), index, index % 50), u'+49%08d' % rand.randint(0, 10**8)]
+        blink_contact = BlinkPresenceContact(name, uris, rand.choice((None, u'Acme Corp', u'Initech')), None, rand.choice((None, u'met at conference %d' % index)))
+        for group in rand.sample(blink_groups, groups_per_contact):
+            group.contacts.append(blink_contact)
+    return blink_groups
@@ -0,0 +1,91 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Throughput of the SHA-1 hashing of files sent by file transfers.
+
+Compares the two ways compute_file_hash goes through a file: memory mapped
+slices hashed in place and the chunked read() used for files that may still
+be written to. The file is hashed once before measuring so both runs find it
+in the page cache.
+
+usage: python benchmarks/file_hash_throughput.py [size in MB] [runs]
+"""
+
+from __future__ import print_function
+
+import hashlib
+import mmap
+import os
+import sys
+import tempfile
+import time
+
+
+HASH_SLICE_SIZE = 4*1024*1024  # same as in FileTransferSession
+
+try:
+    buffer
+except NameError:
+    # Python 3, slices of a memoryview are not copied either
+    def buffer(mapping, offset, size):
+        return memoryview(mapping)[offset:offset+size]
+
+
+def hash_mapped(file):
+    size = os.fstat(file.fileno()).st_size
+    hash = hashlib.sha1()
+    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        pos = 0
+        while pos < size:
+            os.fstat(file.fileno())  # the check done before each slice
+            length = min(HASH_SLICE_SIZE, size - pos)
+            hash.update(buffer(mapping, pos, length))
+            pos += length
+    finally:
+        mapping.close()
+    return hash
+
+
+def hash_read(file):
+    size = os.fstat(file.fileno()).st_size
+    chunk_size = min(max(size//100, 65536), 1048576)
+    hash = hashlib.sha1()
+    file.seek(0)
+    while True:
+        content = file.read(chunk_size)
+        if not content:
+            break
+        hash.update(content)
+    return hash
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    fd, path = tempfile.mkstemp()
+    try:
+        block = os.urandom(1024*1024)
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(size):
+                f.write(block)
+        with open(path, 'rb') as f:
+            expected = hash_read(f).hexdigest()
+            print('%d MB file, best of %d runs' % (size, runs))
+            for name, function in (('memory mapped', hash_mapped), ('read()', hash_read)):
+                best = None
+                for i in range(runs):
+                    start = time.time()
+                    digest = function(f).hexdigest()
+                    elapsed = time.time() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                    assert digest == expected
+                print('%-14s %8.1f MB/s' % (name, size/best))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Cost of building and running the chat history lookups.
+
+Compares statements built by concatenating quoted values, as HistoryManager
+did before SQLQuery, with SQLQuery statements whose text only depends on the
+shape of the query and is prepared once by each sqlite3 connection.
+
+usage: python benchmarks/history_query_builder.py [messages] [queries]
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from history_schema import connect, create_history_tables, history_class, populate_chat_messages
+
+
+SQLQuery = history_class('SQLQuery')
+
+COLUMNS = "id, msgid, direction, time, date, sip_callid, local_uri, remote_uri, cpim_from, cpim_to, cpim_timestamp, body, content_type, private, status, media_type, encryption"
+
+
+def sqlrepr(value):
+    if isinstance(value, int):
+        return str(value)
+    return "'%s'" % value.replace("'", "''")
+
+
+def concatenated_queries(index):
+    remote_uri = 'contact%d@example.com' % (index % 50)
+    replay = "select %s from chat_messages where remote_uri = %s and media_type in (%s, %s) order by time desc, id desc limit %s" % (
+             COLUMNS, sqlrepr(remote_uri), sqlrepr('chat'), sqlrepr('sms'), sqlrepr(100))
+    lookup = "select %s from chat_messages where msgid = %s and remote_uri = %s order by time desc limit %s" % (
+             COLUMNS, sqlrepr('msg%d' % index), sqlrepr(remote_uri), sqlrepr(1))
+    return ((replay, ()), (lookup, ()))
+
+
+def parameterized_queries(index):
+    remote_uri = 'contact%d@example.com' % (index % 50)
+    replay = SQLQuery("select %s from chat_messages" % COLUMNS).where_in("remote_uri", remote_uri).where_in("media_type", ('chat', 'sms'))
+    replay.append("order by time desc, id desc limit ?", 100)
+    lookup = SQLQuery("select %s from chat_messages" % COLUMNS).where("msgid = ?", 'msg%d' % index).where_in("remote_uri", remote_uri)
+    lookup.append("order by time desc limit ?", 1)
+    return ((replay.sql, replay.parameters), (lookup.sql, lookup.parameters))
+
+
+def measure(db, build, kind, queries, execute):
+    start = time.time()
+    for index in range(queries):
+        statement, parameters = build(index)[kind]
+        if execute:
+            db.execute(statement, parameters).fetchall()
+    return (time.time() - start) / queries * 1e6
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    db = connect(':memory:')
+    create_history_tables(db)
+    populate_chat_messages(db, messages)
+
+    print('%d messages, %d queries of each kind' % (messages, queries))
+    for kind, description in enumerate(('history replay', 'msgid lookup')):
+        for name, build in (('concatenated', concatenated_queries), ('SQLQuery', parameterized_queries)):
+            built = measure(db, build, kind, queries, False)
+            executed = measure(db, build, kind, queries, True)
+            print('%-15s %-13s build %6.1f us  build and run %7.1f us per query' % (description, name, built, executed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Latency of chat history lookups while messages are being written.
+
+Compares lookups queued behind the writes on the single 'db-ops' thread with
+lookups served by the 'db-reads' pool of query_only connections on a WAL database.
+
+usage: python benchmarks/history_read_latency.py [messages] [lookups]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from history_schema import chat_message_values, connect, create_history_tables, populate_chat_messages
+
+
+LOOKUP = "select id, msgid, time, body from chat_messages where remote_uri = ? and media_type in ('chat', 'sms') order by time desc, id desc limit 100"
+INSERT = ("INSERT INTO chat_messages (msgid, direction, time, date, sip_callid, sip_fromtag, sip_totag, local_uri, remote_uri, cpim_from, "
+          "cpim_to, cpim_timestamp, body, content_type, private, status, media_type, uuid, journal_id, encryption) VALUES (%s)" % ', '.join('?' * 20))
+
+
+class Worker(threading.Thread):
+    def __init__(self, path, queue, query_only=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.queue = queue
+        self.query_only = query_only
+
+    def run(self):
+        db = connect(self.path)
+        if self.query_only:
+            db.execute('PRAGMA query_only = 1')
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job(db)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*fraction))]
+
+
+def run(path, lookups, separate_readers, first_index):
+    write_queue = Queue()
+    read_queue = write_queue
+    workers = [Worker(path, write_queue)]
+    if separate_readers:
+        read_queue = Queue()
+        workers.extend(Worker(path, read_queue, query_only=True) for i in range(4))
+    for worker in workers:
+        worker.start()
+
+    stop = threading.Event()
+    def writer():
+        # Chat messages arriving in bursts, one transaction each, like ChatHistory.add_message
+        index = first_index
+        while not stop.is_set():
+            for i in range(20):
+                values = chat_message_values(index)
+                def insert(db, values=values):
+                    db.execute(INSERT, values)
+                    db.commit()
+                write_queue.put(insert)
+                index += 1
+            time.sleep(0.01)
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.daemon = True
+    writer_thread.start()
+
+    latencies = []
+    for index in range(lookups):
+        done = threading.Event()
+        def lookup(db, remote_uri='contact%d@example.com' % (index % 50)):
+            db.execute(LOOKUP, (remote_uri,)).fetchall()
+            done.set()
+        start = time.time()
+        read_queue.put(lookup)
+        done.wait()
+        latencies.append(time.time() - start)
+        time.sleep(0.005)
+
+    stop.set()
+    writer_thread.join()
+    for worker in workers:
+        worker.queue.put(None)
+    for worker in workers:
+        worker.join()
+    return latencies
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'history.sqlite')
+        db = connect(path)
+        db.execute('PRAGMA journal_mode = WAL')
+        create_history_tables(db)
+        populate_chat_messages(db, messages)
+        db.close()
+
+        print('%d messages, %d lookups while inserting' % (messages, lookups))
+        for run_index, (name, separate_readers) in enumerate((('single db-ops thread', False), ('db-reads pool', True))):
+            latencies = run(path, lookups, separate_readers, messages + run_index*10**6)
+            print('%-22s p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms' % (name, percentile(latencies, 0.5)*1000, percentile(latencies, 0.95)*1000, max(latencies)*1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
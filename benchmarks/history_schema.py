@@ -0,0 +1,208 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+History database schema used by the benchmarks and query plan tests.
+
+HistoryManager needs the SIP SIMPLE SDK to be imported, the index definitions are
+read from its source instead so that they are always the ones used by Blink.
+"""
+
+import ast
+import os
+import random
+import re
+import sqlite3
+
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from blink_source import definition, load
+
+try:
+    string_types = basestring
+    text_type = unicode
+except NameError:
+    string_types = text_type = str
+
+
+HISTORY_MANAGER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'HistoryManager.py')
+
+# Same columns and indexes SQLObject creates for ChatMessage and SessionHistoryEntry
+CHAT_MESSAGES_SCHEMA = (
+    "CREATE TABLE chat_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, msgid TEXT, direction TEXT, time TIMESTAMP, date DATE, "
+    "sip_callid TEXT, sip_fromtag TEXT, sip_totag TEXT, local_uri VARCHAR(128), remote_uri VARCHAR(128), cpim_from VARCHAR(128), "
+    "cpim_to VARCHAR(128), cpim_timestamp TEXT, body LONGTEXT, content_type TEXT, private TEXT, status TEXT, media_type TEXT, "
+    "uuid TEXT, journal_id TEXT, encryption TEXT)",
+    "CREATE UNIQUE INDEX chat_messages_msg_idx ON chat_messages (msgid, local_uri, remote_uri)",
+    "CREATE INDEX chat_messages_id_idx ON chat_messages (msgid)",
+    "CREATE INDEX chat_messages_local_idx ON chat_messages (local_uri)",
+    "CREATE INDEX chat_messages_remote_idx ON chat_messages (remote_uri)")
+
+SESSIONS_SCHEMA = (
+    "CREATE TABLE sessions (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, media_types TEXT, direction TEXT, status TEXT, "
+    "failure_reason TEXT, start_time TIMESTAMP, end_time TIMESTAMP, duration INT, sip_callid TEXT, sip_fromtag TEXT, sip_totag TEXT, "
+    "local_uri VARCHAR(128), remote_uri VARCHAR(128), remote_focus TEXT, participants LONGTEXT, hidden INT, am_filename LONGTEXT)",
+    "CREATE UNIQUE INDEX sessions_session_idx ON sessions (session_id, local_uri, remote_uri)",
+    "CREATE INDEX sessions_local_idx ON sessions (local_uri)",
+    "CREATE INDEX sessions_remote_idx ON sessions (remote_uri)")
+
+CHAT_MESSAGES_FTS_SCHEMA = (
+    "CREATE VIRTUAL TABLE chat_messages_fts USING fts5(body, content='chat_messages', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO chat_messages_fts (rowid, body) VALUES (new.id, new.body); END")
+
+WORDS = ('hello', 'meeting', 'tomorrow', 'call', 'file', 'transfer', 'blink', 'presence', 'conference', 'video',
+         'audio', 'number', 'address', 'sip2sip', 'password', 'screen', 'sharing', 'lunch', 'update', 'release')
+
+
+def history_indexes(class_name):
+    # Returns the indexes tuple of the given HistoryManager class. The module is Python 2
+    # code, only the tuple literal is parsed so that this also runs on Python 3
+    with open(HISTORY_MANAGER) as f:
+        source = f.read()
+    match = re.search(r'^class %s\(.*?^    indexes = (\()' % class_name, source, re.M | re.S)
+    if match is None:
+        raise LookupError('%s has no indexes' % class_name)
+    depth = 0
+    for position in range(match.start(1), len(source)):
+        if source[position] == '(':
+            depth += 1
+        elif source[position] == ')':
+            depth -= 1
+            if depth == 0:
+                return ast.literal_eval(source[match.start(1):position+1])
+    raise LookupError('%s has no indexes' % class_name)
+
+
+def python3_source(source):
+    # Blink is Python 2 code, the 'except X as e' form of its 'except X, e' runs on both
+    return re.sub(r'\bexcept ([\w.]+), (\w+):', r'except \1 as \2:', source)
+
+
+def history_class(class_name, namespace=None):
+    # Returns a class of HistoryManager that only needs the standard library, like SQLQuery,
+    # with the Python 2 names it uses defined on Python 3. The other names it refers to are
+    # given in namespace
+    namespace = dict(namespace or {}, date=date, datetime=datetime, basestring=string_types)
+    exec(python3_source(definition('HistoryManager', class_name)), namespace)
+    return namespace[class_name]
+
+
+class HistoryLogger(object):
+    # Errors of the history queries are logged by Blink, they fail the benchmarks and tests
+    def log_error(self, message):
+        raise AssertionError(message)
+
+    def log_debug(self, message):
+        pass
+
+
+def history_queries(class_name, method_names):
+    # Returns an object with the given methods of the HistoryManager class and the list of the
+    # (statement, parameters) of the queries they run. The queries are built by SQLQuery as in
+    # Blink, the statements are recorded instead of executed and no rows are returned
+    statements = []
+    namespace = dict(date=date, datetime=datetime, basestring=string_types, unicode=text_type, namedtuple=namedtuple,
+                     BlinkLogger=HistoryLogger, block_on=lambda result: result)
+    load('HistoryManager', ['SQLQuery', 'ChatMessageRow'], namespace)
+
+    class RecordedQuery(namespace['SQLQuery']):
+        def execute(self, db):
+            statements.append((self.sql, self.parameters))
+            return []
+    namespace['SQLQuery'] = RecordedQuery
+
+    db = connect(':memory:')
+    create_history_tables(db, indexes=False)
+    for table, table_class in (('chat_messages', 'ChatMessage'), ('sessions', 'SessionHistoryEntry')):
+        # the columns of the SQLObject classes, in the order they are declared
+        columns = [namedtuple('Column', 'dbName')(row[1]) for row in db.execute("PRAGMA table_info(%s)" % table) if row[1] != 'id']
+        namespace[table_class] = type(table_class, (object,), dict(sqlmeta=type('sqlmeta', (object,), dict(table=table, idName='id', columnList=columns))))
+    db.close()
+
+    methods = {}
+    for name in method_names:
+        exec(python3_source(definition('HistoryManager', name, class_name)), namespace, methods)
+    history = type(class_name, (object,), methods)()
+    history.read_db = history.db = None
+    history.fts_available = False
+    return history, statements
+
+
+def create_history_tables(db, fts=False, indexes=True):
+    for query in CHAT_MESSAGES_SCHEMA + SESSIONS_SCHEMA:
+        db.execute(query)
+    if indexes:
+        create_history_indexes(db)
+    if fts:
+        for query in CHAT_MESSAGES_FTS_SCHEMA:
+            db.execute(query)
+
+
+def create_history_indexes(db):
+    for table, class_name in (('chat_messages', 'ChatHistory'), ('sessions', 'SessionHistory')):
+        for name, columns in history_indexes(class_name):
+            db.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (name, table, columns))
+
+
+def chat_message_values(index, contacts=50, start=datetime(2015, 1, 1)):
+    rand = random.Random(index)
+    time = start + timedelta(seconds=index*37, microseconds=rand.randint(0, 999999))
+    remote_uri = 'contact%d@example.com' % (index % contacts)
+    body = ' '.join(rand.choice(WORDS) for i in range(rand.randint(3, 20)))
+    media_type = rand.choice(('chat', 'chat', 'chat', 'sms'))
+    call_id = 'callid%d' % index if media_type == 'sms' else ''
+    return ('msg%d' % index, rand.choice(('incoming', 'outgoing')), time.strftime('%Y-%m-%d %H:%M:%S.%f'), time.strftime('%Y-%m-%d'),
+            call_id, '', '', 'alice@example.com', remote_uri, remote_uri, 'alice@example.com', time.isoformat(), body, 'text', '0',
+            'delivered', media_type, 'uuid', '', '')
+
+
+def populate_chat_messages(db, count, contacts=50):
+    query = ("INSERT INTO chat_messages (msgid, direction, time, date, sip_callid, sip_fromtag, sip_totag, local_uri, remote_uri, cpim_from, "
+             "cpim_to, cpim_timestamp, body, content_type, private, status, media_type, uuid, journal_id, encryption) "
+             "VALUES (%s)" % ', '.join('?' * 20))
+    db.executemany(query, (chat_message_values(index, contacts) for index in range(count)))
+    db.commit()
+
+
+def populate_sessions(db, count, contacts=50, start=datetime(2015, 1, 1)):
+    query = ("INSERT INTO sessions (session_id, media_types, direction, status, failure_reason, start_time, end_time, duration, sip_callid, "
+             "sip_fromtag, sip_totag, local_uri, remote_uri, remote_focus, participants, hidden, am_filename) VALUES (%s)" % ', '.join('?' * 17))
+    def values(index):
+        start_time = start + timedelta(seconds=index*600)
+        return ('session%d' % index, 'audio', 'incoming', 'completed', '', start_time.strftime('%Y-%m-%d %H:%M:%S'),
+                (start_time + timedelta(seconds=60)).strftime('%Y-%m-%d %H:%M:%S'), 60, 'callid%d' % index, 'fromtag%d' % index, '',
+                'alice@example.com', 'contact%d@example.com' % (index % contacts), '0', '', 0, '')
+    db.executemany(query, (values(index) for index in range(count)))
+    db.commit()
+
+
+def generate_chat_messages(db, count, contacts=50):
+    # Like populate_chat_messages with a fixed body, the rows are generated by SQLite which
+    # takes seconds for millions of messages instead of minutes
+    db.execute("WITH RECURSIVE sequence(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM sequence WHERE i + 1 < ?) "
+               "INSERT INTO chat_messages (msgid, direction, time, date, sip_callid, sip_fromtag, sip_totag, local_uri, remote_uri, cpim_from, "
+               "cpim_to, cpim_timestamp, body, content_type, private, status, media_type, uuid, journal_id, encryption) "
+               "SELECT 'msg' || i, CASE i % 2 WHEN 0 THEN 'incoming' ELSE 'outgoing' END, datetime('2015-01-01', '+' || (i * 37) || ' seconds'), "
+               "date('2015-01-01', '+' || (i * 37) || ' seconds'), CASE i % 4 WHEN 3 THEN 'callid' || i ELSE '' END, '', '', 'alice@example.com', "
+               "'contact' || (i % ?) || '@example.com', 'contact' || (i % ?) || '@example.com', 'alice@example.com', '', 'message ' || i, "
+               "'text', '0', 'delivered', CASE i % 4 WHEN 3 THEN 'sms' ELSE 'chat' END, 'uuid', '', '' FROM sequence", (count, contacts, contacts))
+    db.commit()
+
+
+def generate_sessions(db, count, contacts=50):
+    db.execute("WITH RECURSIVE sequence(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM sequence WHERE i + 1 < ?) "
+               "INSERT INTO sessions (session_id, media_types, direction, status, failure_reason, start_time, end_time, duration, sip_callid, "
+               "sip_fromtag, sip_totag, local_uri, remote_uri, remote_focus, participants, hidden, am_filename) "
+               "SELECT 'session' || i, CASE i % 5 WHEN 4 THEN 'chat' ELSE 'audio' END, CASE i % 2 WHEN 0 THEN 'incoming' ELSE 'outgoing' END, "
+               "CASE i % 7 WHEN 6 THEN 'missed' ELSE 'completed' END, '', datetime('2015-01-01', '+' || (i * 600) || ' seconds'), "
+               "datetime('2015-01-01', '+' || (i * 600 + 60) || ' seconds'), 60, 'callid' || i, 'fromtag' || i, '', 'alice@example.com', "
+               "'contact' || (i % ?) || '@example.com', '0', '', i % 3 = 2, '' FROM sequence", (count, contacts))
+    db.commit()
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    db.text_factory = str
+    return db
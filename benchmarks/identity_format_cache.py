@@ -0,0 +1,136 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Calls per second of the memoized SIP identity parsing and formatting.
+
+sipuri_components_from_string and format_identity_to_string are loaded from
+util.py and compared with the functions they memoize, over a corpus of URIs
+looked up with a skewed distribution, the way chat and history views render
+the same senders again and again. Both must return the same values and types.
+
+Contacts are looked up in a ContactURIIndex of 2000 contacts, half of the
+identities belong to one of them.
+
+Blink is Python 2 code: python2 benchmarks/identity_format_cache.py [lookups]
+"""
+
+from __future__ import print_function
+
+import random
+import re
+import shlex
+import sys
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+from blink_source import load
+from contacts_model import ContactURIIndex, contacts_list
+
+
+class FakeSIPURI(object):
+    def __init__(self, user, host, port=None, transport='udp'):
+        self.user = user
+        self.host = host
+        self.port = port
+        self.transport = transport
+
+    def __str__(self):
+        return 'sip:%s@%s%s' % (self.user, self.host, ':%d' % self.port if self.port else '')
+
+
+class Identity(object):
+    def __init__(self, uri, display_name=None):
+        self.uri = uri
+        self.display_name = display_name
+
+
+class ContactsWindowController(object):
+    # same lookup as ContactListModel.getFirstContactMatchingURI
+    def __init__(self, groups):
+        self.groups = groups
+        self.uri_index = ContactURIIndex()
+
+    def getFirstContactMatchingURI(self, uri, exact_match=False):
+        for group, blink_contact in self.uri_index.lookup(self.groups, uri, exact_match):
+            return blink_contact
+        return None
+
+
+class Application(object):
+    def __init__(self, groups):
+        self.contactsWindowController = ContactsWindowController(groups)
+
+    def delegate(self):
+        return self
+
+
+def corpus(size, groups):
+    rand = random.Random(1)
+    texts = []
+    identities = []
+    contacts = [blink_contact for group in groups for blink_contact in group.contacts]
+    for index in range(size):
+        kind = index % 5
+        if kind == 0:
+            text, uri = '"User %d" <sip:user%d@example.com>' % (index, index), FakeSIPURI('user%d' % index, 'example.com')
+        elif kind == 1:
+            text, uri = 'sip:+3120%07d@10.0.%d.%d' % (index, index % 250, index % 200), FakeSIPURI('+3120%07d' % index, '10.0.%d.%d' % (index % 250, index % 200))
+        elif kind == 2:
+            text, uri = u'J\xfcrgen M\xfcller %d <sip:juergen%d@example.de>' % (index, index), FakeSIPURI('juergen%d' % index, 'example.de', 5070)
+        elif kind == 3:
+            text, uri = '0049%09d@sip2sip.info' % index, FakeSIPURI('0049%09d' % index, 'sip2sip.info', transport='tls')
+        else:
+            text, uri = u'user%d@example.org' % index, FakeSIPURI('user%d' % index, 'example.org')
+        texts.append(text)
+        if index % 2:
+            blink_contact = rand.choice(contacts)
+            uri = FakeSIPURI(blink_contact.username.encode('utf-8'), blink_contact.domain.encode('utf-8'))
+        identities.append(Identity(uri, rand.choice((None, 'User %d' % index))))
+    return texts, identities
+
+
+def calls_per_second(function, arguments):
+    start = time.time()
+    for argument in arguments:
+        function(*argument)
+    return len(arguments) / (time.time() - start)
+
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    groups = contacts_list(2000)
+    texts, identities = corpus(1500, groups)
+
+    namespace = dict(re=re, shlex=shlex, OrderedDict=OrderedDict, Lock=Lock, SIPURI=FakeSIPURI, FrozenSIPURI=FakeSIPURI,
+                     NSApp=Application(groups), sip_prefix_pattern=re.compile("^(sip:|sips:)"))
+    names = ('_identity_number_regexp', '_number_ip_regexp', '_number_regexp', '_LRUCache', '_sipuri_components_cache', '_identity_cache',
+             'sipuri_components_from_string', '_sipuri_components_from_string', 'format_identity_to_string', '_format_identity_to_string')
+    util = load('util', names, namespace)
+
+    rand = random.Random(2)
+    positions = [min(int(rand.paretovariate(1.2)) - 1, len(texts) - 1) for i in range(lookups)]
+    parse_arguments = [(texts[position],) for position in positions]
+    format_arguments = [(identities[position], True, rand.choice(('compact', 'full'))) for position in positions]
+
+    for (text,) in parse_arguments:
+        expected, result = util['_sipuri_components_from_string'](text), util['sipuri_components_from_string'](text)
+        assert expected == result and [type(value) for value in expected] == [type(value) for value in result], text
+    for identity, check_contact, format in format_arguments:
+        expected, result = util['_format_identity_to_string'](identity, check_contact, format), util['format_identity_to_string'](identity, check_contact, format)
+        assert expected == result and type(expected) == type(result), str(identity.uri)
+
+    print('%d lookups over %d URIs' % (lookups, len(texts)))
+    for name, uncached, cached, arguments in (('sipuri_components_from_string', '_sipuri_components_from_string', 'sipuri_components_from_string', parse_arguments),
+                                              ('format_identity_to_string', '_format_identity_to_string', 'format_identity_to_string', format_arguments)):
+        util['_sipuri_components_cache'].clear()
+        util['_identity_cache'].clear()
+        before = calls_per_second(util[uncached], arguments)
+        after = calls_per_second(util[cached], arguments)
+        print('%-30s %9.0f calls/s without the cache  %9.0f calls/s with it' % (name, before, after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Time taken to find the contacts of a presence notification.
+
+Compares the lookup of each resource of the notification in the contacts URI
+index followed by a filter of the whole resource map for every contact found,
+done before ContactPresenceIndex, with the index. Both must give the same
+resources to the same (contact, group) pairs.
+
+Blink is Python 2 code: python2 benchmarks/presence_dispatch.py [contacts]
+"""
+
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from contacts_model import ContactPresenceIndex, ContactURIIndex, contacts_list
+
+
+def uri_lookup(groups, uri_index, resource_map):
+    pairs = set()
+    for uri in resource_map:
+        pairs.update((blink_contact, group) for group, blink_contact in uri_index.lookup(groups, uri, exact_match=True) if blink_contact.contact.presence.subscribe)
+    resources = {}
+    for blink_contact, group in pairs:
+        contact_uris = list(item.uri for item in blink_contact.contact.uris)
+        contact_resources = dict((key, value) for key, value in resource_map.iteritems() if key in contact_uris)
+        if contact_resources:
+            resources[(blink_contact, group)] = contact_resources
+    return resources
+
+
+def milliseconds(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, (time.time() - start) * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    groups = contacts_list(count)
+    contacts = list(set(blink_contact for group in groups for blink_contact in group.contacts))
+    rand = random.Random(2)
+
+    uri_index = ContactURIIndex()
+    presence_index = ContactPresenceIndex()
+    ignored, uri_build = milliseconds(uri_index.lookup, groups, u'x')
+    ignored, presence_build = milliseconds(presence_index.lookup, groups, {})
+    print('%d contacts in %d groups, URI index built in %.0f ms, presence index in %.0f ms' % (count, len(groups), uri_build, presence_build))
+
+    for name, size in (('full state', 500), ('partial', 5)):
+        resource_map = dict((blink_contact.uris[0].uri, 'pidf') for blink_contact in rand.sample(contacts, size))
+        expected, before = milliseconds(uri_lookup, groups, uri_index, resource_map)
+        result, after = milliseconds(presence_index.lookup, groups, resource_map)
+        assert result == expected
+        print('%-10s %3d resources  URI lookups %8.1f ms  presence index %6.2f ms  %d contacts' % (name, size, before, after, len(result)))
+
+
+if __name__ == '__main__':
+    main()
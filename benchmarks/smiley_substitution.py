@@ -0,0 +1,94 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Time taken to replace smileys in chat messages.
+
+Compares SmileyManager.subst_smileys_html, a single regular expression pass,
+with the replacement of one smiley after the other done before, on the escaped
+text messages of a Blink history database, with the smileys of the default
+theme. Both must give the same HTML. Without a database, generated chat lines
+with MSN style smileys are used.
+
+Blink is Python 2 code:
+python2 benchmarks/smiley_substitution.py [history.sqlite] [messages]
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+
+from blink_source import SOURCE_DIRECTORY, load
+
+
+def replace_one_by_one(smileys_html, text):
+    items = smileys_html.items()
+    items.sort(lambda a,b:cmp(a[0],b[0]))
+    items.reverse() # reverse list so that longer ones are substituted 1st
+    for k, v in items:
+        text = text.replace(k, v)
+    return text
+
+
+def chat_lines(count, smileys):
+    rand = random.Random(1)
+    words = ('hello', 'are', 'you', 'there', 'call', 'me', 'later', 'ok', 'thanks', 'see', 'you', 'tomorrow', 'at', '10:30', 'http://example.com/a?b=c')
+    lines = []
+    for index in range(count):
+        tokens = [rand.choice(words) for i in range(rand.randint(3, 25))]
+        for i in range(rand.randint(0, 3)):
+            tokens.insert(rand.randint(0, len(tokens)), rand.choice(smileys))
+        lines.append(' '.join(tokens))
+    return lines
+
+
+def history_lines(path, count):
+    # the most recent text messages, HTML bodies do not go through the escaping measured here
+    db = sqlite3.connect(path)
+    try:
+        return [body for (body,) in db.execute("SELECT body FROM chat_messages WHERE content_type = 'text' ORDER BY id DESC LIMIT ?", (count,))]
+    finally:
+        db.close()
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    namespace = load('util', ('escape_html',))
+    namespace.update(os=os, re=re, Singleton=type)
+    SmileyManager = load('SmileyManager', ('SMILEY_STYLE', 'SmileyManager'), namespace)['SmileyManager']
+    escape_html = namespace['escape_html']
+
+    manager = SmileyManager.__new__(SmileyManager)
+    manager.smileys = {}
+    manager.smiley_keys = []
+    manager.load_theme(os.path.join(SOURCE_DIRECTORY, 'smileys'), 'default')
+
+    if path is not None:
+        lines = history_lines(path, count)
+        print('%d text messages of %s' % (len(lines), path))
+    else:
+        lines = chat_lines(count, sorted(manager.smileys))
+        print('%d generated chat lines' % len(lines))
+    if not lines:
+        return
+    lines = [escape_html(line) for line in lines]
+    count = len(lines)
+    for name, function in (('one by one', lambda text: replace_one_by_one(manager.smileys_html, text)), ('single pass', manager.subst_smileys_html)):
+        start = time.time()
+        results = [function(line) for line in lines]
+        elapsed = time.time() - start
+        if name == 'one by one':
+            expected = results
+        assert results == expected
+        print('%-12s %6.1f us per line' % (name, elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -97,6 +97,9 @@ class LogsSettingsExtension(LogsSettings):
     trace_notifications_in_gui = Setting(type=bool, default=False)
     trace_notifications_to_file = Setting(type=bool, default=False)
 
+    # entries kept by each trace view of the debug window, 0 keeps everything
+    trace_in_gui_buffer_size = Setting(type=NonNegativeInteger, default=5000)
+
 class ServerSettings(SettingsGroup):
     enrollment_url = Setting(type=HTTPURL, default="https://blink.sipthor.net/enrollment.phtml")
     # Collaboration editor taken from http://code.google.com/p/google-mobwrite/
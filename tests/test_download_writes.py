@@ -0,0 +1,131 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Writes of the chunks received by a file transfer.
+
+FileTransfer.buffer_chunk coalesces the received chunks into writes that end
+on a multiple of DOWNLOAD_WRITE_SIZE from the start of the file, flush_chunks
+writes what is left at the end of the transfer. The file and its checksum must
+be those of the chunks received, in order.
+
+run with: python -m unittest discover tests
+"""
+
+import hashlib
+import io
+import os
+import random
+import sys
+import unittest
+
+from threading import Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+from blink_source import definition, load
+
+
+namespace = load('FileTransferSession', ('DOWNLOAD_WRITE_SIZE', 'DOWNLOAD_MAX_PENDING'), dict(Lock=Lock))
+methods = {}
+for name in ('buffer_chunk', 'flush_chunks', 'queue_write', 'write_download_chunk'):
+    source = definition('FileTransferSession', name, 'FileTransfer')
+    if bytes is not str:
+        # the chunks are str on Python 2, where Blink runs, and bytes on Python 3
+        source = source.replace("''.join", "b''.join")
+    exec(source, namespace, methods)
+
+DOWNLOAD_WRITE_SIZE = namespace['DOWNLOAD_WRITE_SIZE']
+
+
+class Record(object):
+    pass
+
+
+class RecordedFile(io.BytesIO):
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append((self.tell(), len(data)))
+        return io.BytesIO.write(self, data)
+
+
+class Download(type('FileTransfer', (object,), methods)):
+    # the state set by FileTransfer.open_download_file, the chunks are written right away
+    # instead of in the 'file-transfer' thread
+    def __init__(self):
+        self.file_selector = Record()
+        self.file_selector.fd = RecordedFile()
+        self.hash = hashlib.sha1()
+        self.write_buffer = []
+        self.write_buffer_offset = 0
+        self.write_buffer_size = 0
+        self.write_lock = Lock()
+        self.pending_bytes = 0
+        self.writes_drained = None
+
+    def write_chunk(self, data):
+        self.write_download_chunk(data)
+
+
+class DownloadWritesTests(unittest.TestCase):
+
+    def receive(self, sizes, start=0):
+        rand = random.Random(1)
+        download = Download()
+        download.file_selector.fd.seek(start)
+        offset = start
+        content = []
+        for size in sizes:
+            data = bytes(bytearray(rand.randint(0, 255) for i in range(size))) if size < 4096 else os.urandom(size)
+            download.buffer_chunk(data, offset)
+            content.append(data)
+            offset += size
+        return download, b''.join(content)
+
+    def check_aligned(self, download):
+        for position, size in download.file_selector.fd.writes:
+            self.assertEqual((position + size) % DOWNLOAD_WRITE_SIZE, 0, (position, size))
+
+    def test_aligned_writes(self):
+        sizes = [65536 - 7, 1, 70000, 3, 2048] * 40
+        download, content = self.receive(sizes)
+        self.assertTrue(len(download.file_selector.fd.writes) >= 2)
+        self.check_aligned(download)
+        self.assertEqual(download.write_buffer_size, len(content) % DOWNLOAD_WRITE_SIZE)
+        download.flush_chunks()
+        self.assertEqual(download.file_selector.fd.getvalue(), content)
+        self.assertEqual(download.hash.hexdigest(), hashlib.sha1(content).hexdigest())
+        self.assertEqual(download.pending_bytes, 0)
+
+    def test_unaligned_start(self):
+        # the writes end on the block boundaries of the file, not of the first chunk
+        start = 1000
+        download, content = self.receive([300000] * 10, start=start)
+        self.check_aligned(download)
+        download.flush_chunks()
+        self.assertEqual(download.file_selector.fd.getvalue()[start:], content)
+
+    def test_large_chunk(self):
+        download, content = self.receive([3 * DOWNLOAD_WRITE_SIZE + 10])
+        self.assertEqual(download.file_selector.fd.writes, [(0, 3 * DOWNLOAD_WRITE_SIZE)])
+        download.flush_chunks()
+        self.assertEqual(download.file_selector.fd.writes[-1], (3 * DOWNLOAD_WRITE_SIZE, 10))
+        self.assertEqual(download.file_selector.fd.getvalue(), content)
+
+    def test_tail_flush(self):
+        download, content = self.receive([100, 200, 300])
+        self.assertEqual(download.file_selector.fd.writes, [])
+        self.assertEqual(download.pending_bytes, 0)
+        download.flush_chunks()
+        self.assertEqual(download.file_selector.fd.writes, [(0, 600)])
+        self.assertEqual(download.file_selector.fd.getvalue(), content)
+        # nothing is left to write
+        download.flush_chunks()
+        self.assertEqual(len(download.file_selector.fd.writes), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
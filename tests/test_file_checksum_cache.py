@@ -0,0 +1,113 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Checksums of the files sent, cached by FileChecksumCache.
+
+A checksum is only returned while the inode, size and modification time of
+the file are the ones it was computed for, the least recently used entries
+are evicted above max_entries and the file_checksums table follows the cache.
+
+run with: python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import sys
+import time
+import unittest
+
+from collections import OrderedDict, namedtuple
+from threading import Event, Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+from history_schema import HistoryLogger, connect, history_class
+
+
+# Same columns and index SQLObject creates for FileChecksum
+FILE_CHECKSUMS_SCHEMA = (
+    "CREATE TABLE file_checksums (id INTEGER PRIMARY KEY AUTOINCREMENT, file_path TEXT, inode INT, file_size INT, mtime FLOAT, hash TEXT, last_used FLOAT)",
+    "CREATE UNIQUE INDEX file_checksums_path_idx ON file_checksums (file_path)")
+
+Stat = namedtuple('Stat', 'st_ino st_size st_mtime')
+
+
+class HistoryDatabase(object):
+    # the methods of the SQLObject connection used by FileChecksumCache
+    def __init__(self, db):
+        self.db = db
+        self.module = sqlite3
+
+    def getConnection(self):
+        return self.db
+
+    def releaseConnection(self, conn):
+        self.db.commit()
+
+
+class NotificationData(object):
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+# the db thread calls are run right away
+FileChecksumCache = history_class('FileChecksumCache', dict(Singleton=type, run_in_db_thread=lambda func: func, BlinkLogger=HistoryLogger, NotificationData=NotificationData,
+                                                            OrderedDict=OrderedDict, Lock=Lock, Event=Event, os=os, time=time))
+
+
+class FileChecksumCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = connect(':memory:')
+        for query in FILE_CHECKSUMS_SCHEMA:
+            self.db.execute(query)
+        self.cache = FileChecksumCache.__new__(FileChecksumCache)
+        self.cache.db = HistoryDatabase(self.db)
+        self.cache.entries = OrderedDict()
+        self.cache.lock = Lock()
+        self.cache.hits = 0
+        self.cache.misses = 0
+        self.cache.initialized = Event()
+        self.cache.initialized.set()
+
+    def tearDown(self):
+        self.db.close()
+
+    def stored_paths(self):
+        return sorted(row[0] for row in self.db.execute("SELECT file_path FROM file_checksums"))
+
+    def test_hit(self):
+        stat = Stat(1, 100, 1000.0)
+        self.cache.put('/tmp/a', stat, 'hash-a')
+        self.assertEqual(self.cache.get('/tmp/a', stat), 'hash-a')
+        self.assertEqual(self.cache.get('/tmp/b', stat), None)
+        self.assertEqual((self.cache.stats.hits, self.cache.stats.misses, self.cache.stats.entries), (1, 1, 1))
+        self.assertEqual(self.stored_paths(), ['/tmp/a'])
+
+    def test_invalidation(self):
+        stat = Stat(1, 100, 1000.0)
+        for changed in (Stat(2, 100, 1000.0), Stat(1, 101, 1000.0), Stat(1, 100, 1000.5)):
+            self.cache.put('/tmp/a', stat, 'hash-a')
+            self.assertEqual(self.cache.get('/tmp/a', changed), None, changed)
+            self.assertEqual(self.cache.get('/tmp/a', stat), 'hash-a')
+        self.cache.put('/tmp/a', Stat(1, 100, 1000.5), 'hash-b')
+        self.assertEqual(self.cache.get('/tmp/a', stat), None)
+        self.assertEqual(self.cache.get('/tmp/a', Stat(1, 100, 1000.5)), 'hash-b')
+        self.assertEqual(self.db.execute("SELECT hash FROM file_checksums WHERE file_path = '/tmp/a'").fetchall(), [('hash-b',)])
+
+    def test_eviction(self):
+        self.cache.max_entries = 3
+        stat = Stat(1, 100, 1000.0)
+        for name in 'abc':
+            self.cache.put('/tmp/' + name, stat, 'hash-' + name)
+        # a lookup makes an entry the most recently used one
+        self.assertEqual(self.cache.get('/tmp/a', stat), 'hash-a')
+        self.cache.put('/tmp/d', stat, 'hash-d')
+        self.assertEqual(list(self.cache.entries), ['/tmp/c', '/tmp/a', '/tmp/d'])
+        self.assertEqual(self.cache.get('/tmp/b', stat), None)
+        self.assertEqual(self.stored_paths(), ['/tmp/a', '/tmp/c', '/tmp/d'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Query plans of the hot history queries.
+
+The chat_messages table is filled with 1,000,000 messages and the sessions
+table with 200,000 calls, with the indexes declared by ChatHistory and
+SessionHistory. The queries are built by the HistoryManager methods, called
+the way Blink calls them, and each must be answered through the index meant
+for it and never with a full table scan.
+
+run with: python -m unittest discover tests
+"""
+
+import os
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+from history_schema import connect, create_history_indexes, create_history_tables, generate_chat_messages, generate_sessions, history_indexes, history_queries
+
+
+CHAT_MESSAGES_COUNT = 1000000
+SESSIONS_COUNT = 200000
+
+CHAT_HISTORY_METHODS = ('_where_messages', '_where_search_text', '_fts_match_expression', '_get_message_rows', 'get_message_rows', '_get_daily_entries', 'get_daily_entries')
+SESSION_HISTORY_METHODS = ('_get_entries', 'get_entries', '_get_last_chat_conversations', 'get_last_chat_conversations', '_get_last_sms_conversations', 'get_last_sms_conversations')
+
+# (description, method, keyword arguments, indexes one of which the plan must use)
+CHAT_QUERIES = (
+    ("history replay", 'get_message_rows', dict(remote_uri=['contact1@example.com'], media_type=('chat', 'sms'), count=100),
+     ('remote_uri_media_type_date_index',)),
+    ("history replay of a contact with several addresses", 'get_message_rows', dict(remote_uri=['contact1@example.com', 'contact2@example.com'], media_type=('chat', 'sms'), count=100),
+     ('remote_uri_media_type_date_index',)),
+    ("history replay of a zoom period", 'get_message_rows', dict(remote_uri=['contact1@example.com'], media_type=('chat', 'sms'), after_date='2015-01-01', count=10000),
+     ('remote_uri_media_type_date_index',)),
+    ("older page of history", 'get_message_rows', dict(remote_uri=['contact1@example.com'], media_type=('chat', 'sms'), before=('2015-01-02 00:00:00', 1000), count=250),
+     ('remote_uri_media_type_date_index',)),
+    ("newer page of history", 'get_message_rows', dict(remote_uri=['contact1@example.com'], media_type=('chat', 'sms'), after=('2015-01-02 00:00:00', 1000), count=250),
+     ('remote_uri_media_type_date_index',)),
+    ("history viewer messages of a day", 'get_message_rows', dict(remote_uri=['contact1@example.com'], media_type='chat', date='2015-01-02', count=1000),
+     ('remote_uri_media_type_date_index',)),
+    ("daily entries", 'get_daily_entries', dict(media_type='chat'),
+     ('media_type_date_index',)),
+    ("daily entries of a contact", 'get_daily_entries', dict(remote_uri=['contact1@example.com'], media_type='chat'),
+     ('media_type_date_index', 'remote_uri_media_type_date_index')),
+    ("daily entries of an account", 'get_daily_entries', dict(local_uri='alice@example.com', media_type='chat'),
+     ('media_type_date_index',)),
+)
+
+SESSION_QUERIES = (
+    ("server history call lookup", 'get_entries', dict(direction='incoming', count=1, call_id='callid1', from_tag='fromtag1'),
+     ('sip_callid_start_time_index', 'sip_fromtag_start_time_index')),
+    ("recent calls", 'get_entries', dict(direction='incoming', status='completed', count=10),
+     ('start_time_index',)),
+    ("missed calls group", 'get_entries', dict(hidden=0, after_date='2015-01-01 00:00:00', count=200),
+     ('start_time_index',)),
+    ("outgoing calls group", 'get_entries', dict(direction='outgoing', remote_focus="0", hidden=0, after_date='2015-01-01 00:00:00', count=100),
+     ('start_time_index',)),
+    ("last chat conversations", 'get_last_chat_conversations', dict(count=4),
+     ('start_time_media_types_index',)),
+)
+
+SMS_QUERIES = (
+    ("last sms conversations", 'get_last_sms_conversations', dict(count=4),
+     ('media_type_time_index',)),
+)
+
+
+class HistoryQueryPlanTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = connect(':memory:')
+        # the indexes are built once the rows are in, which is faster than updating them on each insert
+        create_history_tables(cls.db, indexes=False)
+        generate_chat_messages(cls.db, CHAT_MESSAGES_COUNT)
+        generate_sessions(cls.db, SESSIONS_COUNT)
+        create_history_indexes(cls.db)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+
+    def query_plan(self, statement, parameters):
+        return [row[-1] for row in self.db.execute("EXPLAIN QUERY PLAN " + statement, parameters)]
+
+    def check_queries(self, table, class_name, method_names, queries):
+        full_scan = re.compile(r'^SCAN (TABLE )?%s\b(?!.*\bINDEX\b)' % table)
+        for description, method, arguments, indexes in queries:
+            history, statements = history_queries(class_name, method_names)
+            getattr(history, method)(**arguments)
+            self.assertEqual(len(statements), 1, "%s runs %d queries" % (description, len(statements)))
+            statement, parameters = statements[0]
+            plan = self.query_plan(statement, parameters)
+            self.assertFalse([line for line in plan if full_scan.match(line)], "%s scans the %s table: %s\n%s" % (description, table, plan, statement))
+            self.assertTrue([line for line in plan if re.search(r'\bINDEX (%s)\b' % '|'.join(indexes), line)], "%s does not use %s: %s\n%s" % (description, ' or '.join(indexes), plan, statement))
+
+    def test_row_counts(self):
+        self.assertEqual(self.db.execute("SELECT count(*) FROM chat_messages").fetchone()[0], CHAT_MESSAGES_COUNT)
+        self.assertEqual(self.db.execute("SELECT count(*) FROM sessions").fetchone()[0], SESSIONS_COUNT)
+
+    def test_declared_indexes(self):
+        for table, class_name in (('chat_messages', 'ChatHistory'), ('sessions', 'SessionHistory')):
+            created = set(row[0] for row in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table,)))
+            for name, columns in history_indexes(class_name):
+                self.assertIn(name, created)
+
+    def test_chat_messages_queries(self):
+        self.check_queries('chat_messages', 'ChatHistory', CHAT_HISTORY_METHODS, CHAT_QUERIES)
+        self.check_queries('chat_messages', 'SessionHistory', SESSION_HISTORY_METHODS, SMS_QUERIES)
+
+    def test_sessions_queries(self):
+        self.check_queries('sessions', 'SessionHistory', SESSION_HISTORY_METHODS, SESSION_QUERIES)
+
+
+if __name__ == '__main__':
+    unittest.main()
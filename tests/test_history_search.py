@@ -0,0 +1,61 @@
+# Copyright (C) 2009-2011 AG Projects. See LICENSE for details.
+#
+
+"""
+Full text search of the chat history.
+
+The trigram index of chat_messages_fts must find the same messages as the
+LIKE '%text%' search it replaces, parts of words and numbers included.
+
+run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'benchmarks'))
+
+from history_schema import connect, create_history_tables, populate_chat_messages
+
+
+# statements as built by ChatHistory._where_search_text and ChatHistory._search_messages
+MATCH = "select id from chat_messages where id in (select rowid from chat_messages_fts where chat_messages_fts match ?)"
+LIKE = "select id from chat_messages where body like ?"
+SEARCH = ("select chat_messages.id from chat_messages join (select rowid, rank from chat_messages_fts where chat_messages_fts match ?) as matches "
+          "on chat_messages.id = matches.rowid where remote_uri = ? order by matches.rank limit ?")
+
+
+def match_expression(search_text):
+    # same as ChatHistory._fts_match_expression
+    return '"%s"' % search_text.replace('"', '""')
+
+
+class HistorySearchTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = connect(':memory:')
+        create_history_tables(cls.db, fts=True)
+        populate_chat_messages(cls.db, 2000)
+        cls.db.execute("update chat_messages set body = ? where id = 1", ("call me at +31 20 5551234, ask for \"Sip2Sip\"",))
+        cls.db.execute("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+
+    def test_same_matches_as_like(self):
+        for text in ('ference', 'CONF', 'lo mee', '5551', '20 555', 'p2s', '"sip2sip"', '1234, ask'):
+            matched = sorted(row[0] for row in self.db.execute(MATCH, (match_expression(text),)))
+            liked = sorted(row[0] for row in self.db.execute(LIKE, ('%' + text + '%',)))
+            self.assertTrue(liked, text)
+            self.assertEqual(matched, liked, text)
+
+    def test_ranked_search(self):
+        rows = self.db.execute(SEARCH, (match_expression('ference'), 'contact1@example.com', 10)).fetchall()
+        self.assertTrue(0 < len(rows) <= 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
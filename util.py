@@ -2,7 +2,7 @@
 #
 
 __all__ = ['audio_codecs', 'allocate_autorelease_pool', 'beautify_audio_codec', 'beautify_video_codec', 'call_in_gui_thread', 'run_in_gui_thread',
-           'compare_identity_addresses', 'escape_html', 'external_url_pattern', 'format_uri_type', 'format_identity_to_string', 'format_date', 'format_size', 'format_size_rounded', 'is_sip_aor_format', 'is_anonymous', 'image_file_extension_pattern', 'html2txt', 'normalize_sip_uri_for_outgoing_session', 'osx_version',
+           'clear_identity_cache', 'compare_identity_addresses', 'escape_html', 'external_url_pattern', 'format_uri_type', 'format_identity_to_string', 'format_date', 'format_size', 'format_size_rounded', 'is_sip_aor_format', 'is_anonymous', 'image_file_extension_pattern', 'html2txt', 'normalize_sip_uri_for_outgoing_session', 'osx_version',
            'sipuri_components_from_string', 'strip_addressbook_special_characters', 'sip_prefix_pattern', 'video_file_extension_pattern',  'translate_alpha2digit', 'checkValidPhoneNumber',
            'AccountInfo', 'DictDiffer', 'local_to_utc', 'utc_to_local']
 
@@ -17,9 +17,11 @@ import time
 import calendar
 
 
+from collections import OrderedDict
 from datetime import datetime
 from htmlentitydefs import name2codepoint
 from HTMLParser import HTMLParser, HTMLParseError
+from threading import Lock
 
 from application.python.decorator import decorator, preserve_signature
 
@@ -38,6 +40,40 @@ _pstn_addressbook_chars_substract_regexp = re.compile(_pstn_addressbook_chars)
 _pstn_match_regexp = re.compile("^\+?([0-9,\#\*]|%s)+$" % _pstn_addressbook_chars)
 _pstn_plus_regexp = re.compile("^\+")
 
+_identity_number_regexp = re.compile(r'^(?P<number>\+[1-9][0-9]\d{5,15})@(\d{1,3}\.){3}\d{1,3}$')
+_number_ip_regexp = re.compile(r'^(?P<number>\+?[0-9]\d{5,15})@(\d{1,3}\.){3}\d{1,3}$')
+_number_regexp = re.compile(r'^(?P<number>(00|\+)[1-9]\d{4,14})@')
+
+
+class _LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# parsed SIP URIs, the parsing does not depend on anything else
+_sipuri_components_cache = _LRUCache(5000)
+
+# identities formatted after the contact matching their URI, cleared when the contacts change
+_identity_cache = _LRUCache(5000)
+
 
 def strip_addressbook_special_characters(contact):
     return _pstn_addressbook_chars_substract_regexp.sub("", contact)
@@ -103,11 +139,31 @@ def normalize_sip_uri_for_outgoing_session(target_uri, account):
     return target_uri
 
 
+def clear_identity_cache():
+    _identity_cache.clear()
+
+
 def format_identity_to_string(identity, check_contact=False, format='AOR'):
     """
     Takes a SIPURI, Account, FromHeader, ToHeader, CPIMIdentity object and
     returns either an AOR (user@domain), compact (username of phone number) or full (Display Name <user@domain>)
     """
+    if not check_contact or format == 'AOR':
+        return _format_identity_to_string(identity, check_contact, format)
+
+    if isinstance(identity, (SIPURI, FrozenSIPURI)):
+        key = (str(identity), None, format)
+    else:
+        key = (str(identity.uri), identity.display_name, format)
+    try:
+        return _identity_cache[key]
+    except KeyError:
+        result = _format_identity_to_string(identity, check_contact, format)
+        _identity_cache[key] = result
+        return result
+
+
+def _format_identity_to_string(identity, check_contact, format):
     port = 5060
     transport = 'udp'
     if isinstance(identity, (SIPURI, FrozenSIPURI)):
@@ -144,7 +200,7 @@ def format_identity_to_string(identity, check_contact=False, format='AOR'):
     else:
         address = u"%s@%s:%d;transport=%s" % (user, host, port, transport)
 
-    match = re.match(r'^(?P<number>\+[1-9][0-9]\d{5,15})@(\d{1,3}\.){3}\d{1,3}$', address)
+    match = _identity_number_regexp.match(address)
     if contact:
         if format == 'compact':
             if display_name == user or not display_name:
@@ -174,6 +230,17 @@ def sipuri_components_from_string(text):
     """
     Takes a SIP URI in text format and returns formatted strings with various sub-parts
     """
+    # str and unicode texts compare equal but give results of their own type
+    key = (isinstance(text, unicode), text)
+    try:
+        return _sipuri_components_cache[key]
+    except KeyError:
+        result = _sipuri_components_from_string(text)
+        _sipuri_components_cache[key] = result
+        return result
+
+
+def _sipuri_components_from_string(text):
     display_name = ""
     address = ""
     full_uri = ""
@@ -206,9 +273,7 @@ def sipuri_components_from_string(text):
     else:
         full_uri = address
 
-    match_number_ip = re.match(r'^(?P<number>\+?[0-9]\d{5,15})@(\d{1,3}\.){3}\d{1,3}$', address)
-    match_number = re.match(r'^(?P<number>(00|\+)[1-9]\d{4,14})@', address)
-    match = match_number_ip or match_number
+    match = _number_ip_regexp.match(address) or _number_regexp.match(address)
 
     if match is not None:
         address = match.group('number')
@@ -350,6 +415,17 @@ def run_in_gui_thread(func):
     return wrapper
 
 
+def run_in_thread_pool(pool):
+    # Returns a decorator which runs the decorated function in a thread of the twisted ThreadPool pool
+    @decorator
+    def run_in_pool_thread(func):
+        @preserve_signature(func)
+        def wrapper(*args, **kw):
+            pool.callInThread(func, *args, **kw)
+        return wrapper
+    return run_in_pool_thread
+
+
 @decorator
 def allocate_autorelease_pool(func):
     @preserve_signature(func)